@@ -0,0 +1,111 @@
+"""
+Bandeja de salida (outbox) de los mensajes del worker
+
+El worker escribe el mensaje en notificaciones_salida en la misma
+transacción que actualiza finanzas: o quedan las dos cosas o ninguna.
+El relevo (un hilo del notificador) saca las filas por lotes y las pasa
+a la cola de notificador.py en un solo pipeline de Redis; las filas se
+borran recién cuando Redis las tiene. Si el relevo cae entre medio, el
+lote se vuelve a pasar y la cola lo agrupa por clave (gasto_id), así que
+un mensaje repetido no se envía dos veces.
+"""
+import os
+import json
+import logging
+import threading
+
+from psycopg2.extras import execute_values
+
+import db
+import notificador
+
+logger = logging.getLogger(__name__)
+
+BANDEJA_LOTE = int(os.getenv('BANDEJA_LOTE', '200'))
+BANDEJA_INTERVALO = float(os.getenv('BANDEJA_INTERVALO', '0.5'))
+
+SQL_CREAR_TABLA = """
+    CREATE TABLE IF NOT EXISTS notificaciones_salida (
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        clave TEXT NOT NULL,
+        mensaje TEXT NOT NULL,
+        creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+# SKIP LOCKED: varios relevos pueden drenar a la vez sin pisarse
+SQL_TOMAR = """
+    DELETE FROM notificaciones_salida
+    WHERE id IN (
+        SELECT id FROM notificaciones_salida
+        ORDER BY id
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, chat_id, clave, mensaje
+"""
+
+
+def agregar(cursor, chat_id, clave, texto, teclado=None, parse_mode='Markdown'):
+    """Agrega el mensaje en la transacción del cursor (el llamador hace commit)"""
+    mensaje = notificador.construir_mensaje(texto, teclado, parse_mode)
+    cursor.execute(
+        "INSERT INTO notificaciones_salida (chat_id, clave, mensaje) VALUES (%s, %s, %s)",
+        (chat_id, str(clave), json.dumps(mensaje))
+    )
+
+
+def agregar_lote(cursor, mensajes):
+    """Como agregar() para varios (chat_id, clave, texto, teclado) en un solo INSERT"""
+    execute_values(
+        cursor,
+        "INSERT INTO notificaciones_salida (chat_id, clave, mensaje) VALUES %s",
+        [
+            (chat_id, str(clave), json.dumps(notificador.construir_mensaje(texto, teclado)))
+            for chat_id, clave, texto, teclado in mensajes
+        ],
+        page_size=len(mensajes)
+    )
+
+
+def drenar(redis_conn, lote=BANDEJA_LOTE):
+    """Pasa hasta 'lote' mensajes a la cola del notificador. Retorna cuántos."""
+    with db.conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SQL_TOMAR, (lote,))
+            filas = cur.fetchall()
+        if not filas:
+            conn.rollback()
+            return 0
+
+        # El DELETE se confirma solo si el pipeline llegó entero a Redis
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for _, chat_id, clave, mensaje in sorted(filas):
+                notificador.encolar(redis_conn, chat_id, clave, json.loads(mensaje), pipeline=pipe)
+            pipe.execute()
+        conn.commit()
+    return len(filas)
+
+
+def relevar(redis_conn, detener):
+    """Bucle del relevo: drena mientras haya lotes llenos, si no espera"""
+    logger.info(f"📤 Relevo de la bandeja de salida iniciado (lotes de {BANDEJA_LOTE})")
+    while not detener.is_set():
+        try:
+            movidos = drenar(redis_conn)
+        except Exception as e:
+            logger.error(f"❌ Error drenando la bandeja de salida: {e}")
+            detener.wait(max(BANDEJA_INTERVALO, 1))
+            continue
+
+        if movidos:
+            logger.info(f"📤 {movidos} mensajes pasados al notificador")
+        if movidos < BANDEJA_LOTE:
+            detener.wait(BANDEJA_INTERVALO)
+
+
+def iniciar_relevo(redis_conn, detener):
+    hilo = threading.Thread(target=relevar, args=(redis_conn, detener), name='bandeja-salida', daemon=True)
+    hilo.start()
+    return hilo
@@ -0,0 +1,130 @@
+"""
+Barrido de gastos huérfanos: filas 'pending' o 'error' sin job vigente
+
+Una foto queda huérfana si Redis no estaba al recibirla (encolar_foto
+retorna None y la fila queda 'pending') o si el worker murió a mitad de
+los reintentos ('error' sin job vigente). Las filas cuyo último intento
+de RQ falló quedan en 'fallido': el usuario ya recibió el aviso con
+🔄 Reintentar y el barrido no las toca. El barrido corre al iniciar el bot y el worker y luego
+cada BARRIDO_INTERVALO segundos:
+
+1. Toma por lotes, con el índice parcial idx_finanzas_status_pendientes,
+   las filas 'pending'/'error' creadas hace más de BARRIDO_ANTIGUEDAD
+   segundos (y menos de BARRIDO_MAX_HORAS horas), con FOR UPDATE SKIP
+   LOCKED para que dos barridos no tomen la misma fila.
+2. Descarta las que tienen un job vigente según RQ, buscado por la marca
+   fotos:gasto:{id} (queue_manager.con_marca): esperando turno en el
+   carril, encolado, programado para reintento o en proceso.
+3. Las demás vuelven a 'pending', suman un barrido_intentos y se encolan
+   todas en un solo pipeline (queue_manager.encolar_lote). El UPDATE se
+   confirma solo si Redis aceptó el lote.
+
+Tras BARRIDO_MAX_INTENTOS barridos una fila se deja como está.
+"""
+import os
+import time
+import logging
+import threading
+
+import db
+
+logger = logging.getLogger(__name__)
+
+BARRIDO_INTERVALO = float(os.getenv('BARRIDO_INTERVALO', '300'))
+BARRIDO_ANTIGUEDAD = float(os.getenv('BARRIDO_ANTIGUEDAD', '60'))
+BARRIDO_MAX_HORAS = float(os.getenv('BARRIDO_MAX_HORAS', '48'))
+BARRIDO_MAX_INTENTOS = int(os.getenv('BARRIDO_MAX_INTENTOS', '3'))
+BARRIDO_LOTE = int(os.getenv('BARRIDO_LOTE', '500'))
+
+# Las condiciones sobre status y creado coinciden con el índice parcial
+SQL_CANDIDATOS = """
+    SELECT id
+    FROM finanzas
+    WHERE status IN ('pending', 'error')
+      AND creado < LOCALTIMESTAMP - interval '1 second' * %s
+      AND creado > LOCALTIMESTAMP - interval '1 hour' * %s
+      AND barrido_intentos < %s
+      AND id > %s
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+"""
+
+SQL_REACTIVAR = """
+    UPDATE finanzas
+    SET status = 'pending', barrido_intentos = barrido_intentos + 1
+    WHERE id = ANY(%s)
+    RETURNING id, COALESCE(image_path, telegram_file_id), telegram_chat_id, telegram_user_id
+"""
+
+
+def _barrer_lote(desde, lote):
+    """
+    Un lote de candidatos con id > desde.
+
+    Returns:
+        (último id visto o None si no hubo candidatos, cantidad encolada)
+    """
+    import queue_manager
+
+    with db.conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute(SQL_CANDIDATOS, (BARRIDO_ANTIGUEDAD, BARRIDO_MAX_HORAS, BARRIDO_MAX_INTENTOS, desde, lote))
+            candidatos = [fila_id for (fila_id,) in cur.fetchall()]
+            if not candidatos:
+                conn.rollback()
+                return None, 0
+
+            vigentes = queue_manager.con_marca(candidatos)
+            huerfanos = [g for g in candidatos if g not in vigentes]
+            fotos = []
+            if huerfanos:
+                cur.execute(SQL_REACTIVAR, (huerfanos,))
+                # Sin imagen ni chat no hay nada que procesar ni a quién avisar
+                fotos = [fila for fila in cur.fetchall() if fila[1] and fila[2]]
+
+        # Si Redis falla, el rollback deja las filas e intentos como estaban
+        queue_manager.encolar_lote(sorted(fotos))
+        conn.commit()
+    return candidatos[-1], len(fotos)
+
+
+def barrer(lote=BARRIDO_LOTE):
+    """Encola los gastos huérfanos. Retorna cuántos encoló."""
+    import queue_manager
+    if queue_manager.redis_conn is None:
+        return 0
+
+    # Carriles detenidos por cupos vencidos de workers caídos
+    queue_manager.despachar()
+
+    inicio = time.monotonic()
+    total = 0
+    desde = 0
+    while True:
+        desde, encolados = _barrer_lote(desde, lote)
+        total += encolados
+        if desde is None:
+            break
+
+    if total:
+        logger.info(f"🧹 Barrido: {total} gastos huérfanos encolados en {time.monotonic() - inicio:.1f}s")
+    return total
+
+
+def _bucle(detener):
+    while True:
+        try:
+            barrer()
+        except Exception as e:
+            logger.error(f"❌ Error en el barrido de gastos huérfanos: {e}")
+        if detener.wait(BARRIDO_INTERVALO):
+            return
+
+
+def iniciar(detener=None):
+    """Barre ahora y cada BARRIDO_INTERVALO segundos en un hilo aparte"""
+    detener = detener or threading.Event()
+    threading.Thread(target=_bucle, args=(detener,), name='barrido', daemon=True).start()
+    logger.info(f"🧹 Barrido de gastos huérfanos cada {BARRIDO_INTERVALO:.0f}s")
+    return detener
@@ -0,0 +1,3 @@
+"""
+Benchmarks y pruebas de carga (se ejecutan con: python -m bench.<modulo>)
+"""
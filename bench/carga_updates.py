@@ -0,0 +1,96 @@
+"""
+Prueba de carga del procesamiento de updates: secuencial vs. concurrente por chat
+
+Uso:
+    python -m bench.carga_updates --usuarios 200 --mensajes 5 --latencia 0.05
+
+Simula --usuarios chats que envían --mensajes updates cada uno, intercalados
+como llegarían de Telegram. Cada handler tarda --latencia segundos (descarga,
+BD, encolado). Verifica que los updates de cada chat se procesen en orden y
+sin solaparse, y reporta updates/seg y latencia por update.
+"""
+import time
+import asyncio
+import argparse
+from datetime import datetime
+
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+from procesador_updates import ProcesadorPorChat
+
+
+def generar_updates(usuarios, mensajes):
+    updates = []
+    update_id = 0
+    for n in range(mensajes):
+        for uid in range(1, usuarios + 1):
+            update_id += 1
+            chat = Chat(uid, Chat.PRIVATE)
+            mensaje = Message(n, datetime.now(), chat, from_user=User(uid, f'u{uid}', False), text=str(n))
+            updates.append(Update(update_id, message=mensaje))
+    return updates
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(int(len(ordenados) * p), len(ordenados) - 1)]
+
+
+async def correr(procesador, updates, latencia):
+    vistos = {}
+    activos = set()
+    errores = []
+    latencias = []
+
+    async def handler(update, llegada):
+        chat_id = update.effective_chat.id
+        if chat_id in activos:
+            errores.append(f'chat {chat_id}: updates solapados')
+        activos.add(chat_id)
+        await asyncio.sleep(latencia)
+        n = int(update.message.text)
+        if vistos.get(chat_id, -1) != n - 1:
+            errores.append(f'chat {chat_id}: llegó {n} después de {vistos.get(chat_id)}')
+        vistos[chat_id] = n
+        activos.discard(chat_id)
+        latencias.append(time.perf_counter() - llegada)
+
+    inicio = time.perf_counter()
+    async with procesador:
+        # Igual que Application: una tarea por update, creadas en orden de llegada
+        tareas = [
+            asyncio.create_task(procesador.process_update(u, handler(u, time.perf_counter())))
+            for u in updates
+        ]
+        await asyncio.gather(*tareas)
+    duracion = time.perf_counter() - inicio
+    return duracion, latencias, errores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--usuarios', type=int, default=200)
+    parser.add_argument('--mensajes', type=int, default=5)
+    parser.add_argument('--latencia', type=float, default=0.05)
+    parser.add_argument('--concurrencia', type=int, default=64)
+    args = parser.parse_args()
+
+    updates = generar_updates(args.usuarios, args.mensajes)
+    casos = [
+        ('secuencial', SimpleUpdateProcessor(1)),
+        ('por_chat', ProcesadorPorChat(args.concurrencia)),
+    ]
+
+    print(f"{len(updates)} updates de {args.usuarios} usuarios, {args.latencia * 1000:.0f} ms por handler")
+    print(f"{'modo':<12} {'updates/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'errores':>8}")
+    for nombre, procesador in casos:
+        duracion, latencias, errores = asyncio.run(correr(procesador, updates, args.latencia))
+        print(f"{nombre:<12} {len(updates) / duracion:>10.1f} "
+              f"{percentil(latencias, 0.5) * 1000:>9.0f} {percentil(latencias, 0.99) * 1000:>9.0f} {len(errores):>8}")
+        for error in errores[:5]:
+            print(f"   ⚠️ {error}")
+
+
+if __name__ == '__main__':
+    main()
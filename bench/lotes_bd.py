@@ -0,0 +1,146 @@
+"""
+Benchmark de filas/seg al guardar resultados del OCR: una transacción por
+fila vs. lotes con UPDATE ... FROM (VALUES ...)
+
+Uso:
+    python -m bench.lotes_bd --filas 5000 --hilos 16 --tamano 50
+
+Usa un Postgres desechable (bench/postgres_temporal.py, o BENCH_DATABASE_URL).
+Inserta --filas gastos en estado 'pending' y los pasa a 'processed' con:
+
+    por_fila   un UPDATE ... WHERE id = %s y un commit por fila (el camino
+               anterior de actualizar_bd), desde --hilos hilos
+    lotes      lotes_bd.EscritorLotes con --hilos hilos escribiendo a la vez,
+               como en el worker async
+    directo    lotes_bd.aplicar() con lotes de --tamano filas desde un hilo
+
+Cada modo escribe también el mensaje en la bandeja de salida.
+"""
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.postgres_temporal import postgres_temporal
+
+OCR = {'monto': 12500, 'fecha': '2024-03-15', 'categoria': 'Comida', 'descripcion': 'Almuerzo'}
+
+
+def preparar(filas):
+    import db
+    db.ejecutar_sql_sync("TRUNCATE finanzas, notificaciones_salida RESTART IDENTITY")
+    db.ejecutar_sql_sync("""
+        INSERT INTO finanzas (status, telegram_user_id, telegram_chat_id)
+        SELECT 'pending', 1 + g %% 100, 1 + g %% 100 FROM generate_series(1, %s) AS g
+    """, (filas,))
+    return list(range(1, filas + 1))
+
+
+def fila_ocr(gasto_id):
+    import lotes_bd
+    ahora = datetime.now()
+    return lotes_bd.FilaOcr(
+        id=gasto_id, status='processed', ocr_data=json.dumps(OCR), processed_at=ahora,
+        fecha=datetime(2024, 3, 15).date(), monto=12500.0, categoria='Comida', descripcion='Almuerzo',
+        tipo_gasto=None, banco=None, image_path=None,
+        encolado_at=ahora, procesando_at=ahora, ocr_at=ahora,
+    )
+
+
+def notificacion(gasto_id):
+    return (1 + gasto_id % 100, f'Confirmación {gasto_id}', None)
+
+
+def por_fila(ids, hilos, _):
+    """Una transacción por fila, como antes de lotes_bd"""
+    import db
+    import bandeja_salida
+
+    def escribir(gasto_id):
+        fila = fila_ocr(gasto_id)
+        with db.conexion() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE finanzas
+                    SET status = %s, ocr_data = %s, processed_at = %s,
+                        fecha = COALESCE(%s, fecha), monto = COALESCE(%s, monto),
+                        categoria = COALESCE(%s, categoria), descripcion = COALESCE(%s, descripcion),
+                        tipo_gasto = COALESCE(%s, tipo_gasto), banco = COALESCE(%s, banco),
+                        image_path = COALESCE(%s, image_path), encolado_at = COALESCE(%s, encolado_at),
+                        procesando_at = COALESCE(%s, procesando_at), ocr_at = COALESCE(%s, ocr_at)
+                    WHERE id = %s
+                """, fila[1:] + (fila.id,))
+                chat_id, texto, teclado = notificacion(gasto_id)
+                bandeja_salida.agregar(cur, chat_id, gasto_id, texto, teclado)
+            conn.commit()
+
+    with ThreadPoolExecutor(hilos) as pool:
+        list(pool.map(escribir, ids))
+
+
+def lotes(ids, hilos, tamano):
+    """Muchos hilos escribiendo a la vez a través del EscritorLotes"""
+    import lotes_bd
+    escritor = lotes_bd.EscritorLotes(tamano=tamano)
+    with ThreadPoolExecutor(hilos) as pool:
+        resultados = list(pool.map(lambda i: escritor.escribir(fila_ocr(i), notificacion(i)), ids))
+    assert all(resultados)
+
+
+def directo(ids, _, tamano):
+    import lotes_bd
+    for i in range(0, len(ids), tamano):
+        lote = ids[i:i + tamano]
+        actualizados = lotes_bd.aplicar([(fila_ocr(g), notificacion(g)) for g in lote])
+        assert actualizados == set(lote)
+
+
+MODOS = {'por_fila': por_fila, 'lotes': lotes, 'directo': directo}
+
+
+def verificar(filas):
+    import db
+    procesadas, mensajes = db.ejecutar_sql_sync("""
+        SELECT (SELECT count(*) FROM finanzas WHERE status = 'processed'),
+               (SELECT count(*) FROM notificaciones_salida)
+    """, fetch='one')
+    return procesadas == filas and mensajes == filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filas', type=int, default=5000)
+    parser.add_argument('--hilos', type=int, default=16, help='Jobs escribiendo a la vez')
+    parser.add_argument('--tamano', type=int, default=50, help='Filas por lote')
+    parser.add_argument('--modos', default=','.join(MODOS))
+    args = parser.parse_args()
+
+    with postgres_temporal() as database_url:
+        os.environ.update({
+            'DATABASE_PUBLIC_URL': database_url,
+            'DB_SSLMODE': 'disable',
+            'DB_POOL_MAX': str(args.hilos),
+        })
+        import db
+        from migraciones import aplicar_migraciones
+        db.init_pool()
+        aplicar_migraciones()
+
+        print(f"{args.filas} filas · {args.hilos} hilos · lotes de {args.tamano}")
+        print(f"  {'modo':<10} {'seg':>8} {'filas/s':>10}  ok")
+        try:
+            for nombre in args.modos.split(','):
+                ids = preparar(args.filas)
+                inicio = time.perf_counter()
+                MODOS[nombre](ids, args.hilos, args.tamano)
+                duracion = time.perf_counter() - inicio
+                print(f"  {nombre:<10} {duracion:>8.2f} {args.filas / duracion:>10.0f}  "
+                      f"{'sí' if verificar(args.filas) else 'NO'}")
+        finally:
+            db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
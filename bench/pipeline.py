@@ -0,0 +1,296 @@
+"""
+Benchmark de punta a punta del bot y el worker contra servicios locales
+
+Uso:
+    REDIS_URL=redis://localhost:6379/15 python -m bench.pipeline \\
+        --usuarios 20 --fotos 5 --manuales 5 --modo async --n8n-latencia 1.0
+
+Levanta un n8n y una Bot API de Telegram falsos (bench/servicios.py) y un
+Postgres desechable (bench/postgres_temporal.py), aplica las migraciones y
+arranca un worker y el notificador reales en procesos aparte. Luego
+simula --usuarios usuarios que, en paralelo:
+
+    fotos    /nuevo -> "📸 Subir boleta" -> foto, --fotos veces cada uno
+             (recibir_foto -> encolar_foto -> procesar_foto_job)
+    manual   los nueve pasos del ConversationHandler, --manuales veces
+
+Los updates pasan por el mismo Application de main.py (construir_app) y
+su ProcesadorPorChat. Reporta throughput, percentiles de latencia del bot
+y de punta a punta (foto enviada -> confirmación del worker en Telegram),
+la duración por etapa (metricas.py) y espera en cola vs. proceso según
+los tiempos guardados en finanzas.
+
+Requiere Redis: usar una base dedicada, el bench la vacía con FLUSHDB.
+"""
+import os
+import time
+import asyncio
+import argparse
+import multiprocessing
+from datetime import datetime
+
+from bench.servicios import N8nFalso, TelegramFalso
+from bench.postgres_temporal import postgres_temporal
+
+TOKEN_BENCH = '123456:BENCH'
+ANCHOS_FOTO = (90, 320, 960)
+PASOS_MANUAL = [
+    '/nuevo', '🖋 Ingresar manualmente', '15-03-2024', '12.500', 'Comida',
+    'Gasto', 'Banco Bench', 'Almuerzo', 'Tarjeta Débito',
+]
+
+
+def percentil(valores, p):
+    if not valores:
+        return float('nan')
+    ordenados = sorted(valores)
+    return ordenados[min(int(len(ordenados) * p), len(ordenados) - 1)]
+
+
+def configurar_entorno(n8n, telegram, database_url, args):
+    """Antes de importar los módulos del bot: leen la configuración al importarse"""
+    os.environ.update({
+        'TELEGRAM_TOKEN': TOKEN_BENCH,
+        'TELEGRAM_API_URL': telegram.url,
+        'N8N_ENDPOINT': f'{n8n.url}/webhook/ocr',
+        'DATABASE_PUBLIC_URL': database_url,
+        'DB_SSLMODE': 'disable',
+        'DB_POOL_MAX': str(args.pool),
+        'WORKER_CONCURRENCIA': str(args.concurrencia),
+        'IMAGE_STORE': 'postgres',
+    })
+
+
+def _correr_worker(modo, procesos, concurrencia):
+    from redis import Redis
+    import start_worker
+    start_worker.iniciar(modo, procesos, Redis.from_url(os.environ['REDIS_URL']), concurrencia=concurrencia)
+
+
+def _correr_notificador():
+    import notificador
+    notificador.servir()
+
+
+# -----------------------------------------------------------------------------
+# Updates simulados
+# -----------------------------------------------------------------------------
+
+class Simulador:
+    def __init__(self, app):
+        self.app = app
+        self.update_id = 0
+        self.mensaje_id = 0
+
+    def _update(self, uid, **contenido):
+        self.update_id += 1
+        self.mensaje_id += 1
+        return {
+            'update_id': self.update_id,
+            'message': {
+                'message_id': self.mensaje_id,
+                'date': int(time.time()),
+                'chat': {'id': uid, 'type': 'private'},
+                'from': {'id': uid, 'is_bot': False, 'first_name': f'u{uid}'},
+                **contenido,
+            },
+        }
+
+    def texto(self, uid, texto):
+        contenido = {'text': texto}
+        if texto.startswith('/'):
+            contenido['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(texto.split()[0])}]
+        return self._update(uid, **contenido)
+
+    def foto(self, uid, n):
+        fotos = [
+            {'file_id': f'u{uid}f{n}_{ancho}', 'file_unique_id': f'u{uid}f{n}_{ancho}',
+             'width': ancho, 'height': ancho * 4 // 3, 'file_size': ancho * 100}
+            for ancho in ANCHOS_FOTO
+        ]
+        return self._update(uid, photo=fotos)
+
+    async def enviar(self, datos):
+        """Procesa un update como lo haría el Application; retorna segundos"""
+        from telegram import Update
+        update = Update.de_json(datos, self.app.bot)
+        inicio = time.perf_counter()
+        await self.app.update_processor.process_update(update, self.app.process_update(update))
+        return time.perf_counter() - inicio
+
+
+async def flujo_fotos(sim, telegram, usuarios, fotos, timeout):
+    envios = {}
+    latencias_bot = []
+
+    async def usuario(uid):
+        for n in range(fotos):
+            await sim.enviar(sim.texto(uid, '/nuevo'))
+            await sim.enviar(sim.texto(uid, '📸 Subir boleta (foto)'))
+            envios.setdefault(uid, []).append(time.perf_counter())
+            latencias_bot.append(await sim.enviar(sim.foto(uid, n)))
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(usuario(uid) for uid in range(1, usuarios + 1)))
+
+    total = usuarios * fotos
+    limite = time.perf_counter() + timeout
+    while sum(len(v) for v in telegram.confirmaciones().values()) < total and time.perf_counter() < limite:
+        await asyncio.sleep(0.1)
+    duracion = time.perf_counter() - inicio
+
+    confirmaciones = telegram.confirmaciones()
+    punta_a_punta = []
+    for uid, horas in envios.items():
+        for enviada, confirmada in zip(horas, sorted(confirmaciones.get(uid, []))):
+            punta_a_punta.append(confirmada - enviada)
+    return duracion, latencias_bot, punta_a_punta
+
+
+async def flujo_manual(sim, usuarios, repeticiones):
+    latencias_flujo = []
+    latencias_paso = []
+
+    async def usuario(uid):
+        for _ in range(repeticiones):
+            inicio = time.perf_counter()
+            for paso in PASOS_MANUAL:
+                latencias_paso.append(await sim.enviar(sim.texto(uid, paso)))
+            latencias_flujo.append(time.perf_counter() - inicio)
+
+    inicio = time.perf_counter()
+    # uid distintos a los de fotos para no mezclar conversaciones
+    await asyncio.gather(*(usuario(100_000 + uid) for uid in range(1, usuarios + 1)))
+    return time.perf_counter() - inicio, latencias_flujo, latencias_paso
+
+
+# -----------------------------------------------------------------------------
+# Reporte
+# -----------------------------------------------------------------------------
+
+def fila(nombre, valores, escala=1000):
+    return (f"  {nombre:<22} {len(valores):>6} "
+            f"{percentil(valores, 0.5) * escala:>9.0f} {percentil(valores, 0.9) * escala:>9.0f} "
+            f"{percentil(valores, 0.99) * escala:>9.0f}")
+
+
+def percentil_histograma(conteos, p):
+    import metricas
+    total = sum(conteos)
+    acumulado = 0
+    for limite, n in zip(metricas.BUCKETS + (float('inf'),), conteos):
+        acumulado += n
+        if acumulado >= total * p:
+            return limite
+    return float('inf')
+
+
+def reporte_etapas():
+    import metricas
+    metricas.volcar()
+    print(f"\n  {'etapa':<22} {'n':>6} {'media ms':>9} {'p50 ≤ms':>9} {'p95 ≤ms':>9}")
+    for etapa, (conteos, suma, total) in sorted(metricas._acumulado().items()):
+        if total:
+            print(f"  {etapa:<22} {total:>6} {suma / total * 1000:>9.0f} "
+                  f"{percentil_histograma(conteos, 0.5) * 1000:>9.0f} "
+                  f"{percentil_histograma(conteos, 0.95) * 1000:>9.0f}")
+
+
+def reporte_bd():
+    import db
+    fila_bd = db.ejecutar_sql_sync("""
+        SELECT
+            count(*),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM procesando_at - encolado_at)),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY extract(epoch FROM procesando_at - encolado_at)),
+            percentile_cont(0.5) WITHIN GROUP (ORDER BY extract(epoch FROM processed_at - procesando_at)),
+            percentile_cont(0.95) WITHIN GROUP (ORDER BY extract(epoch FROM processed_at - procesando_at))
+        FROM finanzas
+        WHERE status = 'processed' AND encolado_at IS NOT NULL
+    """, fetch='one')
+    n, espera50, espera95, proceso50, proceso95 = fila_bd
+    if n:
+        print(f"\n  Según finanzas ({n} boletas): espera en cola p50 {espera50:.2f}s p95 {espera95:.2f}s, "
+              f"proceso p50 {proceso50:.2f}s p95 {proceso95:.2f}s")
+
+
+async def correr(args, telegram):
+    import main as bot
+    import metricas
+
+    app = bot.construir_app()
+    sim = Simulador(app)
+    async with app:
+        print(f"\n{'':2}{'medida':<22} {'n':>6} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9}")
+
+        if args.fotos:
+            duracion, bot_ms, e2e = await flujo_fotos(sim, telegram, args.usuarios, args.fotos, args.timeout)
+            total = args.usuarios * args.fotos
+            print(f"Fotos: {len(e2e)}/{total} confirmadas en {duracion:.1f}s "
+                  f"({len(e2e) / duracion:.2f} boletas/s)")
+            print(fila('bot (recibir_foto)', bot_ms))
+            print(fila('punta a punta', e2e))
+
+        if args.manuales:
+            duracion, flujos, pasos = await flujo_manual(sim, args.usuarios, args.manuales)
+            print(f"Manual: {len(flujos)} gastos en {duracion:.1f}s ({len(flujos) / duracion:.1f} gastos/s)")
+            print(fila('flujo completo', flujos))
+            print(fila('paso', pasos))
+
+    metricas.volcar()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--usuarios', type=int, default=20)
+    parser.add_argument('--fotos', type=int, default=5, help='Fotos por usuario')
+    parser.add_argument('--manuales', type=int, default=5, help='Gastos manuales por usuario')
+    parser.add_argument('--modo', default='async', help='Modo del worker (start_worker.py)')
+    parser.add_argument('--procesos', type=int, default=2)
+    parser.add_argument('--concurrencia', type=int, default=16)
+    parser.add_argument('--pool', type=int, default=10, help='DB_POOL_MAX')
+    parser.add_argument('--n8n-latencia', type=float, default=1.0)
+    parser.add_argument('--n8n-jitter', type=float, default=0.2)
+    parser.add_argument('--n8n-errores', type=float, default=0.0, help='Fracción de respuestas 500')
+    parser.add_argument('--timeout', type=float, default=300, help='Espera máxima por las confirmaciones')
+    args = parser.parse_args()
+
+    with N8nFalso(args.n8n_latencia, args.n8n_jitter, args.n8n_errores) as n8n, \
+            TelegramFalso() as telegram, \
+            postgres_temporal() as database_url:
+        configurar_entorno(n8n, telegram, database_url, args)
+
+        import db
+        from migraciones import aplicar_migraciones
+        from queue_manager import redis_conn
+        if redis_conn is None:
+            raise SystemExit("Redis no disponible (REDIS_URL)")
+        redis_conn.flushdb()
+        db.init_pool()
+        aplicar_migraciones()
+
+        worker = multiprocessing.Process(
+            target=_correr_worker, args=(args.modo, args.procesos, args.concurrencia)
+        )
+        worker.start()
+        notificador = multiprocessing.Process(target=_correr_notificador, daemon=True)
+        notificador.start()
+
+        print(f"{datetime.now():%Y-%m-%d %H:%M} · {args.usuarios} usuarios · worker {args.modo} · "
+              f"n8n {args.n8n_latencia}s ±{args.n8n_jitter}s, {args.n8n_errores:.0%} errores")
+        try:
+            asyncio.run(correr(args, telegram))
+            reporte_etapas()
+            reporte_bd()
+            print(f"\n  Llamadas a n8n: {n8n.llamadas}")
+        finally:
+            notificador.terminate()
+            worker.terminate()
+            worker.join(30)
+            if worker.is_alive():
+                worker.kill()
+            db.close_pool()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Postgres desechable para los benchmarks
+
+Con BENCH_DATABASE_URL usa esa base (debe ser descartable: el bench crea
+tablas y filas). Si no, levanta un cluster nuevo con initdb/pg_ctl en un
+directorio temporal, escuchando solo en un socket Unix, y lo borra al salir.
+"""
+import os
+import glob
+import shutil
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+BENCH_DATABASE_URL = os.getenv('BENCH_DATABASE_URL')
+PUERTO = 55432
+
+
+def _binario(nombre):
+    encontrado = shutil.which(nombre)
+    if encontrado:
+        return encontrado
+    # Debian/Ubuntu no ponen los binarios del servidor en el PATH
+    candidatos = sorted(glob.glob(f'/usr/lib/postgresql/*/bin/{nombre}'))
+    if candidatos:
+        return candidatos[-1]
+    raise RuntimeError(f"No se encontró {nombre}: instala PostgreSQL o define BENCH_DATABASE_URL")
+
+
+@contextmanager
+def postgres_temporal():
+    """Entrega la URL de conexión a una base vacía"""
+    if BENCH_DATABASE_URL:
+        yield BENCH_DATABASE_URL
+        return
+
+    directorio = tempfile.mkdtemp(prefix='bench_pg_')
+    datos = os.path.join(directorio, 'datos')
+    log = os.path.join(directorio, 'postgres.log')
+    try:
+        subprocess.run(
+            [_binario('initdb'), '-D', datos, '-U', 'bench', '-A', 'trust', '--no-sync'],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        subprocess.run(
+            [_binario('pg_ctl'), '-D', datos, '-l', log, '-w', 'start', '-o',
+             f"-p {PUERTO} -k {directorio} -c listen_addresses='' -c fsync=off "
+             f"-c synchronous_commit=off -c max_connections=200"],
+            check=True, stdout=subprocess.DEVNULL
+        )
+        try:
+            yield f'postgresql://bench@/postgres?host={directorio}&port={PUERTO}'
+        finally:
+            subprocess.run([_binario('pg_ctl'), '-D', datos, '-m', 'fast', '-w', 'stop'],
+                           stdout=subprocess.DEVNULL)
+    finally:
+        shutil.rmtree(directorio, ignore_errors=True)
@@ -0,0 +1,217 @@
+"""
+Servicios falsos para los benchmarks: n8n y la Bot API de Telegram
+
+Ambos corren en un hilo con ThreadingHTTPServer en 127.0.0.1 y un puerto
+libre; .url da la dirección base.
+
+    N8nFalso        POST cualquier ruta -> JSON de OCR tras 'latencia'
+                    segundos (± jitter); con probabilidad 'tasa_error'
+                    responde 500
+    TelegramFalso   /bot<token>/getMe, getFile, sendMessage, editMessageText,
+                    answerCallbackQuery, sendDocument y /file/bot<token>/<ruta>.
+                    Cada file_id sirve una boleta JPEG distinta generada al
+                    vuelo (file_id '<foto>_<ancho>'); los sendMessage quedan
+                    registrados con su hora.
+"""
+import io
+import json
+import time
+import random
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageDraw
+
+OCR_POR_DEFECTO = {
+    'monto': 12500,
+    'fecha': '2024-03-15',
+    'categoria': 'Gasto',
+    'tipo_gasto': 'Comida',
+    'descripcion': 'Almuerzo',
+    'banco': 'Banco Bench',
+}
+
+
+class _Servidor:
+    def __init__(self, handler):
+        self.servidor = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.servidor.daemon_threads = True
+        self.servidor.servicio = self
+        self.url = f'http://127.0.0.1:{self.servidor.server_address[1]}'
+
+    def __enter__(self):
+        threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.servidor.shutdown()
+        self.servidor.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def servicio(self):
+        return self.server.servicio
+
+    def _responder(self, estado, cuerpo, tipo='application/json'):
+        if isinstance(cuerpo, (dict, list)):
+            cuerpo = json.dumps(cuerpo).encode()
+        self.send_response(estado)
+        self.send_header('Content-Type', tipo)
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def _cuerpo(self):
+        largo = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(largo) if largo else b''
+
+    def log_message(self, format, *args):
+        pass
+
+
+# -----------------------------------------------------------------------------
+# n8n
+# -----------------------------------------------------------------------------
+
+class _N8nHandler(_Handler):
+    def do_POST(self):
+        n8n = self.servicio
+        self._cuerpo()
+        time.sleep(max(n8n.latencia + random.uniform(-n8n.jitter, n8n.jitter), 0))
+        with n8n.lock:
+            n8n.llamadas += 1
+        if random.random() < n8n.tasa_error:
+            self._responder(500, {'error': 'falla simulada'})
+            return
+        self._responder(200, n8n.payload())
+
+
+class N8nFalso(_Servidor):
+    def __init__(self, latencia=1.0, jitter=0.2, tasa_error=0.0, payload=None):
+        super().__init__(_N8nHandler)
+        self.latencia = latencia
+        self.jitter = jitter
+        self.tasa_error = tasa_error
+        # dict fijo o función sin argumentos que retorna el dict
+        self._payload = payload or OCR_POR_DEFECTO
+        self.llamadas = 0
+        self.lock = threading.Lock()
+
+    def payload(self):
+        return self._payload() if callable(self._payload) else self._payload
+
+
+# -----------------------------------------------------------------------------
+# Telegram
+# -----------------------------------------------------------------------------
+
+def boleta_jpeg(semilla, ancho=960, alto=1280):
+    """Boleta sintética: renglones de distinto largo, distinta por semilla"""
+    azar = random.Random(semilla)
+    img = Image.new('L', (ancho, alto), 235)
+    dibujo = ImageDraw.Draw(img)
+    margen = ancho // 8
+    dibujo.rectangle((margen, 40, ancho - margen, alto - 40), fill=255)
+    y = 80
+    while y < alto - 100:
+        largo = azar.randint(ancho // 6, ancho - 3 * margen)
+        dibujo.rectangle((margen + 30, y, margen + 30 + largo, y + 14), fill=azar.randint(0, 80))
+        y += azar.randint(24, 60)
+    salida = io.BytesIO()
+    img.save(salida, 'JPEG', quality=85)
+    return salida.getvalue()
+
+
+class _TelegramHandler(_Handler):
+    def _parametros(self):
+        cuerpo = self._cuerpo()
+        tipo = self.headers.get('Content-Type', '')
+        if tipo.startswith('application/json'):
+            return json.loads(cuerpo or b'{}')
+        if tipo.startswith('application/x-www-form-urlencoded'):
+            return {k: v[0] for k, v in parse_qs(cuerpo.decode()).items()}
+        # multipart (sendDocument): solo interesa que llegue
+        return {}
+
+    def do_GET(self):
+        ruta = self.path.split('?', 1)
+        if ruta[0].startswith('/file/bot'):
+            file_id = ruta[0].rsplit('/', 1)[-1].rsplit('.', 1)[0]
+            self._responder(200, self.servicio.imagen(file_id), 'image/jpeg')
+            return
+        parametros = {k: v[0] for k, v in parse_qs(ruta[1]).items()} if len(ruta) > 1 else {}
+        self._metodo(ruta[0].rsplit('/', 1)[-1], parametros)
+
+    def do_POST(self):
+        self._metodo(self.path.rsplit('/', 1)[-1], self._parametros())
+
+    def _metodo(self, metodo, parametros):
+        telegram = self.servicio
+        if metodo == 'getMe':
+            resultado = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        elif metodo == 'getFile':
+            file_id = parametros['file_id']
+            resultado = {'file_id': file_id, 'file_unique_id': file_id, 'file_path': f'photos/{file_id}.jpg'}
+        elif metodo in ('sendMessage', 'editMessageText', 'sendDocument'):
+            chat_id = int(parametros.get('chat_id') or 0)
+            texto = parametros.get('text', '')
+            telegram.registrar(chat_id, texto, parametros.get('reply_markup') or '')
+            resultado = {
+                'message_id': telegram.siguiente_id(),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private'},
+                'text': texto,
+            }
+        elif metodo in ('answerCallbackQuery', 'setWebhook', 'deleteWebhook'):
+            resultado = True
+        else:
+            self._responder(404, {'ok': False, 'error_code': 404, 'description': f'{metodo} no simulado'})
+            return
+        self._responder(200, {'ok': True, 'result': resultado})
+
+
+class TelegramFalso(_Servidor):
+    def __init__(self):
+        super().__init__(_TelegramHandler)
+        self.mensajes = []  # (hora, chat_id, texto, reply_markup)
+        self._imagenes = {}
+        self._id = 0
+        self.lock = threading.Lock()
+
+    def siguiente_id(self):
+        with self.lock:
+            self._id += 1
+            return self._id
+
+    def registrar(self, chat_id, texto, reply_markup):
+        if isinstance(reply_markup, dict):
+            reply_markup = json.dumps(reply_markup)
+        with self.lock:
+            self.mensajes.append((time.perf_counter(), chat_id, texto, reply_markup))
+
+    def imagen(self, file_id):
+        """file_id '<foto>_<ancho>': misma boleta para todos los tamaños de una foto"""
+        foto, _, ancho = file_id.rpartition('_')
+        if not ancho.isdigit():
+            foto, ancho = file_id, '960'
+        imagen = self._imagenes.get(file_id)
+        if imagen is None:
+            ancho = int(ancho)
+            imagen = self._imagenes[file_id] = boleta_jpeg(foto, ancho, ancho * 4 // 3)
+        return imagen
+
+    def confirmaciones(self):
+        """
+        chat_id -> horas de los mensajes del worker (confirmación o error),
+        una por boleta aunque el notificador haya agrupado varias en un mensaje
+        """
+        por_chat = {}
+        with self.lock:
+            for hora, chat_id, _, botones in self.mensajes:
+                boletas = botones.count('"confirm_') + botones.count('"retry_')
+                por_chat.setdefault(chat_id, []).extend([hora] * boletas)
+        return {chat_id: horas for chat_id, horas in por_chat.items() if horas}
@@ -0,0 +1,76 @@
+"""
+Benchmark de jobs/seg por modo de worker (fork, simple, pool)
+
+Uso:
+    python -m bench.worker_modos --jobs 200 --procesos 4 [--url http://localhost:8080/]
+
+Requiere Redis (REDIS_URL). Usa una cola propia para no tocar 'fotos'.
+Cada job hace el trabajo fijo que paga un job real antes del OCR: importar
+el módulo worker, obtener la sesión HTTP y (opcional) un GET a --url, que
+mide el efecto del keep-alive.
+"""
+import os
+import time
+import argparse
+import multiprocessing
+
+from redis import Redis
+from rq import Queue
+
+import start_worker
+
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+COLA_BENCH = 'bench_worker_modos'
+
+
+def job_bench(url=None):
+    """Job de prueba: usa los mismos recursos que procesar_foto_job"""
+    import worker  # noqa: F401
+    from http_client import get_session
+
+    session = get_session()
+    if url:
+        session.get(url, timeout=10).raise_for_status()
+    return os.getpid()
+
+
+def medir(modo, jobs, procesos, url, redis_conn):
+    cola = Queue(COLA_BENCH, connection=redis_conn)
+    cola.empty()
+    for _ in range(jobs):
+        cola.enqueue('bench.worker_modos.job_bench', url, result_ttl=60)
+
+    inicio = time.perf_counter()
+    start_worker.COLAS = [COLA_BENCH]
+    if modo == 'pool':
+        # WorkerPool instala sus propios handlers de señales: se aísla en un proceso
+        proceso = multiprocessing.Process(target=start_worker.iniciar, args=(modo, procesos, redis_conn, True))
+        proceso.start()
+        proceso.join()
+    else:
+        start_worker.iniciar(modo, procesos, redis_conn, burst=True)
+    duracion = time.perf_counter() - inicio
+
+    pendientes = len(cola)
+    return (jobs - pendientes) / duracion, duracion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--jobs', type=int, default=200)
+    parser.add_argument('--procesos', type=int, default=4)
+    parser.add_argument('--url', default=None, help='Endpoint HTTP a consultar en cada job')
+    parser.add_argument('--modos', nargs='+', choices=start_worker.MODOS, default=list(start_worker.MODOS))
+    args = parser.parse_args()
+
+    redis_conn = Redis.from_url(REDIS_URL)
+    redis_conn.ping()
+
+    print(f"{'modo':<8} {'jobs/s':>10} {'segundos':>10}")
+    for modo in args.modos:
+        jobs_seg, duracion = medir(modo, args.jobs, args.procesos, args.url, redis_conn)
+        print(f"{modo:<8} {jobs_seg:>10.1f} {duracion:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
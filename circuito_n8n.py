@@ -0,0 +1,222 @@
+"""
+Circuit breaker y concurrencia adaptativa (AIMD) para las llamadas a n8n
+
+El estado vive en Redis y lo comparten todos los workers:
+
+    n8n:circuito   hash estado (cerrado|abierto|semiabierto), abierto_hasta,
+                   enfriamiento, limite, recorte
+    n8n:en_vuelo   zset token -> vencimiento (llamadas en curso)
+    n8n:ventana    últimos N8N_VENTANA resultados (1 = ok, 0 = error)
+
+Concurrencia: cada llamada rápida y exitosa suma 1/limite (+1 por ronda
+completa); un error o una llamada más lenta que N8N_LATENCIA_OBJETIVO
+recorta el límite a la mitad, como mucho una vez por N8N_LATENCIA_OBJETIVO.
+
+Circuito: con N8N_UMBRAL_ERROR de errores en la ventana se abre por
+'enfriamiento' segundos. Después deja pasar una sola llamada de prueba
+(semiabierto): si sale bien se cierra, si no se vuelve a abrir con el
+doble de enfriamiento (hasta N8N_ENFRIAMIENTO_MAX).
+
+Sin Redis no se limita nada aquí (queda N8N_MAX_INFLIGHT por proceso).
+"""
+import os
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+N8N_LIMITE_MIN = int(os.getenv('N8N_LIMITE_MIN', '1'))
+N8N_LIMITE_MAX = int(os.getenv('N8N_LIMITE_MAX', '16'))
+N8N_LIMITE_INICIAL = float(os.getenv('N8N_LIMITE_INICIAL', '4'))
+N8N_LATENCIA_OBJETIVO = float(os.getenv('N8N_LATENCIA_OBJETIVO', '15'))
+N8N_VENTANA = int(os.getenv('N8N_VENTANA', '20'))
+N8N_MIN_MUESTRAS = int(os.getenv('N8N_MIN_MUESTRAS', '5'))
+N8N_UMBRAL_ERROR = float(os.getenv('N8N_UMBRAL_ERROR', '0.5'))
+N8N_ENFRIAMIENTO = float(os.getenv('N8N_ENFRIAMIENTO', '30'))
+N8N_ENFRIAMIENTO_MAX = float(os.getenv('N8N_ENFRIAMIENTO_MAX', '300'))
+# Cuánto espera un job por un cupo antes de diferirse
+N8N_ESPERA_CUPO = float(os.getenv('N8N_ESPERA_CUPO', '10'))
+DIFERIR_SIN_CUPO = 5
+INTERVALO_SONDEO = 0.2
+# Timeout de la llamada a n8n más margen: un token huérfano vence solo
+TOKEN_TTL = 90
+
+CLAVE_CIRCUITO = 'n8n:circuito'
+CLAVE_EN_VUELO = 'n8n:en_vuelo'
+CLAVE_VENTANA = 'n8n:ventana'
+
+_LUA_ADQUIRIR = """
+local ahora, token, ttl, inicial = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3]), tonumber(ARGV[4])
+local estado = redis.call('HGET', KEYS[1], 'estado') or 'cerrado'
+
+if estado == 'abierto' then
+    local hasta = tonumber(redis.call('HGET', KEYS[1], 'abierto_hasta'))
+    if ahora < hasta then
+        return {'abierto', tostring(hasta - ahora)}
+    end
+    estado = 'semiabierto'
+    redis.call('HSET', KEYS[1], 'estado', estado)
+end
+
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ahora)
+local limite = tonumber(redis.call('HGET', KEYS[1], 'limite')) or inicial
+if estado == 'semiabierto' then
+    limite = 1
+end
+if redis.call('ZCARD', KEYS[2]) >= math.floor(limite) then
+    return {'lleno', '0'}
+end
+redis.call('ZADD', KEYS[2], ahora + ttl, token)
+return {'ok', tostring(limite)}
+"""
+
+_LUA_REGISTRAR = """
+local ahora, token, exito, latencia = tonumber(ARGV[1]), ARGV[2], ARGV[3] == '1', tonumber(ARGV[4])
+local objetivo, lmin, lmax, inicial = tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7]), tonumber(ARGV[8])
+local ventana, min_muestras, umbral = tonumber(ARGV[9]), tonumber(ARGV[10]), tonumber(ARGV[11])
+local enfr_base, enfr_max = tonumber(ARGV[12]), tonumber(ARGV[13])
+
+redis.call('ZREM', KEYS[2], token)
+local estado = redis.call('HGET', KEYS[1], 'estado') or 'cerrado'
+local limite = tonumber(redis.call('HGET', KEYS[1], 'limite')) or inicial
+local enfriamiento = tonumber(redis.call('HGET', KEYS[1], 'enfriamiento')) or enfr_base
+
+local function abrir(segundos)
+    redis.call('HSET', KEYS[1], 'estado', 'abierto', 'abierto_hasta', ahora + segundos, 'enfriamiento', segundos)
+    redis.call('DEL', KEYS[3])
+    return 'abierto'
+end
+
+-- AIMD
+if exito and latencia <= objetivo then
+    limite = math.min(lmax, limite + 1 / limite)
+else
+    local recorte = tonumber(redis.call('HGET', KEYS[1], 'recorte')) or 0
+    if ahora - recorte >= objetivo then
+        limite = math.max(lmin, limite / 2)
+        redis.call('HSET', KEYS[1], 'recorte', ahora)
+    end
+end
+redis.call('HSET', KEYS[1], 'limite', limite)
+
+if estado == 'semiabierto' then
+    if exito then
+        redis.call('HSET', KEYS[1], 'estado', 'cerrado', 'enfriamiento', enfr_base)
+        redis.call('DEL', KEYS[3])
+        return {'cerrado', tostring(limite)}
+    end
+    return {abrir(math.min(enfriamiento * 2, enfr_max)), tostring(limite)}
+end
+
+-- Resultados tardíos de llamadas hechas antes de abrir no cuentan
+if estado ~= 'cerrado' then
+    return {estado, tostring(limite)}
+end
+
+redis.call('LPUSH', KEYS[3], exito and '1' or '0')
+redis.call('LTRIM', KEYS[3], 0, ventana - 1)
+local resultados = redis.call('LRANGE', KEYS[3], 0, -1)
+local errores = 0
+for _, r in ipairs(resultados) do
+    if r == '0' then errores = errores + 1 end
+end
+if #resultados >= min_muestras and errores / #resultados >= umbral then
+    return {abrir(enfr_base), tostring(limite)}
+end
+return {estado, tostring(limite)}
+"""
+
+
+class N8nNoDisponible(Exception):
+    """El circuito está abierto o no hubo cupo: el job debe diferirse 'espera' segundos"""
+
+    def __init__(self, espera, motivo):
+        super().__init__(f"n8n no disponible ({motivo}), reintentar en {espera:.0f}s")
+        self.espera = espera
+        self.motivo = motivo
+
+
+_scripts = None
+
+
+def _redis():
+    """Conexión y scripts registrados, o None si no hay Redis"""
+    global _scripts
+    from queue_manager import redis_conn
+    if redis_conn is None:
+        return None
+    if _scripts is None:
+        _scripts = (redis_conn.register_script(_LUA_ADQUIRIR), redis_conn.register_script(_LUA_REGISTRAR))
+    return _scripts
+
+
+def adquirir(espera_max=N8N_ESPERA_CUPO):
+    """
+    Reserva un cupo para llamar a n8n. Espera hasta espera_max segundos
+    si el límite está lleno.
+
+    Returns:
+        token para registrar(); None si no hay Redis
+    Raises:
+        N8nNoDisponible si el circuito está abierto o no se liberó un cupo a tiempo
+    """
+    scripts = _redis()
+    if scripts is None:
+        return None
+
+    token = uuid.uuid4().hex
+    limite_espera = time.monotonic() + espera_max
+    while True:
+        resultado, valor = scripts[0](
+            keys=[CLAVE_CIRCUITO, CLAVE_EN_VUELO],
+            args=[time.time(), token, TOKEN_TTL, N8N_LIMITE_INICIAL]
+        )
+        resultado = resultado.decode()
+        if resultado == 'ok':
+            return token
+        if resultado == 'abierto':
+            raise N8nNoDisponible(float(valor), 'circuito abierto')
+        if time.monotonic() >= limite_espera:
+            raise N8nNoDisponible(DIFERIR_SIN_CUPO, 'sin cupo')
+        time.sleep(INTERVALO_SONDEO)
+
+
+def registrar(token, exito, latencia):
+    """Libera el cupo y actualiza límite y circuito con el resultado de la llamada"""
+    scripts = _redis()
+    if scripts is None or token is None:
+        return
+
+    try:
+        estado, limite = scripts[1](
+            keys=[CLAVE_CIRCUITO, CLAVE_EN_VUELO, CLAVE_VENTANA],
+            args=[
+                time.time(), token, '1' if exito else '0', latencia,
+                N8N_LATENCIA_OBJETIVO, N8N_LIMITE_MIN, N8N_LIMITE_MAX, N8N_LIMITE_INICIAL,
+                N8N_VENTANA, N8N_MIN_MUESTRAS, N8N_UMBRAL_ERROR,
+                N8N_ENFRIAMIENTO, N8N_ENFRIAMIENTO_MAX,
+            ]
+        )
+    except Exception as e:
+        logger.error(f"❌ Error registrando resultado de n8n: {e}")
+        return
+
+    if estado.decode() == 'abierto' and not exito:
+        logger.warning(f"🔌 Circuito de n8n abierto (latencia {latencia:.1f}s, éxito={exito})")
+    logger.debug(f"🎚️ Límite de concurrencia n8n: {float(limite):.2f}")
+
+
+def get_estado():
+    """Estado del circuito para monitoreo"""
+    from queue_manager import redis_conn
+    if redis_conn is None:
+        return {'error': 'Redis no disponible'}
+
+    datos = {k.decode(): v.decode() for k, v in redis_conn.hgetall(CLAVE_CIRCUITO).items()}
+    return {
+        'estado': datos.get('estado', 'cerrado'),
+        'limite': float(datos.get('limite', N8N_LIMITE_INICIAL)),
+        'en_vuelo': redis_conn.zcount(CLAVE_EN_VUELO, time.time(), '+inf'),
+        'abierto_hasta': float(datos['abierto_hasta']) if 'abierto_hasta' in datos else None,
+    }
@@ -0,0 +1,190 @@
+"""
+Pool de conexiones a PostgreSQL compartido por el bot y el worker
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+import functools
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from psycopg2 import extensions
+from psycopg2.pool import ThreadedConnectionPool
+
+logger = logging.getLogger(__name__)
+
+DATABASE_URL = os.getenv('DATABASE_PUBLIC_URL')
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '10'))
+# Conexiones inactivas más de N segundos se validan con SELECT 1 antes de usarse
+DB_HEALTHCHECK_IDLE = float(os.getenv('DB_HEALTHCHECK_IDLE', '30'))
+# 'disable' para un Postgres local sin TLS (bench)
+DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+
+_pool = None
+_pid = None
+_cupos = None  # Semáforo: espera en vez de PoolError cuando el pool está lleno
+_executor = None
+_ultimo_uso = {}
+_lock = threading.Lock()
+
+
+def init_pool(minconn=None, maxconn=None):
+    """Crea el pool (idempotente). Se llama una vez al iniciar el proceso."""
+    global _pool, _pid, _cupos, _executor
+    with _lock:
+        if _pool is not None and _pid == os.getpid():
+            return _pool
+
+        if _pool is not None:
+            # Proceso hijo (fork): los sockets del padre no se cierran ni se reutilizan
+            logger.info("🔀 Fork detectado, creando pool propio")
+            _ultimo_uso.clear()
+
+        minconn = DB_POOL_MIN if minconn is None else minconn
+        maxconn = DB_POOL_MAX if maxconn is None else maxconn
+
+        _pool = ThreadedConnectionPool(minconn, maxconn, DATABASE_URL, sslmode=DB_SSLMODE)
+        _pid = os.getpid()
+        _cupos = threading.BoundedSemaphore(maxconn)
+        # Un hilo por conexión: el loop async nunca espera por una conexión
+        _executor = ThreadPoolExecutor(max_workers=maxconn, thread_name_prefix='db')
+        logger.info(f"✅ Pool PostgreSQL listo (min={minconn}, max={maxconn})")
+        return _pool
+
+
+def close_pool():
+    """Cierra el executor y todas las conexiones del pool"""
+    global _pool, _cupos, _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(wait=True)
+        if _pool is not None:
+            _pool.closeall()
+            logger.info("🔌 Pool PostgreSQL cerrado")
+        _pool = None
+        _cupos = None
+        _executor = None
+        _ultimo_uso.clear()
+
+
+async def cerrar_pool():
+    """
+    Versión async de close_pool para el post_shutdown del bot: espera las
+    consultas en curso desde otro hilo sin bloquear el loop
+    """
+    await asyncio.to_thread(close_pool)
+
+
+def _conexion_sana(conn):
+    """Verifica una conexión antes de entregarla"""
+    if conn.closed:
+        return False
+
+    ultimo_uso = _ultimo_uso.get(id(conn))
+    if ultimo_uso is None or time.monotonic() - ultimo_uso < DB_HEALTHCHECK_IDLE:
+        return True
+
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        logger.warning(f"⚠️ Conexión descartada por health check: {e}")
+        return False
+
+
+def _obtener():
+    pool = init_pool()
+    # Reintenta si la conexión entregada estaba rota (p.ej. tras reinicio de Postgres)
+    for _ in range(DB_POOL_MAX + 1):
+        conn = pool.getconn()
+        if _conexion_sana(conn):
+            return conn
+        _ultimo_uso.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    raise psycopg2.OperationalError("No hay conexiones sanas disponibles")
+
+
+def _devolver(conn, roto=False):
+    pool = _pool
+    if pool is None:
+        conn.close()
+        return
+
+    if not roto and not conn.closed:
+        # Nunca devolver una transacción abierta al pool
+        if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                roto = True
+
+    if roto or conn.closed:
+        _ultimo_uso.pop(id(conn), None)
+        pool.putconn(conn, close=True)
+    else:
+        _ultimo_uso[id(conn)] = time.monotonic()
+        pool.putconn(conn)
+
+
+@contextmanager
+def conexion():
+    """
+    Presta una conexión del pool.
+
+    El llamador hace commit explícito; cualquier transacción pendiente se
+    descarta al devolverla. Conexiones con errores de red se cierran.
+    """
+    init_pool()
+    _cupos.acquire()
+    try:
+        conn = _obtener()
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            _devolver(conn, roto=True)
+            raise
+        except Exception:
+            _devolver(conn)
+            raise
+        else:
+            _devolver(conn)
+    finally:
+        _cupos.release()
+
+
+def ejecutar_sql_sync(query, params=None, fetch=None):
+    """
+    Ejecuta una sentencia y hace commit.
+
+    Args:
+        fetch: None, 'one' o 'all'
+    """
+    with conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            if fetch == 'one':
+                resultado = cur.fetchone()
+            elif fetch == 'all':
+                resultado = cur.fetchall()
+            else:
+                resultado = None
+        conn.commit()
+        return resultado
+
+
+async def ejecutar(fn, *args, **kwargs):
+    """Ejecuta una función bloqueante de BD en el executor acotado del pool"""
+    init_pool()
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(fn, *args, **kwargs))
+
+
+async def ejecutar_sql(query, params=None, fetch=None):
+    """Versión async de ejecutar_sql_sync para los handlers del bot"""
+    return await ejecutar(ejecutar_sql_sync, query, params, fetch)
@@ -0,0 +1,145 @@
+"""
+Detección de boletas casi duplicadas con hash perceptual (dHash de 64 bits)
+
+Cada usuario tiene un índice multi-hash en Redis: el hash se parte en
+PHASH_BANDAS bandas y cada banda indexa los gastos que la comparten. Por
+el principio del palomar, dos hashes a distancia de Hamming < PHASH_BANDAS
+coinciden en al menos una banda, así que la búsqueda solo compara contra
+los candidatos de esas bandas y no contra todo el historial.
+"""
+import io
+import os
+import time
+import logging
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+PHASH_DISTANCIA = int(os.getenv('PHASH_DISTANCIA', '6'))
+PHASH_RECIENTES = int(os.getenv('PHASH_RECIENTES', '200'))
+PHASH_TTL = int(os.getenv('PHASH_TTL', str(90 * 24 * 3600)))
+# Bandas de 8 bits: el script Lua las extrae del hash guardado en hexadecimal
+PHASH_BANDAS = 8
+BITS_BANDA = 8
+
+# Registra un hash y descarta del índice los gastos más antiguos sobre el límite
+_LUA_REGISTRAR = """
+local hashes, recientes, prefijo = KEYS[1], KEYS[2], ARGV[1]
+local gasto_id, phash, ahora = ARGV[2], ARGV[3], ARGV[4]
+local limite, ttl, nbandas = tonumber(ARGV[5]), tonumber(ARGV[6]), tonumber(ARGV[7])
+
+redis.call('HSET', hashes, gasto_id, phash)
+redis.call('ZADD', recientes, ahora, gasto_id)
+for b = 1, nbandas do
+    local key = prefijo .. (b - 1) .. ':' .. ARGV[7 + b]
+    redis.call('SADD', key, gasto_id)
+    redis.call('EXPIRE', key, ttl)
+end
+
+local sobrantes = redis.call('ZCARD', recientes) - limite
+if sobrantes > 0 then
+    local viejos = redis.call('ZPOPMIN', recientes, sobrantes)
+    for i = 1, #viejos, 2 do
+        local id = viejos[i]
+        local valor = redis.call('HGET', hashes, id)
+        if valor then
+            -- valor es hex de 16 caracteres; la banda b son los bits (b-1)*8 .. (b-1)*8+7
+            for b = 1, nbandas do
+                local inicio = 15 - 2 * (b - 1)
+                local banda = tonumber(string.sub(valor, inicio, inicio + 1), 16)
+                redis.call('SREM', prefijo .. (b - 1) .. ':' .. banda, id)
+            end
+            redis.call('HDEL', hashes, id)
+        end
+    end
+end
+redis.call('EXPIRE', hashes, ttl)
+redis.call('EXPIRE', recientes, ttl)
+return sobrantes
+"""
+
+_script_registrar = None
+
+
+def _redis():
+    from queue_manager import redis_conn
+    return redis_conn
+
+
+def calcular_phash(image_bytes):
+    """dHash: compara la luminancia de píxeles vecinos en una miniatura 9x8"""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        pequena = img.convert('L').resize((9, 8), Image.LANCZOS)
+        pixeles = list(pequena.getdata())
+
+    valor = 0
+    for fila in range(8):
+        for col in range(8):
+            izquierda = pixeles[fila * 9 + col]
+            derecha = pixeles[fila * 9 + col + 1]
+            valor = (valor << 1) | (1 if izquierda > derecha else 0)
+    return valor
+
+
+def distancia(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _bandas(phash):
+    mascara = (1 << BITS_BANDA) - 1
+    return [(phash >> (i * BITS_BANDA)) & mascara for i in range(PHASH_BANDAS)]
+
+
+def _prefijo(user_id):
+    return f'phash:{user_id}:banda:'
+
+
+def registrar(user_id, gasto_id, phash):
+    """Agrega el hash de un gasto al índice del usuario"""
+    global _script_registrar
+    redis_conn = _redis()
+    if redis_conn is None:
+        return
+
+    if _script_registrar is None:
+        _script_registrar = redis_conn.register_script(_LUA_REGISTRAR)
+
+    _script_registrar(
+        keys=[f'phash:{user_id}:hashes', f'phash:{user_id}:recientes'],
+        args=[_prefijo(user_id), gasto_id, f'{phash:016x}', time.time(), PHASH_RECIENTES, PHASH_TTL, PHASH_BANDAS]
+        + _bandas(phash)
+    )
+
+
+def buscar(user_id, phash, max_distancia=PHASH_DISTANCIA):
+    """
+    Busca gastos recientes del usuario con imagen parecida
+
+    Returns:
+        Lista de (gasto_id, distancia) ordenada de más a menos parecido
+    """
+    redis_conn = _redis()
+    if redis_conn is None:
+        return []
+
+    pipe = redis_conn.pipeline()
+    for i, banda in enumerate(_bandas(phash)):
+        pipe.smembers(f'{_prefijo(user_id)}{i}:{banda}')
+    candidatos = set().union(*pipe.execute())
+    if not candidatos:
+        return []
+
+    candidatos = sorted(candidatos)
+    valores = redis_conn.hmget(f'phash:{user_id}:hashes', candidatos)
+
+    resultado = []
+    for gasto_id, valor in zip(candidatos, valores):
+        if valor is None:
+            continue
+        d = distancia(phash, int(valor, 16))
+        if d <= max_distancia:
+            resultado.append((int(gasto_id), d))
+
+    resultado.sort(key=lambda x: (x[1], -x[0]))
+    return resultado
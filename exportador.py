@@ -0,0 +1,124 @@
+"""
+Exportación de gastos a CSV o XLSX para /exportar
+
+Las filas se leen con un cursor con nombre (server-side): Postgres entrega
+EXPORT_LOTE filas por vez y se van escribiendo al archivo temporal, así la
+memoria del bot no depende de cuántos años de gastos tenga el usuario.
+
+XLSX usa openpyxl (requirements.txt); si faltara, se exporta en CSV.
+"""
+import os
+import csv
+import json
+import logging
+import tempfile
+
+import db
+
+logger = logging.getLogger(__name__)
+
+EXPORT_LOTE = int(os.getenv('EXPORT_LOTE', '2000'))
+
+COLUMNAS = ['id', 'fecha', 'monto', 'tipo_gasto', 'categoria', 'banco',
+            'descripcion', 'metodo_pago', 'status', 'creado']
+# Pesadas: solo con "completo"
+COLUMNAS_PESADAS = ['image_path', 'ocr_data']
+
+FORMATOS = ('csv', 'xlsx')
+
+try:
+    from openpyxl import Workbook
+except ImportError:
+    Workbook = None
+
+
+def _filas(conn, user_id, desde, hasta, columnas):
+    """Genera las filas del usuario en lotes de EXPORT_LOTE"""
+    condiciones = ['telegram_user_id = %s']
+    params = [user_id]
+    if desde:
+        condiciones.append('fecha >= %s')
+        params.append(desde)
+    if hasta:
+        condiciones.append('fecha <= %s')
+        params.append(hasta)
+
+    # El nombre identifica el cursor dentro de la transacción de esta conexión
+    with conn.cursor(name=f'exportar_{user_id}') as cur:
+        cur.itersize = EXPORT_LOTE
+        cur.execute(
+            f"SELECT {', '.join(columnas)} FROM finanzas "
+            f"WHERE {' AND '.join(condiciones)} ORDER BY fecha, id",
+            params
+        )
+        while True:
+            lote = cur.fetchmany(EXPORT_LOTE)
+            if not lote:
+                break
+            yield from lote
+
+
+def _valor(v):
+    if isinstance(v, (dict, list)):
+        return json.dumps(v, ensure_ascii=False)
+    return v
+
+
+def _escribir_csv(archivo, columnas, filas):
+    with open(archivo, 'w', newline='', encoding='utf-8-sig') as f:
+        escritor = csv.writer(f)
+        escritor.writerow(columnas)
+        total = 0
+        for fila in filas:
+            escritor.writerow([_valor(v) for v in fila])
+            total += 1
+    return total
+
+
+def _escribir_xlsx(archivo, columnas, filas):
+    # write_only: openpyxl escribe cada fila al disco en vez de armar la hoja en memoria
+    libro = Workbook(write_only=True)
+    hoja = libro.create_sheet('finanzas')
+    hoja.append(columnas)
+    total = 0
+    for fila in filas:
+        hoja.append([_valor(v) for v in fila])
+        total += 1
+    libro.save(archivo)
+    return total
+
+
+def exportar(user_id, desde=None, hasta=None, formato='csv', completo=False):
+    """
+    Escribe los gastos del usuario en un archivo temporal
+
+    Args:
+        desde, hasta: fechas ISO (YYYY-MM-DD) inclusivas, o None
+        completo: incluir image_path y ocr_data
+
+    Returns:
+        (ruta del archivo, formato usado, cantidad de filas). El llamador
+        borra el archivo después de enviarlo.
+    """
+    if formato == 'xlsx' and Workbook is None:
+        logger.warning("⚠️ openpyxl no instalado, exportando en CSV")
+        formato = 'csv'
+
+    columnas = COLUMNAS + (COLUMNAS_PESADAS if completo else [])
+    fd, archivo = tempfile.mkstemp(prefix='finanzas_', suffix=f'.{formato}')
+    os.close(fd)
+
+    try:
+        with db.conexion() as conn:
+            filas = _filas(conn, user_id, desde, hasta, columnas)
+            if formato == 'xlsx':
+                total = _escribir_xlsx(archivo, columnas, filas)
+            else:
+                total = _escribir_csv(archivo, columnas, filas)
+            conn.commit()
+    except Exception:
+        os.unlink(archivo)
+        raise
+
+    logger.info(f"📤 Exportadas {total} filas de {user_id} ({formato}, {os.path.getsize(archivo)} bytes)")
+    return archivo, formato, total
@@ -0,0 +1,31 @@
+"""
+Conversión de fechas y montos ingresados por el usuario o leídos de archivos
+"""
+import re
+from datetime import datetime
+
+
+def parse_fecha_ddmmyyyy(txt: str) -> str:
+    """Convierte DD-MM-YYYY a YYYY-MM-DD (ISO para Postgres)."""
+    return datetime.strptime(txt.strip(), "%d-%m-%Y").strftime("%Y-%m-%d")
+
+def parse_monto(txt: str) -> float:
+    """Normaliza monto en distintos formatos a float."""
+    s = txt.strip().replace("$", "").replace(" ", "")
+    if "," in s and s.count(",") == 1 and (("." in s and s.rfind(".") < s.rfind(",")) or "." not in s):
+        s = s.replace(".", "").replace(",", ".")
+    return float(s)
+
+def formatear_monto(monto) -> str:
+    """$12.500 (separador de miles chileno)"""
+    return f"${monto:,.0f}".replace(',', '.')
+
+# 12.500 / -1.250.000: puntos como separador de miles
+_MILES = re.compile(r'^-?\$?\s?\d{1,3}(\.\d{3})+$')
+
+def parse_monto_miles(txt: str) -> float:
+    """Como parse_monto, pero 12.500 son doce mil quinientos y no 12,5."""
+    txt = txt.strip()
+    if _MILES.match(txt):
+        txt = txt.replace(".", "")
+    return parse_monto(txt)
@@ -0,0 +1,118 @@
+"""
+Registro de un gasto en un solo mensaje
+
+    /g 12.500 comida almuerzo debito
+    ayer 8000 transporte uber
+    15-03 45.000 ingreso sueldo
+
+Cada palabra se clasifica como fecha (hoy, ayer, anteayer, DD-MM,
+DD-MM-YYYY), monto (el primer número), tipo de gasto, categoría o método
+de pago según los mismos botones del flujo manual (sin importar
+mayúsculas ni tildes). Lo que sobra es la descripción. Sin fecha se usa
+hoy y sin categoría, Gasto.
+"""
+import re
+import unicodedata
+from datetime import date, datetime, timedelta
+
+from formatos import parse_monto_miles
+
+_FECHA = re.compile(r'^(\d{1,2})[-/](\d{1,2})(?:[-/](\d{4}))?$')
+_MONTO = re.compile(r'^\$?\d[\d.,]*$')
+DIAS_RELATIVOS = {'hoy': 0, 'ayer': 1, 'anteayer': 2}
+
+# Formas cortas que la gente escribe en vez del texto del botón
+ALIAS_METODOS = {
+    'credito': 'Tarjeta Crédito',
+    'tc': 'Tarjeta Crédito',
+    'debito': 'Tarjeta Débito',
+    'td': 'Tarjeta Débito',
+}
+
+
+def normalizar(texto):
+    """minúsculas y sin tildes"""
+    sin_tildes = unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode()
+    return sin_tildes.lower().strip()
+
+
+class Gramatica:
+    """Vocabulario compilado una vez a partir de los teclados del bot"""
+
+    def __init__(self, tipos_gasto, categorias, metodos_pago):
+        # frase normalizada (una o dos palabras) -> (campo, valor del botón)
+        self.vocabulario = {}
+        for campo, teclado in (('tipo_gasto', tipos_gasto), ('categoria', categorias), ('metodo_pago', metodos_pago)):
+            for fila in teclado:
+                for opcion in fila:
+                    self.vocabulario[normalizar(opcion)] = (campo, opcion)
+        for alias, metodo in ALIAS_METODOS.items():
+            self.vocabulario.setdefault(alias, ('metodo_pago', metodo))
+
+    def _fecha(self, palabra, hoy):
+        if palabra in DIAS_RELATIVOS:
+            return hoy - timedelta(days=DIAS_RELATIVOS[palabra])
+        m = _FECHA.match(palabra)
+        if not m:
+            return None
+        dia, mes, anio = m.groups()
+        try:
+            fecha = date(int(anio) if anio else hoy.year, int(mes), int(dia))
+        except ValueError:
+            return None
+        # "31-12" escrito en enero es del año pasado
+        if not anio and fecha > hoy:
+            fecha = fecha.replace(year=hoy.year - 1)
+        return fecha
+
+    def parsear(self, texto, hoy=None):
+        """
+        Returns:
+            dict con los campos de insert_into_db, o None si no hay monto.
+            'reconocidos' lista los campos que vinieron en el texto.
+        """
+        hoy = hoy or datetime.now().date()
+        palabras = texto.split()
+        normalizadas = [normalizar(p) for p in palabras]
+        datos = {}
+        descripcion = []
+
+        i = 0
+        while i < len(palabras):
+            # Primero dos palabras ("tarjeta credito"), luego una
+            par = ' '.join(normalizadas[i:i + 2]) if i + 1 < len(palabras) else None
+            if par in self.vocabulario and self.vocabulario[par][0] not in datos:
+                campo, valor = self.vocabulario[par]
+                datos[campo] = valor
+                i += 2
+                continue
+
+            palabra = normalizadas[i]
+            if palabra in self.vocabulario and self.vocabulario[palabra][0] not in datos:
+                campo, valor = self.vocabulario[palabra]
+                datos[campo] = valor
+            elif 'fecha' not in datos and self._fecha(palabra, hoy):
+                datos['fecha'] = self._fecha(palabra, hoy)
+            elif 'monto' not in datos and _MONTO.match(palabra):
+                try:
+                    datos['monto'] = parse_monto_miles(palabra)
+                except ValueError:
+                    descripcion.append(palabras[i])
+            else:
+                descripcion.append(palabras[i])
+            i += 1
+
+        if 'monto' not in datos:
+            return None
+
+        reconocidos = sorted(datos)
+        return {
+            'fecha': datos.get('fecha', hoy).isoformat(),
+            'monto': datos['monto'],
+            'tipo_gasto': datos.get('tipo_gasto'),
+            'categoria': datos.get('categoria', 'Gasto'),
+            'banco': None,
+            'descripcion': ' '.join(descripcion) or None,
+            'metodo_pago': datos.get('metodo_pago'),
+            'reconocidos': reconocidos,
+        }
@@ -0,0 +1,51 @@
+"""
+Sesión HTTP persistente (keep-alive) compartida por el proceso
+"""
+import os
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+
+_session = None
+_pid = None
+_lock = threading.Lock()
+
+
+def _crear_session():
+    session = requests.Session()
+    # Solo reintenta fallos de conexión: los POST no se repiten si el servidor ya respondió
+    retry = Retry(total=2, connect=2, read=0, status=0, backoff_factor=0.5, allowed_methods=None)
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def get_session():
+    """Retorna la sesión del proceso, creándola si no existe (o tras un fork)"""
+    global _session, _pid
+    if _session is not None and _pid == os.getpid():
+        return _session
+
+    with _lock:
+        if _session is None or _pid != os.getpid():
+            _session = _crear_session()
+            _pid = os.getpid()
+            logger.info("🌐 Sesión HTTP creada")
+        return _session
+
+
+def reset_session():
+    """Descarta la sesión actual; la próxima llamada crea conexiones nuevas"""
+    global _session
+    with _lock:
+        if _session is not None:
+            _session.close()
+        _session = None
@@ -0,0 +1,130 @@
+"""
+Almacén de imágenes de boletas direccionado por contenido (SHA-256)
+
+finanzas.image_path guarda solo la clave ('sha256:<hex>'); los bytes viven
+en la tabla imagenes (IMAGE_STORE=postgres, por defecto) o en un
+directorio local (IMAGE_STORE=directorio). Subir la misma foto dos veces
+no duplica datos.
+"""
+import os
+import hashlib
+import logging
+import tempfile
+from abc import ABC, abstractmethod
+
+import psycopg2
+
+import db
+
+logger = logging.getLogger(__name__)
+
+IMAGE_STORE = os.getenv('IMAGE_STORE', 'postgres')
+IMAGE_STORE_DIR = os.getenv('IMAGE_STORE_DIR', 'imagenes')
+PREFIJO_CLAVE = 'sha256:'
+
+SQL_CREAR_TABLA = """
+    CREATE TABLE IF NOT EXISTS imagenes (
+        sha256 CHAR(64) PRIMARY KEY,
+        datos BYTEA NOT NULL,
+        bytes INTEGER NOT NULL,
+        creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+"""
+
+
+def calcular_clave(image_bytes):
+    """Clave del almacén para unos bytes"""
+    return PREFIJO_CLAVE + hashlib.sha256(image_bytes).hexdigest()
+
+
+def es_clave(ref):
+    return isinstance(ref, str) and ref.startswith(PREFIJO_CLAVE)
+
+
+class ImageStore(ABC):
+    """Interfaz común de los almacenes: uno incompleto falla al instanciarse"""
+
+    @abstractmethod
+    def guardar(self, image_bytes):
+        """Guarda los bytes (idempotente) y retorna su clave"""
+
+    @abstractmethod
+    def obtener(self, clave):
+        """Retorna los bytes de la clave o None si no existe"""
+
+
+class PostgresImageStore(ImageStore):
+    """Tabla lateral imagenes(sha256, datos BYTEA)"""
+
+    def guardar(self, image_bytes, conn=None):
+        clave = calcular_clave(image_bytes)
+        query = """
+            INSERT INTO imagenes (sha256, datos, bytes)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (sha256) DO NOTHING
+        """
+        params = (clave[len(PREFIJO_CLAVE):], psycopg2.Binary(image_bytes), len(image_bytes))
+
+        if conn is not None:
+            # Dentro de la transacción del llamador (migración)
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+        else:
+            db.ejecutar_sql_sync(query, params)
+        return clave
+
+    def obtener(self, clave):
+        row = db.ejecutar_sql_sync(
+            "SELECT datos FROM imagenes WHERE sha256 = %s",
+            (clave[len(PREFIJO_CLAVE):],), fetch='one'
+        )
+        return bytes(row[0]) if row else None
+
+
+class DirectorioImageStore(ImageStore):
+    """Archivos <dir>/<2 primeros hex>/<hex>; solo sirve si bot y worker comparten disco"""
+
+    def __init__(self, directorio=IMAGE_STORE_DIR):
+        self.directorio = directorio
+
+    def _ruta(self, clave):
+        hexdigest = clave[len(PREFIJO_CLAVE):]
+        return os.path.join(self.directorio, hexdigest[:2], hexdigest)
+
+    def guardar(self, image_bytes, conn=None):
+        clave = calcular_clave(image_bytes)
+        ruta = self._ruta(clave)
+        if os.path.exists(ruta):
+            return clave
+
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        # Escritura atómica: nunca queda un archivo a medias con la clave final
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(ruta))
+        with os.fdopen(fd, 'wb') as f:
+            f.write(image_bytes)
+        os.replace(tmp, ruta)
+        return clave
+
+    def obtener(self, clave):
+        try:
+            with open(self._ruta(clave), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+_store = None
+
+
+def get_store():
+    """Almacén configurado para el proceso"""
+    global _store
+    if _store is None:
+        if IMAGE_STORE == 'directorio':
+            _store = DirectorioImageStore()
+        elif IMAGE_STORE == 'postgres':
+            _store = PostgresImageStore()
+        else:
+            raise ValueError(f"IMAGE_STORE desconocido: {IMAGE_STORE}")
+        logger.info(f"🗄️ Almacén de imágenes: {IMAGE_STORE}")
+    return _store
@@ -0,0 +1,247 @@
+"""
+Importación masiva de cartolas bancarias (CSV u OFX)
+
+El archivo se lee línea a línea y las filas van directo a un COPY FROM STDIN
+sobre una tabla temporal; un solo INSERT ... SELECT las pasa a finanzas
+descartando las que ya existen para el usuario con la misma fecha, monto y
+descripción. Así una cartola de miles de movimientos es un COPY y un INSERT,
+no miles de INSERT, y se puede volver a subir sin duplicar.
+
+CSV: la primera fila con una columna de fecha se toma como encabezado.
+Se reconocen fecha, descripción y monto, o cargo/abono por separado.
+Separador ',' o ';'. Montos negativos o cargos quedan como Gasto, el resto
+como Ingreso; el monto se guarda siempre en positivo.
+"""
+import io
+import re
+import csv
+import codecs
+import logging
+from datetime import datetime
+
+import db
+from formatos import parse_fecha_ddmmyyyy, parse_monto_miles
+
+logger = logging.getLogger(__name__)
+
+# Telegram no deja a los bots descargar archivos de más de 20 MB
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+ENCABEZADOS = {
+    'fecha': ('fecha', 'fecha operacion', 'fecha operación', 'fecha transaccion', 'fecha transacción', 'date'),
+    'descripcion': ('descripcion', 'descripción', 'detalle', 'glosa', 'concepto', 'movimiento', 'description'),
+    'monto': ('monto', 'importe', 'valor', 'amount'),
+    'cargo': ('cargo', 'cargos', 'debito', 'débito', 'giros', 'debe'),
+    'abono': ('abono', 'abonos', 'credito', 'crédito', 'depositos', 'depósitos', 'haber'),
+}
+
+_TAG_OFX = re.compile(r'<(/?[A-Za-z0-9.]+)>([^<\r\n]*)')
+
+SQL_STAGING = """
+    CREATE TEMP TABLE finanzas_import (
+        fecha DATE,
+        monto REAL,
+        categoria TEXT,
+        descripcion TEXT
+    ) ON COMMIT DROP
+"""
+
+SQL_INSERTAR = """
+    INSERT INTO finanzas
+        (fecha, monto, categoria, descripcion, banco, status, telegram_user_id, telegram_chat_id)
+    SELECT s.fecha, s.monto, s.categoria, s.descripcion, %(banco)s, 'manual', %(user_id)s, %(chat_id)s
+    FROM finanzas_import s
+    WHERE NOT EXISTS (
+        SELECT 1 FROM finanzas f
+        WHERE f.telegram_user_id = %(user_id)s
+          AND f.fecha = s.fecha
+          AND f.monto = s.monto
+          AND f.descripcion IS NOT DISTINCT FROM s.descripcion
+    )
+"""
+
+
+class Estadisticas:
+    def __init__(self):
+        self.leidas = 0
+        self.invalidas = 0
+        self.insertadas = 0
+
+    @property
+    def duplicadas(self):
+        return self.leidas - self.invalidas - self.insertadas
+
+
+def _monto(txt):
+    txt = (txt or '').strip()
+    if not txt:
+        return None
+    return parse_monto_miles(txt)
+
+
+def _fecha(txt):
+    txt = txt.strip().replace('/', '-').replace('.', '-')
+    try:
+        return parse_fecha_ddmmyyyy(txt)
+    except ValueError:
+        # YYYY-MM-DD o el formato compacto de OFX (20240131120000[-3:CLT])
+        txt = txt.replace('-', '')[:8]
+        return datetime.strptime(txt, '%Y%m%d').strftime('%Y-%m-%d')
+
+
+def _movimiento(fecha, monto, descripcion):
+    """(fecha, monto positivo, categoría, descripción)"""
+    categoria = 'Gasto' if monto < 0 else 'Ingreso'
+    return fecha, abs(monto), categoria, (descripcion or '').strip() or None
+
+
+def _columnas(encabezado):
+    normalizado = [c.strip().lower() for c in encabezado]
+    columnas = {}
+    for campo, nombres in ENCABEZADOS.items():
+        for i, nombre in enumerate(normalizado):
+            if nombre in nombres:
+                columnas[campo] = i
+                break
+    return columnas
+
+
+def _leer_csv(lineas, stats):
+    primera = next(lineas, '')
+    separador = ';' if primera.count(';') > primera.count(',') else ','
+    lector = csv.reader(_con_primera(primera, lineas), delimiter=separador)
+
+    columnas = None
+    for fila in lector:
+        if columnas is None:
+            # Las cartolas suelen traer líneas de título antes del encabezado
+            candidatas = _columnas(fila)
+            if 'fecha' in candidatas and ('monto' in candidatas or 'cargo' in candidatas or 'abono' in candidatas):
+                columnas = candidatas
+            continue
+        if not any(c.strip() for c in fila):
+            continue
+
+        stats.leidas += 1
+        try:
+            fecha = _fecha(fila[columnas['fecha']])
+            if 'monto' in columnas:
+                monto = _monto(fila[columnas['monto']])
+            else:
+                cargo = _monto(fila[columnas['cargo']]) if 'cargo' in columnas else None
+                abono = _monto(fila[columnas['abono']]) if 'abono' in columnas else None
+                monto = -abs(cargo) if cargo else abono
+            if monto is None:
+                raise ValueError('sin monto')
+            descripcion = fila[columnas['descripcion']] if 'descripcion' in columnas else None
+        except (ValueError, IndexError):
+            stats.invalidas += 1
+            continue
+
+        yield _movimiento(fecha, monto, descripcion)
+
+    if columnas is None:
+        raise ValueError('No se encontró el encabezado (fecha, descripción, monto)')
+
+
+def _con_primera(primera, lineas):
+    yield primera
+    yield from lineas
+
+
+def _leer_ofx(lineas, stats):
+    """OFX 1.x (SGML) o 2.x (XML): solo se usan los bloques STMTTRN"""
+    movimiento = None
+    for linea in lineas:
+        # En OFX 1.x los tags pueden venir todos en una línea o uno por línea
+        for tag, valor in _TAG_OFX.findall(linea):
+            tag, valor = tag.upper(), valor.strip()
+            if tag == 'STMTTRN':
+                movimiento = {}
+            elif movimiento is None:
+                continue
+            elif tag == '/STMTTRN':
+                stats.leidas += 1
+                try:
+                    fecha = _fecha(movimiento['DTPOSTED'])
+                    monto = float(movimiento['TRNAMT'].replace(',', '.'))
+                except (KeyError, ValueError):
+                    stats.invalidas += 1
+                else:
+                    yield _movimiento(fecha, monto, movimiento.get('MEMO') or movimiento.get('NAME'))
+                movimiento = None
+            elif tag in ('DTPOSTED', 'TRNAMT', 'NAME', 'MEMO') and valor:
+                movimiento[tag] = valor
+
+
+class _FlujoCopy(io.TextIOBase):
+    """Adapta un generador de filas al objeto archivo que pide copy_expert"""
+
+    def __init__(self, filas):
+        self._filas = filas
+        self._buffer = ''
+        self._salida = io.StringIO()
+        self._escritor = csv.writer(self._salida)
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            fila = next(self._filas, None)
+            if fila is None:
+                break
+            self._escritor.writerow(fila)
+            self._buffer += self._salida.getvalue()
+            self._salida.seek(0)
+            self._salida.truncate()
+        if size < 0:
+            size = len(self._buffer)
+        trozo, self._buffer = self._buffer[:size], self._buffer[size:]
+        return trozo
+
+
+def _abrir(archivo):
+    """Abre el archivo como texto: UTF-8 si decodifica, si no Latin-1 (Excel en Windows)"""
+    with open(archivo, 'rb') as f:
+        muestra = f.read(64 * 1024)
+    try:
+        codecs.getincrementaldecoder('utf-8')().decode(muestra, final=False)
+        encoding = 'utf-8-sig'
+    except UnicodeDecodeError:
+        encoding = 'latin-1'
+    return open(archivo, encoding=encoding, newline='')
+
+
+def importar(archivo, formato, user_id, chat_id=None, banco=None):
+    """
+    Importa una cartola a finanzas
+
+    Args:
+        archivo: ruta del archivo descargado
+        formato: 'csv' u 'ofx'
+
+    Returns:
+        Estadisticas (leidas, invalidas, insertadas, duplicadas)
+    """
+    stats = Estadisticas()
+    with _abrir(archivo) as f:
+        lineas = iter(f)
+        filas = _leer_ofx(lineas, stats) if formato == 'ofx' else _leer_csv(lineas, stats)
+
+        with db.conexion() as conn:
+            with conn.cursor() as cur:
+                cur.execute(SQL_STAGING)
+                cur.copy_expert(
+                    "COPY finanzas_import (fecha, monto, categoria, descripcion) FROM STDIN WITH (FORMAT csv)",
+                    _FlujoCopy(filas)
+                )
+                cur.execute(SQL_INSERTAR, {'user_id': user_id, 'chat_id': chat_id, 'banco': banco})
+                stats.insertadas = cur.rowcount
+            conn.commit()
+
+    logger.info(
+        f"📥 Importación de {user_id}: {stats.leidas} leídas, {stats.insertadas} nuevas, "
+        f"{stats.duplicadas} duplicadas, {stats.invalidas} inválidas"
+    )
+    return stats
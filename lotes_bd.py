@@ -0,0 +1,191 @@
+"""
+Escritura por lotes de los resultados del OCR en finanzas
+
+Cada resultado es una fila (FilaOcr) más, opcionalmente, su mensaje para
+la bandeja de salida. aplicar() escribe un lote en una transacción: un
+solo UPDATE ... FROM (VALUES ...) con execute_values y un solo INSERT en
+notificaciones_salida para las filas que existían.
+
+En modo async (start_worker.py) muchos jobs terminan a la vez en el mismo
+proceso: EscritorLotes junta sus filas y las aplica cada LOTE_BD_TAMANO
+filas o LOTE_BD_ESPERA segundos, lo que pase primero. Cada job espera el
+resultado de su propia fila. Si el lote falla, se reintenta fila por
+fila para que el error le llegue solo al job que lo causó.
+
+Si un job deja de esperar (LOTE_BD_TIMEOUT), su fila se saca de la cola
+si todavía no entró a un lote; si ya entró, el lote puede confirmarse
+después, mientras el job falla y RQ lo reintenta. Por eso el UPDATE no
+toca filas ya 'processed' o 'confirmed': entre el lote tardío y el
+reintento solo una de las escrituras aplica.
+
+En los demás modos cada proceso corre un job a la vez y aplicar() se
+llama directo con una fila.
+"""
+import os
+import time
+import queue
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import Future
+
+from psycopg2.extras import execute_values
+
+import db
+import bandeja_salida
+
+logger = logging.getLogger(__name__)
+
+LOTE_BD_TAMANO = int(os.getenv('LOTE_BD_TAMANO', '50'))
+LOTE_BD_ESPERA = float(os.getenv('LOTE_BD_ESPERA', '0.05'))
+# Lo que espera un job por su fila antes de darla por fallida
+LOTE_BD_TIMEOUT = 60
+
+FilaOcr = namedtuple('FilaOcr', [
+    'id', 'status', 'ocr_data', 'processed_at', 'fecha', 'monto', 'categoria', 'descripcion',
+    'tipo_gasto', 'banco', 'image_path', 'encolado_at', 'procesando_at', 'ocr_at',
+])
+
+# Los VALUES no tienen tipo propio: los NULL y los textos necesitan cast
+PLANTILLA = (
+    '(%s::integer, %s, %s::jsonb, %s::timestamp, %s::date, %s::real, %s, %s, %s, %s, %s, '
+    '%s::timestamp, %s::timestamp, %s::timestamp)'
+)
+
+SQL_ACTUALIZAR = f"""
+    UPDATE finanzas AS f
+    SET
+        status = v.status,
+        ocr_data = v.ocr_data,
+        processed_at = v.processed_at,
+        fecha = COALESCE(v.fecha, f.fecha),
+        monto = COALESCE(v.monto, f.monto),
+        categoria = COALESCE(v.categoria, f.categoria),
+        descripcion = COALESCE(v.descripcion, f.descripcion),
+        tipo_gasto = COALESCE(v.tipo_gasto, f.tipo_gasto),
+        banco = COALESCE(v.banco, f.banco),
+        image_path = COALESCE(v.image_path, f.image_path),
+        encolado_at = COALESCE(v.encolado_at, f.encolado_at),
+        procesando_at = COALESCE(v.procesando_at, f.procesando_at),
+        ocr_at = COALESCE(v.ocr_at, f.ocr_at)
+    FROM (VALUES %s) AS v ({', '.join(FilaOcr._fields)})
+    WHERE f.id = v.id AND f.status NOT IN ('processed', 'confirmed')
+    RETURNING f.id
+"""
+
+
+def aplicar(items):
+    """
+    Escribe un lote en una sola transacción.
+
+    Args:
+        items: lista de (FilaOcr, notificacion); notificacion es
+               (chat_id, texto, teclado) o None. Sin ids repetidos.
+    Returns:
+        set de ids actualizados (los que faltan ya no existen en finanzas
+        o ya estaban procesados)
+    """
+    with db.conexion() as conn:
+        with conn.cursor() as cur:
+            actualizados = execute_values(
+                cur, SQL_ACTUALIZAR, [fila for fila, _ in items],
+                template=PLANTILLA, page_size=len(items), fetch=True
+            )
+            actualizados = {fila_id for (fila_id,) in actualizados}
+            # Sin mensaje para gastos que ya no existen (cancelados mientras tanto) o ya procesados
+            mensajes = [
+                (notificacion[0], fila.id) + tuple(notificacion[1:])
+                for fila, notificacion in items
+                if notificacion and fila.id in actualizados
+            ]
+            if mensajes:
+                bandeja_salida.agregar_lote(cur, mensajes)
+        conn.commit()
+    return actualizados
+
+
+class EscritorLotes:
+    """Junta filas de varios hilos y las escribe por lotes desde un hilo propio"""
+
+    def __init__(self, tamano=LOTE_BD_TAMANO, espera=LOTE_BD_ESPERA):
+        self.tamano = tamano
+        self.espera = espera
+        self._cola = queue.Queue()
+        self._hilo = threading.Thread(target=self._bucle, name='lotes-bd', daemon=True)
+        self._hilo.start()
+
+    def escribir(self, fila, notificacion=None, timeout=LOTE_BD_TIMEOUT):
+        """Encola la fila y espera a que su lote se escriba. Retorna True si se actualizó."""
+        futuro = Future()
+        self._cola.put((fila, notificacion, futuro))
+        try:
+            return futuro.result(timeout)
+        except TimeoutError:
+            # Solo se cancela si aún no entró a un lote (ver _bucle)
+            futuro.cancel()
+            raise
+
+    def _juntar(self):
+        """Bloquea hasta la primera fila y junta las que lleguen hasta llenar el lote o vencer la espera"""
+        lote = [self._cola.get()]
+        ids = {lote[0][0].id}
+        limite = time.monotonic() + self.espera
+        while len(lote) < self.tamano:
+            restante = limite - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                item = self._cola.get(timeout=restante)
+            except queue.Empty:
+                break
+            if item[0].id in ids:
+                # Un id repetido en el mismo UPDATE ... FROM queda indefinido: va al próximo lote
+                self._cola.put(item)
+                break
+            ids.add(item[0].id)
+            lote.append(item)
+        return lote
+
+    def _bucle(self):
+        while True:
+            # Desde aquí el job ya no puede cancelar su fila
+            lote = [item for item in self._juntar() if item[2].set_running_or_notify_cancel()]
+            if not lote:
+                continue
+            inicio = time.monotonic()
+            try:
+                actualizados = aplicar([(fila, notificacion) for fila, notificacion, _ in lote])
+            except Exception as e:
+                logger.warning(f"⚠️ Lote de {len(lote)} filas falló ({e}), reintentando una por una")
+                for fila, notificacion, futuro in lote:
+                    try:
+                        futuro.set_result(fila.id in aplicar([(fila, notificacion)]))
+                    except Exception as e_fila:
+                        futuro.set_exception(e_fila)
+                continue
+
+            for fila, _, futuro in lote:
+                futuro.set_result(fila.id in actualizados)
+            logger.debug(f"💾 Lote de {len(lote)} filas en {time.monotonic() - inicio:.3f}s")
+
+
+_escritor = None
+
+
+def activar(tamano=LOTE_BD_TAMANO, espera=LOTE_BD_ESPERA):
+    """Hace que escribir() agrupe las filas del proceso por lotes"""
+    global _escritor
+    if _escritor is None:
+        _escritor = EscritorLotes(tamano, espera)
+        logger.info(f"💾 Escritura por lotes activada ({tamano} filas / {espera * 1000:.0f} ms)")
+    return _escritor
+
+
+def escribir(fila, notificacion=None):
+    """
+    Escribe la fila por lotes si están activados; si no, en su propia
+    transacción. Retorna False si el gasto ya no existe o ya estaba procesado.
+    """
+    if _escritor is not None:
+        return _escritor.escribir(fila, notificacion)
+    return fila.id in aplicar([(fila, notificacion)])
@@ -1,6 +1,6 @@
 import os
 import logging
-import psycopg2
+import tempfile
 from datetime import datetime
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import (
@@ -10,10 +10,21 @@ from telegram.ext import (
     ConversationHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters,
 )
-import base64
-import io
+import barrido
+import db
+import duplicados
+import exportador
+import importador
+import gasto_rapido
+import metricas
+from formatos import parse_fecha_ddmmyyyy, parse_monto, formatear_monto
+import preproceso
+from worker import construir_confirmacion
+from procesador_updates import ProcesadorPorChat
+from migraciones import aplicar_migraciones
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,7 +34,11 @@ logger = logging.getLogger(__name__)
 
 # Variables de entorno
 TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
-DB_URL = os.getenv("DATABASE_PUBLIC_URL")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "https://api.telegram.org")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+
+# Solo los tipos de update que tienen handler
+ALLOWED_UPDATES = [Update.MESSAGE, Update.CALLBACK_QUERY]
 
 # Estados de la conversación
 MENU, ESPERANDO_FOTO = range(2)
@@ -39,75 +54,26 @@ TIPOS_GASTO = [["Comida", "Transporte", "Vivienda"],
 CATEGORIAS = [["Gasto", "Ingreso"]]
 METODOS_PAGO = [["Tarjeta Crédito", "Tarjeta Débito", "Inversión"]]
 
+GRAMATICA_RAPIDA = gasto_rapido.Gramatica(TIPOS_GASTO, CATEGORIAS, METODOS_PAGO)
+# Marcas de context.user_data que esperan texto para editar un gasto
+CLAVES_EDICION = ('esperando_monto_editar', 'esperando_desc_editar', 'esperando_fecha_editar', 'esperando_monto_manual')
+
+# /resumen
+RESUMEN_MESES = 3
+RESUMEN_MESES_MAX = 24
+
 # =============================================================================
 # HELPERS
 # =============================================================================
 
-def parse_fecha_ddmmyyyy(txt: str) -> str:
-    """Convierte DD-MM-YYYY a YYYY-MM-DD (ISO para Postgres)."""
-    return datetime.strptime(txt.strip(), "%d-%m-%Y").strftime("%Y-%m-%d")
-
-def parse_monto(txt: str) -> float:
-    """Normaliza monto en distintos formatos a float."""
-    s = txt.strip().replace("$", "").replace(" ", "")
-    if "," in s and s.count(",") == 1 and (("." in s and s.rfind(".") < s.rfind(",")) or "." not in s):
-        s = s.replace(".", "").replace(",", ".")
-    return float(s)
-
-def create_table():
-    """Crea o actualiza la tabla finanzas con soporte para base64"""
-    try:
-        conn = psycopg2.connect(DB_URL, sslmode="require")
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS finanzas (
-                id SERIAL PRIMARY KEY,
-                fecha DATE,
-                monto REAL,
-                tipo_gasto TEXT,
-                categoria TEXT,
-                banco TEXT,
-                descripcion TEXT,
-                metodo_pago TEXT,
-                creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        conn.commit()
-        
-        columnas_nuevas = [
-            "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'manual'",
-            "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS image_path TEXT",
-            "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS ocr_data JSONB",
-            "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS telegram_user_id BIGINT",
-            "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS telegram_chat_id BIGINT",
-            "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS processed_at TIMESTAMP"
-        ]
-        
-        for query in columnas_nuevas:
-            try:
-                cursor.execute(query)
-            except Exception as e:
-                logger.warning(f"⚠️ Columna ya existe: {e}")
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        logger.info("✅ Tabla verificada")
-        
-    except Exception as e:
-        logger.error(f"❌ Error tabla: {e}")
-        raise
-
-def insert_into_db(data, status='manual'):
+def insert_into_db(data, status='manual', user_id=None, chat_id=None):
     """Inserta un registro en la base de datos"""
     try:
-        conn = psycopg2.connect(DB_URL, sslmode="require")
-        cur = conn.cursor()
-        cur.execute(
+        db.ejecutar_sql_sync(
             """INSERT INTO finanzas 
-            (fecha, monto, tipo_gasto, categoria, banco, descripcion, metodo_pago, status) 
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)""",
+            (fecha, monto, tipo_gasto, categoria, banco, descripcion, metodo_pago, status,
+             telegram_user_id, telegram_chat_id) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
             (
                 data["fecha"], 
                 data["monto"], 
@@ -116,12 +82,11 @@ def insert_into_db(data, status='manual'):
                 data["banco"], 
                 data["descripcion"], 
                 data["metodo_pago"],
-                status
+                status,
+                user_id,
+                chat_id
             )
         )
-        conn.commit()
-        cur.close()
-        conn.close()
         logger.info("✅ Guardado")
     except Exception as e:
         logger.error(f"❌ Error: {e}")
@@ -136,7 +101,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         '👋 ¡Bienvenido a Mucho Derroche!\n\n'
         'Bot para registrar tus gastos.\n\n'
-        'Usa /nuevo para registrar un gasto.'
+        'Usa /nuevo para registrar un gasto.\n'
+        'O escríbelo en un mensaje: /g 12.500 comida almuerzo debito\n'
+        'Usa /resumen para ver tus totales.\n'
+        'Usa /exportar para descargarlos.\n'
+        'Envía una cartola CSV u OFX para importarla.'
     )
 
 async def nuevo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -151,6 +120,127 @@ async def nuevo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["in_conversation"] = True
     return MENU
 
+async def resumen(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /resumen [meses]: totales por mes, tipo y categoría"""
+    try:
+        meses = int(context.args[0]) if context.args else RESUMEN_MESES
+    except ValueError:
+        await update.message.reply_text('❌ Uso: /resumen [meses]')
+        return
+    meses = max(1, min(meses, RESUMEN_MESES_MAX))
+    
+    # Lee la tabla agregada (mantenida por trigger): el costo depende de los
+    # meses pedidos, no de cuántos gastos tenga el usuario
+    filas = await db.ejecutar_sql("""
+        SELECT mes, categoria, tipo_gasto, total, cantidad
+        FROM finanzas_resumen
+        WHERE telegram_user_id = %s
+          AND mes >= (date_trunc('month', CURRENT_DATE) - make_interval(months => %s))::date
+          AND cantidad > 0
+        ORDER BY mes DESC, categoria, total DESC
+    """, (update.effective_user.id, meses - 1), fetch='all')
+    
+    if not filas:
+        await update.message.reply_text('📊 Aún no tienes gastos confirmados.\n\nUsa /nuevo para registrar uno.')
+        return
+    
+    por_mes = {}
+    for mes, cat, tipo, total, cantidad in filas:
+        por_mes.setdefault(mes, {}).setdefault(cat or 'Sin categoría', []).append((tipo or 'Sin tipo', total, cantidad))
+    
+    lineas = [f'📊 Resumen de los últimos {meses} meses']
+    for mes, categorias in por_mes.items():
+        lineas.append(f'\n📅 {mes.strftime("%m-%Y")}')
+        for cat, tipos in categorias.items():
+            emoji = '💰' if cat.lower() == 'ingreso' else '💸'
+            lineas.append(f'{emoji} {cat}: {formatear_monto(sum(t[1] for t in tipos))}')
+            for tipo, total, cantidad in tipos:
+                lineas.append(f'   • {tipo}: {formatear_monto(total)} ({cantidad})')
+    
+    await update.message.reply_text('\n'.join(lineas))
+
+async def exportar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /exportar [desde] [hasta] [csv|xlsx] [completo]: envía los gastos como archivo"""
+    desde = hasta = None
+    formato = 'csv'
+    completo = False
+    try:
+        for arg in context.args or []:
+            arg = arg.lower()
+            if arg in exportador.FORMATOS:
+                formato = arg
+            elif arg == 'completo':
+                completo = True
+            elif desde is None:
+                desde = parse_fecha_ddmmyyyy(arg)
+            elif hasta is None:
+                hasta = parse_fecha_ddmmyyyy(arg)
+            else:
+                raise ValueError(arg)
+    except ValueError:
+        await update.message.reply_text(
+            '❌ Uso: /exportar [desde] [hasta] [csv|xlsx] [completo]\n\n'
+            'Fechas en formato DD-MM-YYYY. "completo" incluye imagen y datos OCR.'
+        )
+        return
+    
+    await update.message.reply_text('📤 Preparando exportación...')
+    archivo = None
+    try:
+        archivo, formato, total = await db.ejecutar(
+            exportador.exportar, update.effective_user.id, desde, hasta, formato, completo
+        )
+        if not total:
+            await update.message.reply_text('📭 No hay gastos en ese rango.')
+            return
+        
+        with open(archivo, 'rb') as f:
+            await update.message.reply_document(
+                document=f,
+                filename=f'finanzas_{datetime.now():%Y%m%d}.{formato}',
+                caption=f'📊 {total} registros'
+            )
+    except Exception as e:
+        logger.error(f"❌ Error exportando: {e}")
+        await update.message.reply_text('❌ Error generando la exportación')
+    finally:
+        if archivo:
+            os.unlink(archivo)
+
+async def recibir_cartola(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Importa una cartola CSV u OFX enviada como documento"""
+    documento = update.message.document
+    formato = (documento.file_name or '').rsplit('.', 1)[-1].lower()
+    if documento.file_size and documento.file_size > importador.IMPORT_MAX_BYTES:
+        await update.message.reply_text('❌ El archivo supera los 20 MB')
+        return
+    
+    await update.message.reply_text('📥 Importando cartola...')
+    fd, archivo = tempfile.mkstemp(prefix='cartola_', suffix=f'.{formato}')
+    os.close(fd)
+    try:
+        telegram_file = await documento.get_file()
+        await telegram_file.download_to_drive(archivo)
+        
+        stats = await db.ejecutar(
+            importador.importar, archivo, formato,
+            update.effective_user.id, update.effective_chat.id
+        )
+        await update.message.reply_text(
+            f'✅ Cartola importada\n\n'
+            f'📄 Movimientos leídos: {stats.leidas}\n'
+            f'➕ Nuevos: {stats.insertadas}\n'
+            f'🔁 Ya registrados: {stats.duplicadas}\n'
+            f'⚠️ Inválidos: {stats.invalidas}'
+        )
+    except ValueError as e:
+        await update.message.reply_text(f'❌ No se pudo leer la cartola: {e}')
+    except Exception as e:
+        logger.error(f"❌ Error importando cartola: {e}")
+        await update.message.reply_text('❌ Error importando la cartola')
+    finally:
+        os.unlink(archivo)
+
 # =============================================================================
 # MENÚ
 # =============================================================================
@@ -178,51 +268,48 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return MENU
 
 # =============================================================================
-# FOTO CON BASE64
+# FOTO
 # =============================================================================
 
 async def recibir_foto(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Recibe foto y guarda como base64"""
+    """Recibe foto y encola solo su file_id (el worker descarga la imagen)"""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     
     try:
-        # Descargar foto
-        photo = update.message.photo[-1]
-        file = await photo.get_file()
-        
-        foto_bytes = io.BytesIO()
-        await file.download_to_memory(foto_bytes)
-        foto_bytes.seek(0)
-        
-        # Convertir a base64
-        foto_base64 = base64.b64encode(foto_bytes.read()).decode('utf-8')
+        # El tamaño más chico que alcanza la resolución que necesita el OCR
+        photo = preproceso.elegir_tamano(update.message.photo)
+        file_id = photo.file_id
         
-        logger.info(f"📥 Foto en base64: {len(foto_base64)} chars")
+        logger.info(f"📥 Foto recibida: {photo.width}x{photo.height}, file_id={file_id} ({photo.file_size or '?'} bytes)")
         
         # Guardar en BD
-        conn = psycopg2.connect(DB_URL, sslmode="require")
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO finanzas (
-                status, image_path, telegram_user_id, telegram_chat_id,
-                metodo_pago, fecha, monto, tipo_gasto, categoria, banco, descripcion
-            )
-            VALUES (%s, %s, %s, %s, 'Por definir', CURRENT_DATE, 0, 'Pendiente', 'Pendiente', 'Pendiente', 'Procesando...')
-            RETURNING id
-        """, ('pending', foto_base64, user_id, chat_id))
+        with metricas.medir('bd_insert'):
+            row = await db.ejecutar_sql("""
+                INSERT INTO finanzas (
+                    status, telegram_file_id, telegram_user_id, telegram_chat_id,
+                    metodo_pago, fecha, monto, tipo_gasto, categoria, banco, descripcion
+                )
+                VALUES (%s, %s, %s, %s, 'Por definir', CURRENT_DATE, 0, 'Pendiente', 'Pendiente', 'Pendiente', 'Procesando...')
+                RETURNING id
+            """, ('pending', file_id, user_id, chat_id), fetch='one')
         
-        gasto_id = cursor.fetchone()[0]
-        conn.commit()
-        cursor.close()
-        conn.close()
+        gasto_id = row[0]
         
         logger.info(f"💾 ID={gasto_id}")
         
+        # Boleta casi igual a una ya procesada: preguntar antes de gastar un OCR
+        previo_id = await buscar_duplicado(update.message.photo, user_id, gasto_id)
+        if previo_id:
+            await preguntar_duplicado(update, gasto_id, previo_id)
+            context.user_data["in_conversation"] = False
+            return ConversationHandler.END
+        
         # Encolar (IMPORTANTE: Importar aquí para evitar error de importación circular)
         try:
             from queue_manager import encolar_foto
-            job = encolar_foto(gasto_id, foto_base64, chat_id, user_id)
+            with metricas.medir('encolar'):
+                job = encolar_foto(gasto_id, file_id, chat_id, user_id)
             
             if job:
                 await update.message.reply_text('⏳ *Procesando...*', parse_mode='Markdown')
@@ -240,10 +327,92 @@ async def recibir_foto(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text('❌ Error')
         return ConversationHandler.END
 
+async def buscar_duplicado(photos, user_id, gasto_id):
+    """
+    Busca un gasto previo del usuario con foto casi idéntica y OCR disponible.
+    Usa la miniatura más pequeña de Telegram: basta para el hash perceptual.
+    Retorna el id del gasto previo o None.
+    """
+    try:
+        miniatura = await photos[0].get_file()
+        phash = duplicados.calcular_phash(bytes(await miniatura.download_as_bytearray()))
+        
+        candidatos = [previo_id for previo_id, _ in duplicados.buscar(user_id, phash)]
+        duplicados.registrar(user_id, gasto_id, phash)
+        if not candidatos:
+            return None
+        
+        row = await db.ejecutar_sql("""
+            SELECT id FROM finanzas
+            WHERE id = ANY(%s) AND telegram_user_id = %s
+              AND ocr_data IS NOT NULL AND status IN ('processed', 'confirmed')
+            ORDER BY array_position(%s, id)
+            LIMIT 1
+        """, (candidatos, user_id, candidatos), fetch='one')
+        return row[0] if row else None
+    
+    except Exception as e:
+        # La detección es opcional: ante cualquier fallo se procesa normal
+        logger.warning(f"⚠️ Detección de duplicados falló: {e}")
+        return None
+
+async def preguntar_duplicado(update: Update, gasto_id, previo_id):
+    """Deja el gasto en espera y pregunta al usuario qué hacer"""
+    await db.ejecutar_sql("UPDATE finanzas SET status = 'posible_duplicado' WHERE id = %s", (gasto_id,))
+    
+    keyboard = [
+        [InlineKeyboardButton("🗑️ Sí, es duplicada", callback_data=f"dupsi_{gasto_id}")],
+        [InlineKeyboardButton("📋 Usar mismos datos", callback_data=f"dupusar_{gasto_id}_{previo_id}")],
+        [InlineKeyboardButton("🔄 No, procesar", callback_data=f"dupno_{gasto_id}")]
+    ]
+    
+    await update.message.reply_text(
+        f'🔁 *Esta boleta se parece a la del gasto #{previo_id}*\n\n¿Es la misma boleta?',
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
 # =============================================================================
 # CALLBACKS
 # =============================================================================
 
+# Botones de confirmación y error del worker: callback_data "accion_gastoid"
+ACCIONES_BOLETA = ('confirm', 'edit', 'cancel', 'manual', 'retry')
+
+def boletas_del_mensaje(message):
+    """gasto_ids con botones en el mensaje (más de uno si el notificador lo agrupó)"""
+    if message is None or message.reply_markup is None:
+        return set()
+    ids = set()
+    for fila in message.reply_markup.inline_keyboard:
+        for boton in fila:
+            partes = (boton.callback_data or '').split('_')
+            if len(partes) == 2 and partes[0] in ACCIONES_BOLETA:
+                ids.add(partes[1])
+    return ids
+
+class RespuestaAgrupada:
+    """
+    Botón de un mensaje con varias boletas (notificador.agrupar).
+    edit_message_text reemplazaría el mensaje de todas: la respuesta va en
+    un mensaje nuevo y del agrupado solo se quitan los botones de esta.
+    """
+
+    def __init__(self, query, gasto_id):
+        self._query = query
+        self._gasto_id = gasto_id
+
+    def __getattr__(self, nombre):
+        return getattr(self._query, nombre)
+
+    async def edit_message_text(self, text, **kwargs):
+        await self._query.message.reply_text(text, **kwargs)
+        filas = [
+            fila for fila in self._query.message.reply_markup.inline_keyboard
+            if not any((boton.callback_data or '').split('_')[1:] == [self._gasto_id] for boton in fila)
+        ]
+        await self._query.edit_message_reply_markup(InlineKeyboardMarkup(filas) if filas else None)
+
 async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja botones"""
     query = update.callback_query
@@ -252,38 +421,34 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         parts = query.data.split('_')
         action = parts[0]
-        
-        conn = psycopg2.connect(DB_URL, sslmode="require")
-        cursor = conn.cursor()
+
+        if action in ACCIONES_BOLETA and len(boletas_del_mensaje(query.message)) > 1:
+            query = RespuestaAgrupada(query, parts[1])
         
         # CONFIRMAR GASTO
         if action == 'confirm':
             gasto_id = int(parts[1])
-            cursor.execute("UPDATE finanzas SET status = 'confirmed' WHERE id = %s", (gasto_id,))
-            conn.commit()
+            await db.ejecutar_sql("UPDATE finanzas SET status = 'confirmed' WHERE id = %s", (gasto_id,))
             await query.edit_message_text('✅ *Gasto guardado correctamente!*', parse_mode='Markdown')
         
         # CANCELAR
         elif action == 'cancel':
             gasto_id = int(parts[1])
-            cursor.execute("DELETE FROM finanzas WHERE id = %s", (gasto_id,))
-            conn.commit()
+            await db.ejecutar_sql("DELETE FROM finanzas WHERE id = %s", (gasto_id,))
             await query.edit_message_text('🗑️ Gasto cancelado.')
         
         # SELECCIONAR MONTO (sin propina)
         elif action == 'monto' and parts[1] == 'sin':
             gasto_id = int(parts[2])
             monto = float(parts[3])
-            cursor.execute("UPDATE finanzas SET monto = %s WHERE id = %s", (monto, gasto_id))
-            conn.commit()
+            await db.ejecutar_sql("UPDATE finanzas SET monto = %s WHERE id = %s", (monto, gasto_id))
             await query.answer(f"✅ Registrado: ${monto:,.0f} (sin propina)")
         
         # SELECCIONAR MONTO (con propina)
         elif action == 'monto' and parts[1] == 'con':
             gasto_id = int(parts[2])
             monto = float(parts[3])
-            cursor.execute("UPDATE finanzas SET monto = %s WHERE id = %s", (monto, gasto_id))
-            conn.commit()
+            await db.ejecutar_sql("UPDATE finanzas SET monto = %s WHERE id = %s", (monto, gasto_id))
             await query.answer(f"✅ Registrado: ${monto:,.0f} (con propina)")
         
         # MONTO MANUAL
@@ -324,8 +489,7 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         elif action == 'setcat':
             gasto_id = int(parts[1])
             categoria = '_'.join(parts[2:])  # Por si tiene espacios
-            cursor.execute("UPDATE finanzas SET tipo_gasto = %s WHERE id = %s", (categoria, gasto_id))
-            conn.commit()
+            await db.ejecutar_sql("UPDATE finanzas SET tipo_gasto = %s WHERE id = %s", (categoria, gasto_id))
             await query.answer(f"✅ Categoría: {categoria}")
             await query.edit_message_text(f'✅ Categoría actualizada a: *{categoria}*\n\nUsa los botones anteriores para confirmar.', parse_mode='Markdown')
 
@@ -334,8 +498,10 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             gasto_id = int(parts[1])
 
             # Obtener datos actuales
-            cursor.execute("SELECT monto, tipo_gasto, descripcion, fecha FROM finanzas WHERE id = %s", (gasto_id,))
-            row = cursor.fetchone()
+            row = await db.ejecutar_sql(
+                "SELECT monto, tipo_gasto, descripcion, fecha FROM finanzas WHERE id = %s",
+                (gasto_id,), fetch='one'
+            )
 
             if row:
                 monto, tipo_gasto, descripcion, fecha = row
@@ -361,6 +527,77 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             else:
                 await query.answer("❌ Gasto no encontrado")
 
+        # DUPLICADO: DESCARTAR
+        elif action == 'dupsi':
+            gasto_id = int(parts[1])
+            await db.ejecutar_sql(
+                "DELETE FROM finanzas WHERE id = %s AND status = 'posible_duplicado'", (gasto_id,)
+            )
+            await query.edit_message_text('🗑️ Boleta duplicada descartada.')
+        
+        # DUPLICADO: REUTILIZAR OCR DEL GASTO PREVIO
+        elif action == 'dupusar':
+            gasto_id = int(parts[1])
+            previo_id = int(parts[2])
+            row = await db.ejecutar_sql("""
+                UPDATE finanzas n SET
+                    status = 'processed',
+                    ocr_data = p.ocr_data,
+                    processed_at = NOW(),
+                    fecha = p.fecha,
+                    monto = p.monto,
+                    categoria = p.categoria,
+                    descripcion = p.descripcion,
+                    tipo_gasto = p.tipo_gasto,
+                    banco = p.banco
+                FROM finanzas p
+                WHERE n.id = %s AND p.id = %s AND n.status = 'posible_duplicado'
+                RETURNING n.ocr_data
+            """, (gasto_id, previo_id), fetch='one')
+            
+            if row:
+                mensaje, keyboard = construir_confirmacion(gasto_id, row[0])
+                await query.edit_message_text(
+                    mensaje,
+                    parse_mode='Markdown',
+                    reply_markup=InlineKeyboardMarkup.de_json(keyboard, context.bot)
+                )
+            else:
+                await query.edit_message_text('❌ Gasto no encontrado')
+        
+        # DUPLICADO: PROCESAR IGUAL
+        elif action == 'dupno':
+            gasto_id = int(parts[1])
+            row = await db.ejecutar_sql("""
+                UPDATE finanzas SET status = 'pending'
+                WHERE id = %s AND status = 'posible_duplicado'
+                RETURNING telegram_file_id, telegram_chat_id, telegram_user_id
+            """, (gasto_id,), fetch='one')
+            
+            if row:
+                from queue_manager import encolar_foto
+                job = encolar_foto(gasto_id, *row)
+                await query.edit_message_text('⏳ *Procesando...*' if job else '⚠️ Error al procesar', parse_mode='Markdown')
+            else:
+                await query.edit_message_text('❌ Gasto no encontrado')
+
+        # REINTENTAR OCR (botón del mensaje de error del worker)
+        elif action == 'retry':
+            gasto_id = int(parts[1])
+            row = await db.ejecutar_sql("""
+                UPDATE finanzas SET status = 'pending'
+                WHERE id = %s AND status IN ('error', 'fallido')
+                RETURNING telegram_file_id, telegram_chat_id, telegram_user_id
+            """, (gasto_id,), fetch='one')
+            
+            if row:
+                from queue_manager import encolar_foto
+                # El usuario está esperando: carril prioritario, sin turno
+                job = encolar_foto(gasto_id, *row, prioridad=True)
+                await query.edit_message_text('⏳ *Reintentando...*' if job else '⚠️ Error al procesar', parse_mode='Markdown')
+            else:
+                await query.edit_message_text('❌ Gasto no encontrado')
+
         # EDITAR MONTO
         elif action == 'editmonto':
             gasto_id = int(parts[1])
@@ -390,9 +627,6 @@ async def callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode='Markdown'
             )
             context.user_data['esperando_fecha_editar'] = gasto_id
-
-        cursor.close()
-        conn.close()
         
     except Exception as e:
         logger.error(f"❌ Error: {e}")
@@ -453,7 +687,10 @@ async def metodo_pago(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["metodo_pago"] = update.message.text
     
     try:
-        insert_into_db(context.user_data)
+        await db.ejecutar(
+            insert_into_db, dict(context.user_data),
+            user_id=update.effective_user.id, chat_id=update.effective_chat.id
+        )
         await update.message.reply_text('✅ Guardado', reply_markup=ReplyKeyboardRemove())
     except Exception as e:
         logger.error(f"❌ {e}")
@@ -469,16 +706,12 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def handle_edicion_manual(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja la edición manual de campos (monto, descripción, fecha)"""
     try:
-        conn = psycopg2.connect(DB_URL, sslmode="require")
-        cursor = conn.cursor()
-
         # EDITAR MONTO
         if 'esperando_monto_editar' in context.user_data:
             gasto_id = context.user_data.pop('esperando_monto_editar')
             try:
                 nuevo_monto = parse_monto(update.message.text)
-                cursor.execute("UPDATE finanzas SET monto = %s WHERE id = %s", (nuevo_monto, gasto_id))
-                conn.commit()
+                await db.ejecutar_sql("UPDATE finanzas SET monto = %s WHERE id = %s", (nuevo_monto, gasto_id))
                 await update.message.reply_text(f'✅ Monto actualizado a ${nuevo_monto:,.0f}\n\nUsa /nuevo para otro gasto.')
             except:
                 await update.message.reply_text('❌ Monto inválido')
@@ -487,8 +720,7 @@ async def handle_edicion_manual(update: Update, context: ContextTypes.DEFAULT_TY
         elif 'esperando_desc_editar' in context.user_data:
             gasto_id = context.user_data.pop('esperando_desc_editar')
             nueva_desc = update.message.text
-            cursor.execute("UPDATE finanzas SET descripcion = %s WHERE id = %s", (nueva_desc, gasto_id))
-            conn.commit()
+            await db.ejecutar_sql("UPDATE finanzas SET descripcion = %s WHERE id = %s", (nueva_desc, gasto_id))
             await update.message.reply_text(f'✅ Descripción actualizada\n\nUsa /nuevo para otro gasto.')
 
         # EDITAR FECHA
@@ -496,8 +728,7 @@ async def handle_edicion_manual(update: Update, context: ContextTypes.DEFAULT_TY
             gasto_id = context.user_data.pop('esperando_fecha_editar')
             try:
                 nueva_fecha = parse_fecha_ddmmyyyy(update.message.text)
-                cursor.execute("UPDATE finanzas SET fecha = %s WHERE id = %s", (nueva_fecha, gasto_id))
-                conn.commit()
+                await db.ejecutar_sql("UPDATE finanzas SET fecha = %s WHERE id = %s", (nueva_fecha, gasto_id))
                 await update.message.reply_text(f'✅ Fecha actualizada\n\nUsa /nuevo para otro gasto.')
             except:
                 await update.message.reply_text('❌ Fecha inválida (usa DD-MM-YYYY)')
@@ -507,8 +738,7 @@ async def handle_edicion_manual(update: Update, context: ContextTypes.DEFAULT_TY
             gasto_id = context.user_data.pop('esperando_monto_manual')
             try:
                 monto = parse_monto(update.message.text)
-                cursor.execute("UPDATE finanzas SET monto = %s WHERE id = %s", (monto, gasto_id))
-                conn.commit()
+                await db.ejecutar_sql("UPDATE finanzas SET monto = %s WHERE id = %s", (monto, gasto_id))
                 await update.message.reply_text(f'✅ Monto registrado: ${monto:,.0f}\n\nUsa /nuevo para otro gasto.')
             except:
                 await update.message.reply_text('❌ Monto inválido')
@@ -516,26 +746,83 @@ async def handle_edicion_manual(update: Update, context: ContextTypes.DEFAULT_TY
         else:
             await update.message.reply_text("👋 Usa /nuevo")
 
-        cursor.close()
-        conn.close()
-
     except Exception as e:
         logger.error(f"❌ Error editando: {e}")
         await update.message.reply_text('❌ Error actualizando')
 
+async def guardar_rapido(update: Update, gasto: dict):
+    """Guarda un gasto de gasto_rapido con un solo INSERT y una sola respuesta"""
+    try:
+        await db.ejecutar(
+            insert_into_db, gasto,
+            user_id=update.effective_user.id, chat_id=update.effective_chat.id
+        )
+    except Exception as e:
+        logger.error(f"❌ Error guardando gasto rápido: {e}")
+        await update.message.reply_text('❌ Error guardando')
+        return
+    
+    fecha = datetime.strptime(gasto['fecha'], '%Y-%m-%d').strftime('%d-%m-%Y')
+    detalle = ' · '.join(v for v in (gasto['tipo_gasto'], gasto['metodo_pago'], gasto['descripcion']) if v)
+    await update.message.reply_text(
+        f'✅ {gasto["categoria"]} guardado: {formatear_monto(gasto["monto"])} ({fecha})'
+        + (f'\n{detalle}' if detalle else '')
+    )
+
+async def gasto_rapido_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Comando /g <monto> [tipo] [categoría] [método] [fecha] [descripción]"""
+    gasto = GRAMATICA_RAPIDA.parsear(' '.join(context.args or []))
+    if not gasto:
+        await update.message.reply_text(
+            '❌ Uso: /g 12.500 comida almuerzo debito\n\n'
+            'Fecha opcional: hoy, ayer, DD-MM o DD-MM-YYYY'
+        )
+        return
+    await guardar_rapido(update, gasto)
+
 async def handle_unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handler para mensajes fuera de conversación"""
+    if not any(clave in context.user_data for clave in CLAVES_EDICION):
+        # Texto libre tipo "ayer 8000 transporte uber": monto y al menos otra palabra reconocida
+        gasto = GRAMATICA_RAPIDA.parsear(update.message.text)
+        if gasto and len(gasto['reconocidos']) > 1:
+            await guardar_rapido(update, gasto)
+            return
     await handle_edicion_manual(update, context)
 
 # =============================================================================
 # MAIN
 # =============================================================================
 
-def main():
-    logger.info("🔄 Iniciando...")
-    create_table()
+async def post_shutdown(app: Application):
+    """Cierra el pool de conexiones al detener el bot"""
+    await db.cerrar_pool()
+
+def construir_app() -> Application:
+    """Application con todos los handlers (main y bench/pipeline.py)"""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .base_url(f"{TELEGRAM_API_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+        .concurrent_updates(ProcesadorPorChat())
+        .post_shutdown(post_shutdown)
+    )
     
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
+    # Conversaciones y ediciones pendientes sobreviven reinicios
+    from queue_manager import redis_conn
+    persistencia = None
+    if redis_conn is not None:
+        from persistencia import RedisPersistence
+        persistencia = RedisPersistence()
+        builder = builder.persistence(persistencia)
+    else:
+        logger.warning("⚠️ Redis no disponible, el estado de las conversaciones queda solo en memoria")
+    app = builder.build()
+
+    if persistencia is not None:
+        # Antes que todos: trae lo que otra réplica cambió de este usuario y sus conversaciones
+        app.add_handler(TypeHandler(Update, persistencia.sincronizar), group=-1)
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler("nuevo", nuevo)],
@@ -551,16 +838,41 @@ def main():
             METODO_PAGO: [MessageHandler(filters.TEXT & ~filters.COMMAND, metodo_pago)],
         },
         fallbacks=[CommandHandler("cancel", cancel)],
+        name="gasto",
+        persistent=redis_conn is not None,
     )
     
     # Handlers
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("resumen", resumen))
+    app.add_handler(CommandHandler("exportar", exportar))
+    app.add_handler(CommandHandler("g", gasto_rapido_cmd))
     app.add_handler(conv_handler)
     app.add_handler(CallbackQueryHandler(callback_handler))
+    app.add_handler(MessageHandler(
+        filters.Document.FileExtension('csv') | filters.Document.FileExtension('ofx'),
+        recibir_cartola
+    ))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_unknown))
+    return app
+
+def main():
+    logger.info("🔄 Iniciando...")
+    db.init_pool()
+    aplicar_migraciones()
+    metricas.servir()
+    # Fotos que quedaron sin encolar (p. ej. Redis caído al recibirlas)
+    barrido.iniciar()
+    
+    app = construir_app()
     
-    logger.info("🚀 Bot iniciado")
-    app.run_polling(allowed_updates=Update.ALL_TYPES)
+    if BOT_MODE == 'webhook':
+        from webhook import run_webhook
+        logger.info("🚀 Bot iniciado (webhook)")
+        run_webhook(app, allowed_updates=ALLOWED_UPDATES)
+    else:
+        logger.info("🚀 Bot iniciado (polling)")
+        app.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 if __name__ == "__main__":
     main()
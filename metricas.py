@@ -0,0 +1,209 @@
+"""
+Histogramas de duración por etapa y endpoint HTTP en formato Prometheus
+
+Cada proceso (bot y workers) acumula sus observaciones en memoria y las
+vuelca a Redis con volcar(): el worker al terminar cada job, el bot y el
+notificador cada METRICAS_INTERVALO segundos. El endpoint GET /metrics
+del bot muestra lo acumulado en Redis por todos los procesos, más los
+gauges de la cola (get_queue_info), del circuito de n8n y de los
+mensajes pendientes del notificador.
+
+Etapas:
+    bot:     bd_insert, encolar
+    worker:  espera_cola, descarga_telegram, preproceso, n8n, bd_update,
+             proceso_total
+    notificador: telegram_envio
+"""
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICAS_HOST = os.getenv('METRICAS_HOST', '127.0.0.1')
+METRICAS_PUERTO = int(os.getenv('METRICAS_PUERTO', '9100'))
+METRICAS_INTERVALO = float(os.getenv('METRICAS_INTERVALO', '10'))
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+CLAVE_REDIS = 'metricas:etapas'
+NOMBRE = 'finanzas_etapa_segundos'
+
+# etapa -> [conteos por bucket (el último es +Inf), suma, total]; solo lo no volcado
+_pendientes = {}
+_lock = threading.Lock()
+
+
+def _nuevo():
+    return [[0] * (len(BUCKETS) + 1), 0.0, 0]
+
+
+def observar(etapa, segundos):
+    indice = next((i for i, limite in enumerate(BUCKETS) if segundos <= limite), len(BUCKETS))
+    with _lock:
+        datos = _pendientes.setdefault(etapa, _nuevo())
+        datos[0][indice] += 1
+        datos[1] += segundos
+        datos[2] += 1
+
+
+@contextmanager
+def medir(etapa):
+    """Mide la duración del bloque (también si lanza una excepción)"""
+    inicio = time.monotonic()
+    try:
+        yield
+    finally:
+        observar(etapa, time.monotonic() - inicio)
+
+
+def _redis():
+    try:
+        from queue_manager import redis_conn
+    except Exception:
+        return None
+    return redis_conn
+
+
+def volcar():
+    """Suma lo observado desde el último volcado a los contadores en Redis (un pipeline)"""
+    redis_conn = _redis()
+    if redis_conn is None:
+        return
+
+    global _pendientes
+    with _lock:
+        pendientes, _pendientes = _pendientes, {}
+    if not pendientes:
+        return
+
+    try:
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for etapa, (conteos, suma, total) in pendientes.items():
+                for i, n in enumerate(conteos):
+                    if n:
+                        pipe.hincrby(CLAVE_REDIS, f'{etapa}:{i}', n)
+                pipe.hincrbyfloat(CLAVE_REDIS, f'{etapa}:suma', suma)
+                pipe.hincrby(CLAVE_REDIS, f'{etapa}:total', total)
+            pipe.execute()
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudieron volcar métricas: {e}")
+        # Se devuelven para el próximo intento
+        with _lock:
+            for etapa, (conteos, suma, total) in pendientes.items():
+                datos = _pendientes.setdefault(etapa, _nuevo())
+                datos[0] = [a + b for a, b in zip(datos[0], conteos)]
+                datos[1] += suma
+                datos[2] += total
+
+
+def _acumulado():
+    """etapa -> [conteos, suma, total] desde Redis, o lo local si no hay Redis"""
+    redis_conn = _redis()
+    if redis_conn is None:
+        with _lock:
+            return {etapa: [list(d[0]), d[1], d[2]] for etapa, d in _pendientes.items()}
+
+    volcar()
+    etapas = {}
+    for campo, valor in redis_conn.hgetall(CLAVE_REDIS).items():
+        etapa, _, parte = campo.decode().rpartition(':')
+        datos = etapas.setdefault(etapa, _nuevo())
+        if parte == 'suma':
+            datos[1] = float(valor)
+        elif parte == 'total':
+            datos[2] = int(valor)
+        else:
+            datos[0][int(parte)] = int(valor)
+    return etapas
+
+
+def render():
+    """Texto en formato de exposición de Prometheus"""
+    lineas = [
+        f'# HELP {NOMBRE} Duración de cada etapa del procesamiento de boletas',
+        f'# TYPE {NOMBRE} histogram',
+    ]
+    for etapa, (conteos, suma, total) in sorted(_acumulado().items()):
+        acumulado = 0
+        for limite, n in zip(BUCKETS + ('+Inf',), conteos):
+            acumulado += n
+            lineas.append(f'{NOMBRE}_bucket{{etapa="{etapa}",le="{limite}"}} {acumulado}')
+        lineas.append(f'{NOMBRE}_sum{{etapa="{etapa}"}} {suma}')
+        lineas.append(f'{NOMBRE}_count{{etapa="{etapa}"}} {total}')
+
+    try:
+        from queue_manager import get_queue_info
+        info = get_queue_info()
+    except Exception as e:
+        info = {'error': str(e)}
+    if 'error' not in info:
+        lineas += ['# HELP finanzas_cola_jobs Jobs esperando por carril', '# TYPE finanzas_cola_jobs gauge']
+        lineas += [f'finanzas_cola_jobs{{carril="{c}"}} {n}' for c, n in info['lanes'].items()]
+        lineas += ['# HELP finanzas_cola_registro Jobs por registro de RQ', '# TYPE finanzas_cola_registro gauge']
+        lineas += [f'finanzas_cola_registro{{estado="{e}"}} {info[e]}' for e in ('started', 'finished', 'failed')]
+        lineas += ['# TYPE finanzas_cola_usuarios_esperando gauge', f'finanzas_cola_usuarios_esperando {info["users_waiting"]}']
+
+    try:
+        import circuito_n8n
+        circuito = circuito_n8n.get_estado()
+    except Exception as e:
+        circuito = {'error': str(e)}
+    if 'error' not in circuito:
+        lineas += [
+            '# TYPE finanzas_n8n_limite gauge', f'finanzas_n8n_limite {circuito["limite"]}',
+            '# TYPE finanzas_n8n_en_vuelo gauge', f'finanzas_n8n_en_vuelo {circuito["en_vuelo"]}',
+            '# TYPE finanzas_n8n_circuito_abierto gauge',
+            f'finanzas_n8n_circuito_abierto {int(circuito["estado"] != "cerrado")}',
+        ]
+
+    try:
+        import notificador
+        mensajes = notificador.get_info()
+    except Exception as e:
+        mensajes = {'error': str(e)}
+    if 'error' not in mensajes:
+        lineas += [
+            '# HELP finanzas_notif_chats Chats con mensajes pendientes de envío',
+            '# TYPE finanzas_notif_chats gauge', f'finanzas_notif_chats {mensajes["chats"]}',
+        ]
+
+    return '\n'.join(lineas) + '\n'
+
+
+class _MetricasHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        cuerpo = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def servir(host=METRICAS_HOST, puerto=METRICAS_PUERTO):
+    """Levanta GET /metrics en un hilo aparte y el volcado periódico a Redis"""
+    try:
+        servidor = ThreadingHTTPServer((host, puerto), _MetricasHandler)
+    except OSError as e:
+        # Las métricas no deben impedir que arranque el bot
+        logger.error(f"❌ No se pudo abrir el puerto de métricas {puerto}: {e}")
+        return None
+    threading.Thread(target=servidor.serve_forever, name='metricas', daemon=True).start()
+
+    def _volcado_periodico():
+        while True:
+            time.sleep(METRICAS_INTERVALO)
+            volcar()
+
+    threading.Thread(target=_volcado_periodico, name='metricas-volcado', daemon=True).start()
+    logger.info(f"📈 Métricas en http://{host}:{puerto}/metrics")
+    return servidor
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Migraciones versionadas del esquema
+
+Cada paso se aplica una sola vez y queda registrado en schema_migraciones.
+En un arranque sin pendientes solo se ejecuta una consulta. Un advisory
+lock evita que dos réplicas apliquen la misma migración a la vez.
+
+Para agregar un cambio de esquema se agrega una Migracion al final de
+MIGRACIONES con la versión siguiente; nunca se editan las ya publicadas.
+
+Uso manual:
+    python migraciones.py
+"""
+import re
+import sys
+import logging
+from collections import namedtuple
+
+import bandeja_salida
+import db
+import imagenes
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+# Identificador arbitrario para pg_advisory_lock
+LOCK_MIGRACIONES = 4127001
+
+# concurrente=True: sentencias que no pueden ir en una transacción (CREATE INDEX CONCURRENTLY)
+Migracion = namedtuple('Migracion', ['version', 'descripcion', 'sentencias', 'concurrente'], defaults=[False])
+
+MIGRACIONES = [
+    Migracion(1, 'tabla finanzas', [
+        """
+        CREATE TABLE IF NOT EXISTS finanzas (
+            id SERIAL PRIMARY KEY,
+            fecha DATE,
+            monto REAL,
+            tipo_gasto TEXT,
+            categoria TEXT,
+            banco TEXT,
+            descripcion TEXT,
+            metodo_pago TEXT,
+            creado TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS status VARCHAR(20) DEFAULT 'manual'",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS image_path TEXT",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS ocr_data JSONB",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS telegram_user_id BIGINT",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS telegram_chat_id BIGINT",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS processed_at TIMESTAMP",
+    ]),
+    Migracion(2, 'file_id de Telegram', [
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS telegram_file_id TEXT",
+    ]),
+    Migracion(3, 'almacén de imágenes', [
+        imagenes.SQL_CREAR_TABLA,
+    ]),
+    Migracion(4, 'índices de acceso', [
+        # Consultas por usuario y rango de fechas (/resumen, /exportar, duplicados)
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_finanzas_usuario_fecha ON finanzas (telegram_user_id, fecha)",
+        # Solo filas pendientes o con error: índice chico aunque la tabla crezca
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_finanzas_status_pendientes
+        ON finanzas (status, creado) WHERE status IN ('pending', 'error')
+        """,
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_finanzas_creado ON finanzas (creado)",
+    ], concurrente=True),
+    Migracion(5, 'resumen mensual incremental', [
+        """
+        CREATE TABLE IF NOT EXISTS finanzas_resumen (
+            telegram_user_id BIGINT NOT NULL,
+            mes DATE NOT NULL,
+            tipo_gasto TEXT NOT NULL,
+            categoria TEXT NOT NULL,
+            total DOUBLE PRECISION NOT NULL DEFAULT 0,
+            cantidad INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (telegram_user_id, mes, tipo_gasto, categoria)
+        )
+        """,
+        # Resta el aporte viejo de la fila y suma el nuevo: el resumen se mantiene
+        # en la misma transacción que cualquier INSERT/UPDATE/DELETE de finanzas
+        """
+        CREATE OR REPLACE FUNCTION finanzas_resumen_aplicar() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE')
+               AND OLD.telegram_user_id IS NOT NULL AND OLD.fecha IS NOT NULL
+               AND OLD.status IN ('manual', 'confirmed') THEN
+                UPDATE finanzas_resumen
+                SET total = total - COALESCE(OLD.monto, 0), cantidad = cantidad - 1
+                WHERE telegram_user_id = OLD.telegram_user_id
+                  AND mes = date_trunc('month', OLD.fecha)::date
+                  AND tipo_gasto = COALESCE(OLD.tipo_gasto, '')
+                  AND categoria = COALESCE(OLD.categoria, '');
+            END IF;
+
+            IF TG_OP IN ('INSERT', 'UPDATE')
+               AND NEW.telegram_user_id IS NOT NULL AND NEW.fecha IS NOT NULL
+               AND NEW.status IN ('manual', 'confirmed') THEN
+                INSERT INTO finanzas_resumen (telegram_user_id, mes, tipo_gasto, categoria, total, cantidad)
+                VALUES (NEW.telegram_user_id, date_trunc('month', NEW.fecha)::date,
+                        COALESCE(NEW.tipo_gasto, ''), COALESCE(NEW.categoria, ''), COALESCE(NEW.monto, 0), 1)
+                ON CONFLICT (telegram_user_id, mes, tipo_gasto, categoria) DO UPDATE
+                SET total = finanzas_resumen.total + EXCLUDED.total,
+                    cantidad = finanzas_resumen.cantidad + 1;
+            END IF;
+
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS trg_finanzas_resumen ON finanzas",
+        """
+        CREATE TRIGGER trg_finanzas_resumen
+        AFTER INSERT OR DELETE OR UPDATE OF status, monto, fecha, tipo_gasto, categoria, telegram_user_id
+        ON finanzas
+        FOR EACH ROW EXECUTE FUNCTION finanzas_resumen_aplicar()
+        """,
+        # Carga inicial; el trigger ya tomó el lock de la tabla, no se pierden escrituras
+        """
+        INSERT INTO finanzas_resumen (telegram_user_id, mes, tipo_gasto, categoria, total, cantidad)
+        SELECT telegram_user_id, date_trunc('month', fecha)::date,
+               COALESCE(tipo_gasto, ''), COALESCE(categoria, ''), SUM(COALESCE(monto, 0)), COUNT(*)
+        FROM finanzas
+        WHERE telegram_user_id IS NOT NULL AND fecha IS NOT NULL AND status IN ('manual', 'confirmed')
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT DO NOTHING
+        """,
+    ]),
+    Migracion(6, 'tiempos de procesamiento', [
+        # creado = foto recibida; processed_at = fin del OCR y update
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS encolado_at TIMESTAMP",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS procesando_at TIMESTAMP",
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS ocr_at TIMESTAMP",
+    ]),
+    Migracion(7, 'bandeja de salida de mensajes', [
+        bandeja_salida.SQL_CREAR_TABLA,
+    ]),
+    Migracion(8, 'intentos del barrido', [
+        # Veces que barrido.py volvió a encolar la fila
+        "ALTER TABLE finanzas ADD COLUMN IF NOT EXISTS barrido_intentos INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+
+
+def _version_actual(cursor):
+    # Un solo round trip: crear la tabla de control si falta y leer la versión
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migraciones (
+            version INTEGER PRIMARY KEY,
+            descripcion TEXT,
+            aplicada TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        SELECT COALESCE(MAX(version), 0) FROM schema_migraciones;
+    """)
+    return cursor.fetchone()[0]
+
+
+RE_INDICE_CONCURRENTE = re.compile(r'CREATE\s+INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+
+def _descartar_indice_invalido(cursor, sql):
+    """
+    Un CREATE INDEX CONCURRENTLY interrumpido deja el índice marcado como
+    inválido: existe, así que IF NOT EXISTS no lo reconstruye, pero el
+    planificador no lo usa. Se borra para que la sentencia lo cree de nuevo.
+    """
+    coincidencia = RE_INDICE_CONCURRENTE.search(sql)
+    if not coincidencia:
+        return
+    nombre = coincidencia.group(1)
+    cursor.execute("""
+        SELECT i.indisvalid
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+    """, (nombre,))
+    fila = cursor.fetchone()
+    if fila and not fila[0]:
+        logger.warning(f"⚠️ Índice {nombre} inválido (build interrumpido), se vuelve a crear")
+        cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {nombre}")
+
+
+def _aplicar(conn, cursor, migracion):
+    if migracion.concurrente:
+        conn.autocommit = True
+        try:
+            for sql in migracion.sentencias:
+                _descartar_indice_invalido(cursor, sql)
+                cursor.execute(sql)
+        finally:
+            conn.autocommit = False
+    else:
+        for sql in migracion.sentencias:
+            cursor.execute(sql)
+
+    cursor.execute(
+        "INSERT INTO schema_migraciones (version, descripcion) VALUES (%s, %s)",
+        (migracion.version, migracion.descripcion)
+    )
+    conn.commit()
+    logger.info(f"🧱 Migración {migracion.version} aplicada: {migracion.descripcion}")
+
+
+def aplicar_migraciones():
+    """Aplica las migraciones pendientes. Retorna la versión final del esquema."""
+    with db.conexion() as conn:
+        cursor = conn.cursor()
+        version = _version_actual(cursor)
+        conn.commit()
+
+        ultima = MIGRACIONES[-1].version
+        if version >= ultima:
+            logger.info(f"✅ Esquema al día (versión {version})")
+            return version
+
+        cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_MIGRACIONES,))
+        conn.commit()
+        try:
+            # Otra réplica pudo haberlas aplicado mientras esperábamos el lock
+            version = _version_actual(cursor)
+            conn.commit()
+
+            for migracion in MIGRACIONES:
+                if migracion.version > version:
+                    _aplicar(conn, cursor, migracion)
+                    version = migracion.version
+        finally:
+            conn.rollback()
+            cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_MIGRACIONES,))
+            conn.commit()
+            cursor.close()
+
+        logger.info(f"✅ Esquema actualizado a versión {version}")
+        return version
+
+
+if __name__ == '__main__':
+    try:
+        aplicar_migraciones()
+    except Exception as e:
+        logger.error(f"❌ Error aplicando migraciones: {e}")
+        sys.exit(1)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Mueve las imágenes base64 de finanzas.image_path al almacén por SHA-256
+
+Procesa lotes pequeños en transacciones cortas (FOR UPDATE SKIP LOCKED):
+solo bloquea las filas del lote en curso, nunca la tabla, y se puede
+interrumpir y relanzar en cualquier momento.
+
+Uso:
+    python migrar_imagenes.py [--lote 100] [--pausa 0.2]
+"""
+import sys
+import time
+import base64
+import argparse
+import binascii
+import logging
+
+import db
+import imagenes
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def migrar_lote(store, ultimo_id, tamano):
+    """Migra un lote de filas con id > ultimo_id. Retorna (ultimo_id, migradas, filas_leidas)."""
+    with db.conexion() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id, image_path FROM finanzas
+                WHERE id > %s
+                  AND image_path IS NOT NULL
+                  AND image_path NOT LIKE %s
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (ultimo_id, imagenes.PREFIJO_CLAVE + '%', tamano))
+            filas = cur.fetchall()
+
+            migradas = 0
+            for gasto_id, image_path in filas:
+                ultimo_id = gasto_id
+                try:
+                    image_bytes = base64.b64decode(image_path, validate=True)
+                except (binascii.Error, ValueError):
+                    logger.warning(f"⚠️ gasto_id={gasto_id}: image_path no es base64, se deja igual")
+                    continue
+
+                clave = store.guardar(image_bytes, conn=conn)
+                cur.execute("UPDATE finanzas SET image_path = %s WHERE id = %s", (clave, gasto_id))
+                migradas += 1
+
+        conn.commit()
+        return ultimo_id, migradas, len(filas)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migra imágenes base64 al almacén por SHA-256')
+    parser.add_argument('--lote', type=int, default=100)
+    parser.add_argument('--pausa', type=float, default=0.2, help='Segundos entre lotes')
+    args = parser.parse_args()
+
+    store = imagenes.get_store()
+    ultimo_id, total = 0, 0
+
+    while True:
+        ultimo_id, migradas, leidas = migrar_lote(store, ultimo_id, args.lote)
+        total += migradas
+        if leidas == 0:
+            break
+        logger.info(f"📦 Lote hasta id={ultimo_id}: {migradas} migradas ({total} en total)")
+        time.sleep(args.pausa)
+
+    logger.info(f"✅ Migración terminada: {total} imágenes movidas")
+    db.close_pool()
+
+
+if __name__ == '__main__':
+    try:
+        main()
+    except Exception as e:
+        logger.error(f"❌ Error migrando imágenes: {e}")
+        sys.exit(1)
@@ -0,0 +1,447 @@
+"""
+Envío de mensajes a Telegram con límites de tasa y cola persistente
+
+Los workers no llaman a sendMessage: escriben el mensaje en la bandeja de
+salida de Postgres (bandeja_salida.py), que el relevo pasa a esta cola,
+o lo dejan directo con notificar(). El proceso notificador (Procfile:
+notifier) lo envía. Un fallo de Telegram nunca hace que se repita el job
+ni el OCR.
+
+    notif:agenda            zset chat_id -> cuándo puede enviarse a ese chat
+    notif:orden:{chat_id}   zset clave -> hora de llegada (FIFO por chat)
+    notif:msg:{chat_id}     hash clave -> mensaje JSON
+    notif:cubeta:{chat_id}  token bucket del chat (NOTIF_CHAT_POR_SEG)
+    notif:cubeta:global     token bucket del bot (NOTIF_GLOBAL_POR_SEG)
+
+Agrupación, en dos niveles:
+
+- Por clave: la clave es el gasto_id, así cada boleta tiene a lo más un
+  mensaje pendiente y uno nuevo (p. ej. la confirmación tras un
+  reintento) reemplaza al anterior sin perder su turno.
+- Por chat: cuando le toca a un chat se toman hasta NOTIF_AGRUPAR_MAX
+  mensajes pendientes y, si hay más de uno, van en un solo sendMessage
+  (una ficha de cada cubeta). Cada bloque y sus botones llevan
+  "#gasto_id"; el bot (main.py, RespuestaAgrupada) responde a un botón
+  del mensaje agrupado sin tocar las demás boletas. Lo que no cabe en un
+  mensaje de Telegram queda para el siguiente envío. Si Telegram rechaza
+  un mensaje agrupado, sus partes se vuelven a enviar por separado.
+
+Cada chat tiene un solo mensaje en envío a la vez: al tomarlo, el chat se
+reprograma a ENVIO_TTL segundos; si el proceso muere sin confirmar, el
+mensaje se vuelve a enviar cuando vence. Un 429 reprograma el chat según
+retry_after; otros errores reintentan con espera exponencial.
+"""
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import metricas
+from http_client import get_session
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Telegram admite ~30 mensajes/s en total y ~1/s sostenido por chat
+NOTIF_GLOBAL_POR_SEG = float(os.getenv('NOTIF_GLOBAL_POR_SEG', '25'))
+NOTIF_GLOBAL_RAFAGA = float(os.getenv('NOTIF_GLOBAL_RAFAGA', '25'))
+NOTIF_CHAT_POR_SEG = float(os.getenv('NOTIF_CHAT_POR_SEG', '1'))
+NOTIF_CHAT_RAFAGA = float(os.getenv('NOTIF_CHAT_RAFAGA', '3'))
+NOTIF_HILOS = int(os.getenv('NOTIF_HILOS', '8'))
+NOTIF_MAX_INTENTOS = int(os.getenv('NOTIF_MAX_INTENTOS', '8'))
+NOTIF_AGRUPAR_MAX = int(os.getenv('NOTIF_AGRUPAR_MAX', '10'))
+# Límites de sendMessage
+TEXTO_MAX = 4096
+BOTONES_MAX = 100
+ESPERA_MAX = 300
+# Timeout del sendMessage más margen
+ENVIO_TTL = 30
+INTERVALO_SONDEO = 0.2
+
+PREFIJO = 'notif:'
+CLAVE_AGENDA = PREFIJO + 'agenda'
+
+# Agrega o reemplaza el mensaje; el chat entra a la agenda si no estaba
+_LUA_ENCOLAR = """
+redis.call('ZADD', KEYS[1], 'NX', ARGV[3], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('ZADD', KEYS[3], 'NX', ARGV[3], ARGV[4])
+"""
+
+# Saca el próximo chat vencido con cupo en su cubeta y en la global.
+# Retorna {chat, clave1, mensaje1, clave2, mensaje2, ...} con hasta
+# ARGV[8] mensajes del chat en orden de llegada, {'', espera} si la
+# cubeta global está vacía, o {} si no hay nada vencido.
+_LUA_TOMAR = """
+local ahora, prefijo, envio_ttl = tonumber(ARGV[1]), ARGV[2], tonumber(ARGV[3])
+local g_tasa, g_rafaga = tonumber(ARGV[4]), tonumber(ARGV[5])
+local c_tasa, c_rafaga = tonumber(ARGV[6]), tonumber(ARGV[7])
+local maximo = tonumber(ARGV[8])
+
+local function cubeta(clave, tasa, rafaga)
+    local datos = redis.call('HMGET', clave, 'fichas', 'ts')
+    local fichas = tonumber(datos[1]) or rafaga
+    local ts = tonumber(datos[2]) or ahora
+    return math.min(rafaga, fichas + (ahora - ts) * tasa)
+end
+
+local function gastar(clave, fichas, tasa, rafaga)
+    redis.call('HSET', clave, 'fichas', fichas - 1, 'ts', ahora)
+    redis.call('EXPIRE', clave, math.ceil(rafaga / tasa) + 1)
+end
+
+local global = prefijo .. 'cubeta:global'
+for _ = 1, 20 do
+    local vencido = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ahora, 'LIMIT', 0, 1)
+    if #vencido == 0 then
+        return {}
+    end
+    local chat = vencido[1]
+
+    local fichas_global = cubeta(global, g_tasa, g_rafaga)
+    if fichas_global < 1 then
+        return {'', tostring((1 - fichas_global) / g_tasa)}
+    end
+
+    local orden = prefijo .. 'orden:' .. chat
+    local claves = redis.call('ZRANGE', orden, 0, maximo - 1)
+    local tomados = {chat}
+    if #claves > 0 then
+        local mensajes = redis.call('HMGET', prefijo .. 'msg:' .. chat, unpack(claves))
+        for i, clave in ipairs(claves) do
+            if mensajes[i] then
+                table.insert(tomados, clave)
+                table.insert(tomados, mensajes[i])
+            else
+                redis.call('ZREM', orden, clave)
+            end
+        end
+    end
+
+    if #claves == 0 then
+        redis.call('ZREM', KEYS[1], chat)
+    elseif #tomados > 1 then
+        local cubeta_chat = prefijo .. 'cubeta:' .. chat
+        local fichas_chat = cubeta(cubeta_chat, c_tasa, c_rafaga)
+        if fichas_chat < 1 then
+            redis.call('ZADD', KEYS[1], ahora + (1 - fichas_chat) / c_tasa, chat)
+        else
+            gastar(global, fichas_global, g_tasa, g_rafaga)
+            gastar(cubeta_chat, fichas_chat, c_tasa, c_rafaga)
+            redis.call('ZADD', KEYS[1], ahora + envio_ttl, chat)
+            return tomados
+        end
+    end
+end
+return {}
+"""
+
+# Borra los mensajes enviados (salvo los que haya reemplazado uno nuevo) y
+# deja el chat listo para el siguiente, o fuera de la agenda si no quedan.
+# ARGV: chat, ahora, y luego pares clave, mensaje.
+_LUA_CONFIRMAR = """
+local chat, ahora = ARGV[1], ARGV[2]
+for i = 3, #ARGV, 2 do
+    local clave, mensaje = ARGV[i], ARGV[i + 1]
+    if redis.call('HGET', KEYS[3], clave) == mensaje then
+        redis.call('HDEL', KEYS[3], clave)
+        redis.call('ZREM', KEYS[2], clave)
+    end
+end
+if redis.call('ZCARD', KEYS[2]) > 0 then
+    redis.call('ZADD', KEYS[1], ahora, chat)
+else
+    redis.call('ZREM', KEYS[1], chat)
+end
+"""
+
+# Guarda cada mensaje con su nuevo estado (si no lo reemplazaron) y
+# reprograma el chat. ARGV: chat, cuando, y luego clave, anterior, nuevo.
+_LUA_REPROGRAMAR = """
+local chat, cuando = ARGV[1], ARGV[2]
+for i = 3, #ARGV, 3 do
+    local clave, anterior, mensaje = ARGV[i], ARGV[i + 1], ARGV[i + 2]
+    if redis.call('HGET', KEYS[3], clave) == anterior then
+        redis.call('HSET', KEYS[3], clave, mensaje)
+    end
+end
+redis.call('ZADD', KEYS[1], cuando, chat)
+"""
+
+
+def _claves(chat_id):
+    return [CLAVE_AGENDA, f'{PREFIJO}orden:{chat_id}', f'{PREFIJO}msg:{chat_id}']
+
+
+_scripts = {}
+
+
+def _script(redis_conn, nombre, lua):
+    if nombre not in _scripts:
+        _scripts[nombre] = redis_conn.register_script(lua)
+    return _scripts[nombre]
+
+
+def construir_mensaje(texto, teclado=None, parse_mode='Markdown'):
+    """Parámetros de sendMessage (sin chat_id)"""
+    mensaje = {'text': texto, 'parse_mode': parse_mode}
+    if teclado is not None:
+        mensaje['reply_markup'] = json.dumps(teclado)
+    return mensaje
+
+
+def encolar(redis_conn, chat_id, clave, mensaje, pipeline=None):
+    """Deja el mensaje en la cola; con pipeline solo lo agrega a ese pipeline"""
+    claves = _claves(chat_id)
+    _script(redis_conn, 'encolar', _LUA_ENCOLAR)(
+        keys=[claves[1], claves[2], CLAVE_AGENDA],
+        args=[str(clave), json.dumps(mensaje), time.time(), chat_id],
+        client=pipeline
+    )
+
+
+def notificar(chat_id, clave, texto, teclado=None, parse_mode='Markdown'):
+    """
+    Deja un mensaje para chat_id en la cola del notificador. Si ya hay uno
+    pendiente con la misma clave, lo reemplaza. No lanza excepciones.
+
+    Returns:
+        True si quedó encolado (o se envió directo cuando no hay Redis)
+    """
+    mensaje = construir_mensaje(texto, teclado, parse_mode)
+
+    from queue_manager import redis_conn
+    if redis_conn is None:
+        # Sin Redis no hay cola: un intento directo, sin reintentos
+        try:
+            return enviar(chat_id, mensaje)[0] == 'ok'
+        except Exception as e:
+            logger.error(f"❌ Error enviando mensaje a chat_id={chat_id}: {e}")
+            return False
+
+    try:
+        encolar(redis_conn, chat_id, clave, mensaje)
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error encolando mensaje para chat_id={chat_id}: {e}")
+        return False
+
+
+def enviar(chat_id, mensaje):
+    """
+    Un sendMessage.
+
+    Returns:
+        ('ok', None), ('esperar', segundos) ante un 429, ('descartar', motivo)
+        si Telegram lo rechaza (chat bloqueado, texto inválido) o
+        ('reintentar', motivo) ante errores de red o 5xx
+    """
+    payload = {'chat_id': chat_id, **mensaje}
+    try:
+        response = get_session().post(
+            f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/sendMessage", json=payload, timeout=10
+        )
+    except requests.RequestException as e:
+        return 'reintentar', str(e)
+
+    if response.ok:
+        return 'ok', None
+    try:
+        datos = response.json()
+    except ValueError:
+        datos = {}
+    if response.status_code == 429:
+        return 'esperar', float(datos.get('parameters', {}).get('retry_after', 1))
+    if 400 <= response.status_code < 500:
+        return 'descartar', datos.get('description', response.status_code)
+    return 'reintentar', f"HTTP {response.status_code}"
+
+
+def _botones(mensaje):
+    if 'reply_markup' not in mensaje:
+        return []
+    return json.loads(mensaje['reply_markup']).get('inline_keyboard', [])
+
+
+def agrupar(partes):
+    """
+    Junta los mensajes de un chat en uno solo, en orden, mientras quepan en
+    un sendMessage y compartan parse_mode.
+
+    Args:
+        partes: lista de (clave, mensaje) con mensaje ya decodificado
+    Returns:
+        (mensaje a enviar, cuántas partes incluye)
+    """
+    if len(partes) == 1 or partes[0][1].get('solo'):
+        return {k: v for k, v in partes[0][1].items() if k != 'solo'}, 1
+
+    textos, filas, usadas = [], [], 0
+    largo = botones = 0
+    for clave, mensaje in partes:
+        if mensaje.get('solo') or mensaje.get('parse_mode') != partes[0][1].get('parse_mode'):
+            break
+        texto = f"🧾 Boleta #{clave}\n{mensaje['text']}"
+        propias = [
+            [{**boton, 'text': f"{boton['text']} #{clave}"} for boton in fila]
+            for fila in _botones(mensaje)
+        ]
+        n_botones = sum(len(fila) for fila in propias)
+        if usadas and (largo + len(texto) + 2 > TEXTO_MAX or botones + n_botones > BOTONES_MAX):
+            break
+        textos.append(texto)
+        filas.extend(propias)
+        largo += len(texto) + 2
+        botones += n_botones
+        usadas += 1
+
+    if usadas == 1:
+        return agrupar(partes[:1])
+
+    agrupado = {'text': '\n\n'.join(textos), 'parse_mode': partes[0][1].get('parse_mode')}
+    if filas:
+        agrupado['reply_markup'] = json.dumps({'inline_keyboard': filas})
+    return agrupado, usadas
+
+
+def _procesar(redis_conn, chat_id, tomados):
+    """tomados: lista de (clave, crudo) del chat, en orden de llegada"""
+    partes = [(clave, json.loads(crudo)) for clave, crudo in tomados]
+    mensaje, usadas = agrupar(partes)
+    enviados = tomados[:usadas]
+    intentos = max(partes[i][1].get('intentos', 0) for i in range(usadas))
+    mensaje.pop('intentos', None)
+    descripcion = ', '.join(clave for clave, _ in enviados)
+
+    inicio = time.monotonic()
+    resultado, detalle = enviar(int(chat_id), mensaje)
+    metricas.observar('telegram_envio', time.monotonic() - inicio)
+
+    claves = _claves(chat_id)
+    if resultado == 'ok':
+        logger.info(f"📨 Mensaje enviado a chat_id={chat_id} ({descripcion})")
+    elif resultado == 'descartar' and usadas > 1:
+        # Una parte inválida no debe perder las demás: se reenvían de a una
+        logger.warning(f"⚠️ Mensaje agrupado rechazado (chat_id={chat_id}): {detalle}; se envían por separado")
+        _reprogramar(redis_conn, chat_id, enviados, partes, {'solo': True}, time.time())
+        return
+    elif resultado == 'descartar' or intentos + 1 >= NOTIF_MAX_INTENTOS:
+        logger.error(f"❌ Mensaje a chat_id={chat_id} descartado ({descripcion}): {detalle}")
+    else:
+        if resultado == 'esperar':
+            espera = detalle
+            logger.warning(f"🐢 Telegram pide esperar {espera:.0f}s (chat_id={chat_id})")
+        else:
+            espera = min(2 ** intentos, ESPERA_MAX)
+            logger.warning(f"⚠️ Error enviando a chat_id={chat_id}, reintento en {espera}s: {detalle}")
+            intentos += 1
+        _reprogramar(redis_conn, chat_id, enviados, partes, {'intentos': intentos}, time.time() + espera)
+        return
+
+    args = [chat_id, time.time()]
+    for clave, crudo in enviados:
+        args += [clave, crudo]
+    _script(redis_conn, 'confirmar', _LUA_CONFIRMAR)(keys=claves, args=args)
+
+
+def _reprogramar(redis_conn, chat_id, enviados, partes, cambios, cuando):
+    """Guarda 'cambios' en cada mensaje enviado y reprograma el chat para 'cuando'"""
+    args = [chat_id, cuando]
+    for (clave, crudo), (_, mensaje) in zip(enviados, partes):
+        args += [clave, crudo, json.dumps({**mensaje, **cambios})]
+    _script(redis_conn, 'reprogramar', _LUA_REPROGRAMAR)(keys=_claves(chat_id), args=args)
+
+
+def _procesar_seguro(redis_conn, chat_id, tomados):
+    try:
+        _procesar(redis_conn, chat_id, tomados)
+    except Exception as e:
+        # El chat queda reprogramado a ENVIO_TTL y el mensaje se reintenta solo
+        logger.error(f"❌ Error procesando mensaje para chat_id={chat_id}: {e}")
+
+
+def servir(redis_conn=None, detener=None, relevo=True):
+    """
+    Bucle del notificador: toma mensajes vencidos y los envía con
+    NOTIF_HILOS hilos. Con relevo, además drena la bandeja de salida de
+    Postgres (bandeja_salida.py) en otro hilo.
+    """
+    if redis_conn is None:
+        from queue_manager import redis_conn
+    if redis_conn is None:
+        raise RuntimeError("El notificador necesita Redis")
+    detener = detener or threading.Event()
+
+    if relevo:
+        import bandeja_salida
+        bandeja_salida.iniciar_relevo(redis_conn, detener)
+
+    tomar = _script(redis_conn, 'tomar', _LUA_TOMAR)
+    cupos = threading.BoundedSemaphore(NOTIF_HILOS)
+    ultimo_volcado = time.monotonic()
+    logger.info(f"📬 Notificador iniciado ({NOTIF_GLOBAL_POR_SEG:g} msg/s, {NOTIF_CHAT_POR_SEG:g} msg/s por chat)")
+
+    with ThreadPoolExecutor(max_workers=NOTIF_HILOS, thread_name_prefix='notif') as pool:
+        while not detener.is_set():
+            if time.monotonic() - ultimo_volcado >= metricas.METRICAS_INTERVALO:
+                metricas.volcar()
+                ultimo_volcado = time.monotonic()
+
+            cupos.acquire()
+            try:
+                resultado = tomar(
+                    keys=[CLAVE_AGENDA],
+                    args=[time.time(), PREFIJO, ENVIO_TTL,
+                          NOTIF_GLOBAL_POR_SEG, NOTIF_GLOBAL_RAFAGA, NOTIF_CHAT_POR_SEG, NOTIF_CHAT_RAFAGA,
+                          NOTIF_AGRUPAR_MAX]
+                )
+            except Exception as e:
+                cupos.release()
+                logger.error(f"❌ Error leyendo la cola de mensajes: {e}")
+                detener.wait(1)
+                continue
+
+            if len(resultado) < 3:
+                cupos.release()
+                espera = float(resultado[1]) if len(resultado) == 2 else INTERVALO_SONDEO
+                detener.wait(min(espera, INTERVALO_SONDEO))
+                continue
+
+            chat_id, *resto = (r.decode() for r in resultado)
+            tomados = list(zip(resto[::2], resto[1::2]))
+            futuro = pool.submit(_procesar_seguro, redis_conn, chat_id, tomados)
+            futuro.add_done_callback(lambda _: cupos.release())
+
+    metricas.volcar()
+
+
+def get_info():
+    """Chats con mensajes pendientes, para monitoreo"""
+    from queue_manager import redis_conn
+    if redis_conn is None:
+        return {'error': 'Redis no disponible'}
+    return {
+        'chats': redis_conn.zcard(CLAVE_AGENDA),
+        'vencidos': redis_conn.zcount(CLAVE_AGENDA, '-inf', time.time()),
+    }
+
+
+if __name__ == '__main__':
+    import signal
+
+    detener = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: detener.set())
+    try:
+        servir(detener=detener)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,122 @@
+"""
+Caché de resultados OCR en Redis, indexada por el SHA-256 de la imagen
+
+Evita repetir la llamada a n8n cuando llega la misma foto (reintentos de
+RQ, botón 🔄 Reintentar, boletas reenviadas). Cada entrada expira tras
+OCR_CACHE_TTL segundos y la caché nunca supera OCR_CACHE_MAX entradas
+(se descartan las más antiguas).
+"""
+import os
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+OCR_CACHE_TTL = int(os.getenv('OCR_CACHE_TTL', str(7 * 24 * 3600)))
+OCR_CACHE_MAX = int(os.getenv('OCR_CACHE_MAX', '10000'))
+
+PREFIJO = 'ocr:cache:'
+INDICE = 'ocr:cache:indice'
+HITS = 'ocr:cache:hits'
+MISSES = 'ocr:cache:misses'
+
+# GET + contador de hit/miss en un solo round trip
+_LUA_OBTENER = """
+local valor = redis.call('GET', KEYS[1])
+if valor then
+    redis.call('INCR', KEYS[2])
+else
+    redis.call('INCR', KEYS[3])
+end
+return valor
+"""
+
+# SET con TTL + índice por antigüedad + recorte al tamaño máximo
+_LUA_GUARDAR = """
+redis.call('SET', KEYS[1], ARGV[1], 'EX', ARGV[2])
+redis.call('ZADD', KEYS[2], ARGV[3], KEYS[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[3] - ARGV[2])
+local sobrantes = redis.call('ZCARD', KEYS[2]) - tonumber(ARGV[4])
+if sobrantes > 0 then
+    local viejas = redis.call('ZPOPMIN', KEYS[2], sobrantes)
+    for i = 1, #viejas, 2 do
+        redis.call('DEL', viejas[i])
+    end
+end
+return sobrantes
+"""
+
+_scripts = {}
+
+
+def _redis():
+    from queue_manager import redis_conn
+    return redis_conn
+
+
+def _script(nombre, codigo):
+    if nombre not in _scripts:
+        _scripts[nombre] = _redis().register_script(codigo)
+    return _scripts[nombre]
+
+
+def _key(imagen_clave):
+    return PREFIJO + imagen_clave
+
+
+def obtener(imagen_clave):
+    """Retorna el ocr_data cacheado o None. Nunca lanza: la caché es opcional."""
+    if _redis() is None or not imagen_clave:
+        return None
+
+    try:
+        valor = _script('obtener', _LUA_OBTENER)(keys=[_key(imagen_clave), HITS, MISSES])
+    except Exception as e:
+        logger.warning(f"⚠️ Caché OCR no disponible: {e}")
+        return None
+
+    if valor is None:
+        logger.info(f"🔍 Caché OCR miss: {imagen_clave}")
+        return None
+
+    logger.info(f"⚡ Caché OCR hit: {imagen_clave}")
+    return json.loads(valor)
+
+
+def guardar(imagen_clave, ocr_data):
+    """Guarda un resultado OCR válido"""
+    if _redis() is None or not imagen_clave or not ocr_data:
+        return
+
+    try:
+        _script('guardar', _LUA_GUARDAR)(
+            keys=[_key(imagen_clave), INDICE],
+            args=[json.dumps(ocr_data), OCR_CACHE_TTL, time.time(), OCR_CACHE_MAX]
+        )
+    except Exception as e:
+        logger.warning(f"⚠️ No se pudo guardar en caché OCR: {e}")
+
+
+def get_cache_info():
+    """Retorna contadores de la caché"""
+    redis_conn = _redis()
+    if redis_conn is None:
+        return {'error': 'Redis no disponible'}
+
+    try:
+        pipe = redis_conn.pipeline()
+        pipe.get(HITS)
+        pipe.get(MISSES)
+        pipe.zcard(INDICE)
+        hits, misses, entradas = pipe.execute()
+        hits, misses = int(hits or 0), int(misses or 0)
+        total = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_ratio': hits / total if total else 0.0,
+            'entradas': entradas
+        }
+    except Exception as e:
+        return {'error': str(e)}
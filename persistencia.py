@@ -0,0 +1,339 @@
+"""
+Persistencia del bot en Redis (user_data, chat_data y estados del ConversationHandler)
+
+Así un reinicio no pierde la conversación en curso ni las marcas
+esperando_*_editar / esperando_monto_manual de context.user_data.
+
+PTB llama a update_* cada PERSISTENCIA_INTERVALO segundos con todo lo que
+cambió desde la vez anterior. Esas llamadas solo anotan el cambio en
+memoria y una tarea los escribe todos juntos en un solo pipeline, así que
+ningún update espera un round trip a Redis. Al detener el bot, flush()
+escribe lo que quede pendiente.
+
+Con varias réplicas (webhook.py) cada una tiene en memoria user_data,
+chat_data y los estados de las conversaciones. Para que un update que
+llega a otra réplica vea lo que hizo la primera:
+
+- Cada volcado publica en {prefijo}:cambios qué campos escribió, en el
+  mismo pipeline. Cada réplica escucha el canal y anota como "sucios"
+  los campos que escribieron las demás.
+- sincronizar() corre antes que los demás handlers (TypeHandler del
+  grupo -1, ver main.py) y relee en un solo pipeline el user_data, el
+  chat_data y el estado de cada ConversationHandler persistente del
+  update, solo si alguno está sucio o esta réplica nunca lo leyó. En el
+  caso común no hay ningún round trip. No pisa cambios propios que aún
+  no llegaron a Redis.
+- Si la suscripción se corta, al reconectar todo lo leído se marca sucio.
+
+PTB consulta el estado de la conversación en check_update, antes de
+refresh_user_data/refresh_chat_data; por eso la relectura va en un
+handler previo y no en los refresh_*. Límite que queda: dos réplicas que
+cambian al mismo usuario dentro del mismo PERSISTENCIA_INTERVALO, o
+antes de que llegue la notificación: gana la última escritura.
+
+Claves (prefijo PERSISTENCIA_PREFIJO):
+    {prefijo}:user_data             hash user_id -> JSON
+    {prefijo}:chat_data             hash chat_id -> JSON
+    {prefijo}:bot_data              JSON
+    {prefijo}:callback_data         JSON
+    {prefijo}:conv:{nombre}         hash JSON(clave) -> JSON(estado)
+    {prefijo}:cambios               canal pub/sub de campos escritos
+"""
+import os
+import json
+import uuid
+import asyncio
+import logging
+
+from redis import asyncio as aioredis
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput
+
+from queue_manager import REDIS_URL
+
+logger = logging.getLogger(__name__)
+
+PERSISTENCIA_PREFIJO = os.getenv('PERSISTENCIA_PREFIJO', 'bot')
+PERSISTENCIA_INTERVALO = float(os.getenv('PERSISTENCIA_INTERVALO', '5'))
+
+_BORRAR = object()
+
+
+class RedisPersistence(BasePersistence):
+    def __init__(self, url=REDIS_URL, prefijo=PERSISTENCIA_PREFIJO, update_interval=PERSISTENCIA_INTERVALO):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.redis = aioredis.from_url(url)
+        self.prefijo = prefijo
+        # clave redis -> {campo: valor JSON o _BORRAR}; None como campo = clave completa
+        self._pendientes = {}
+        self._tarea = None
+        # (nombre, campo) -> JSON que esta réplica leyó o escribió por última vez
+        self._vistos = {}
+        # (nombre, campo) escritos por otra réplica después de leerlos
+        self._sucios = set()
+        self._replica = uuid.uuid4().hex
+        self._escucha = None
+
+    def _clave(self, *partes):
+        return ':'.join((self.prefijo,) + partes)
+
+    # -------------------------------------------------------------------------
+    # Escritura diferida
+    # -------------------------------------------------------------------------
+
+    def _anotar(self, clave, campo, valor):
+        self._pendientes.setdefault(clave, {})[campo] = valor
+        if self._tarea is None or self._tarea.done():
+            # Corre después de las demás update_* de esta pasada: un pipeline por pasada
+            self._tarea = asyncio.ensure_future(self._volcar())
+
+    async def _volcar(self):
+        if not self._pendientes:
+            return
+        pendientes, self._pendientes = self._pendientes, {}
+
+        pipe = self.redis.pipeline(transaction=False)
+        cambiados = []
+        for clave, campos in pendientes.items():
+            for campo, valor in campos.items():
+                if campo is None:
+                    pipe.set(clave, valor)
+                    continue
+                if valor is _BORRAR:
+                    pipe.hdel(clave, campo)
+                else:
+                    pipe.hset(clave, campo, valor)
+                cambiados.append((clave[len(self.prefijo) + 1:], campo))
+        if cambiados:
+            pipe.publish(self._clave('cambios'), json.dumps({'replica': self._replica, 'campos': cambiados}))
+
+        try:
+            await pipe.execute()
+        except Exception as e:
+            logger.error(f"❌ Error guardando persistencia en Redis: {e}")
+            # Se reintenta en la próxima pasada sin pisar cambios más nuevos
+            for clave, campos in pendientes.items():
+                nuevos = self._pendientes.setdefault(clave, {})
+                for campo, valor in campos.items():
+                    nuevos.setdefault(campo, valor)
+
+    async def flush(self):
+        if self._tarea is not None:
+            await self._tarea
+        await self._volcar()
+        if self._escucha is not None:
+            self._escucha.cancel()
+        await self.redis.aclose()
+
+    # -------------------------------------------------------------------------
+    # Cambios de otras réplicas
+    # -------------------------------------------------------------------------
+
+    async def _iniciar_escucha(self):
+        """Se suscribe antes de la primera lectura: ningún cambio queda entre medio"""
+        if self._escucha is not None:
+            return
+        suscripcion = self.redis.pubsub(ignore_subscribe_messages=True)
+        await suscripcion.subscribe(self._clave('cambios'))
+        self._escucha = asyncio.ensure_future(self._escuchar(suscripcion))
+
+    async def _escuchar(self, suscripcion):
+        while True:
+            try:
+                async for mensaje in suscripcion.listen():
+                    if mensaje['type'] != 'message':
+                        continue
+                    aviso = json.loads(mensaje['data'])
+                    if aviso['replica'] != self._replica:
+                        self._sucios.update(tuple(campo) for campo in aviso['campos'])
+            except asyncio.CancelledError:
+                await suscripcion.aclose()
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Suscripción a cambios de persistencia cortada: {e}")
+                await asyncio.sleep(1)
+                try:
+                    await suscripcion.aclose()
+                    suscripcion = self.redis.pubsub(ignore_subscribe_messages=True)
+                    await suscripcion.subscribe(self._clave('cambios'))
+                except Exception:
+                    continue
+                # Lo que cambió mientras no escuchábamos
+                self._sucios.update(self._vistos)
+
+    # -------------------------------------------------------------------------
+    # Lectura al iniciar
+    # -------------------------------------------------------------------------
+
+    async def _leer_hash(self, nombre):
+        await self._iniciar_escucha()
+        datos = await self.redis.hgetall(self._clave(nombre))
+        resultado = {}
+        for k, v in datos.items():
+            resultado[int(k)] = json.loads(v)
+            self._vistos[(nombre, k.decode())] = json.dumps(resultado[int(k)])
+        return resultado
+
+    async def get_user_data(self):
+        return await self._leer_hash('user_data')
+
+    async def get_chat_data(self):
+        return await self._leer_hash('chat_data')
+
+    async def get_bot_data(self):
+        datos = await self.redis.get(self._clave('bot_data'))
+        return json.loads(datos) if datos else {}
+
+    async def get_callback_data(self):
+        datos = await self.redis.get(self._clave('callback_data'))
+        if not datos:
+            return None
+        mensajes, botones = json.loads(datos)
+        return [tuple(m) for m in mensajes], botones
+
+    async def get_conversations(self, name):
+        await self._iniciar_escucha()
+        datos = await self.redis.hgetall(self._clave('conv', name))
+        for k, v in datos.items():
+            self._vistos[(f'conv:{name}', k.decode())] = json.dumps(json.loads(v))
+        return {tuple(json.loads(k)): json.loads(v) for k, v in datos.items()}
+
+    # -------------------------------------------------------------------------
+    # Actualización
+    # -------------------------------------------------------------------------
+
+    def _actualizar(self, nombre, id_, data):
+        valor = json.dumps(data)
+        self._vistos[(nombre, str(id_))] = valor
+        self._anotar(self._clave(nombre), str(id_), valor)
+
+    async def update_user_data(self, user_id, data):
+        self._actualizar('user_data', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        self._actualizar('chat_data', chat_id, data)
+
+    async def update_bot_data(self, data):
+        self._anotar(self._clave('bot_data'), None, json.dumps(data))
+
+    async def update_callback_data(self, data):
+        self._anotar(self._clave('callback_data'), None, json.dumps(data))
+
+    async def update_conversation(self, name, key, new_state):
+        campo = json.dumps(list(key))
+        self._vistos[(f'conv:{name}', campo)] = json.dumps(new_state)
+        valor = _BORRAR if new_state is None else json.dumps(new_state)
+        self._anotar(self._clave('conv', name), campo, valor)
+
+    async def drop_user_data(self, user_id):
+        self._vistos.pop(('user_data', str(user_id)), None)
+        self._anotar(self._clave('user_data'), str(user_id), _BORRAR)
+
+    async def drop_chat_data(self, chat_id):
+        self._vistos.pop(('chat_data', str(chat_id)), None)
+        self._anotar(self._clave('chat_data'), str(chat_id), _BORRAR)
+
+    # -------------------------------------------------------------------------
+    # Relectura antes de cada update (varias réplicas)
+    # -------------------------------------------------------------------------
+
+    def _hay_que_leer(self, nombre, campo, local_json, vacio):
+        if campo in self._pendientes.get(self._clave(nombre), {}):
+            # Escritura propia aún no volcada: es más nueva que Redis
+            return False
+        if local_json != self._vistos.get((nombre, campo), vacio):
+            # Cambios de esta réplica que PTB aún no pasó a update_*
+            return False
+        return (nombre, campo) in self._sucios or (nombre, campo) not in self._vistos
+
+    async def sincronizar(self, update, context):
+        """
+        Callback del TypeHandler del grupo -1: antes de que los demás
+        handlers vean el update, trae de Redis en un solo pipeline lo que
+        otra réplica cambió del usuario, del chat y de sus conversaciones.
+        """
+        if not isinstance(update, Update):
+            return
+
+        # (nombre, campo, aplicar) de lo que hay que leer; aplicar(remoto) retorna lo que quedó en memoria
+        lecturas = []
+        for nombre, id_, datos in (('user_data', update.effective_user, context.user_data),
+                                   ('chat_data', update.effective_chat, context.chat_data)):
+            if id_ is None or datos is None:
+                continue
+            campo = str(id_.id)
+            if self._hay_que_leer(nombre, campo, json.dumps(datos), '{}'):
+                lecturas.append((nombre, campo, self._reemplazar_datos(datos)))
+
+        for handlers in context.application.handlers.values():
+            for handler in handlers:
+                if isinstance(handler, ConversationHandler) and handler.persistent:
+                    lectura = self._lectura_conversacion(handler, update)
+                    if lectura:
+                        lecturas.append(lectura)
+
+        if not lecturas:
+            return
+        # Antes de leer: un cambio que llegue durante la lectura vuelve a marcarlo
+        self._sucios.difference_update((nombre, campo) for nombre, campo, _ in lecturas)
+
+        pipe = self.redis.pipeline(transaction=False)
+        for nombre, campo, _ in lecturas:
+            pipe.hget(self._clave(nombre), campo)
+        try:
+            crudos = await pipe.execute()
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudo releer la persistencia de Redis: {e}")
+            self._sucios.update((nombre, campo) for nombre, campo, _ in lecturas)
+            return
+
+        for (nombre, campo, aplicar), crudo in zip(lecturas, crudos):
+            aplicado = aplicar(json.loads(crudo) if crudo else None)
+            self._vistos[(nombre, campo)] = json.dumps(aplicado)
+
+    @staticmethod
+    def _reemplazar_datos(datos):
+        def aplicar(remoto):
+            datos.clear()
+            datos.update(remoto or {})
+            return datos
+        return aplicar
+
+    def _lectura_conversacion(self, handler, update):
+        # PTB no expone la clave ni los estados de un ConversationHandler
+        try:
+            clave = handler._get_key(update)
+        except RuntimeError:
+            return None
+        conversaciones = handler._conversations
+        try:
+            local_json = json.dumps(conversaciones.get(clave))
+        except TypeError:
+            # PendingState: un callback no bloqueante sigue corriendo aquí
+            return None
+
+        nombre, campo = f'conv:{handler.name}', json.dumps(list(clave))
+        if not self._hay_que_leer(nombre, campo, local_json, 'null'):
+            return None
+
+        def aplicar(remoto):
+            if remoto is None:
+                # Sin registrar escritura, como update_no_track: Redis ya no la tiene
+                conversaciones.data.pop(clave, None)
+            else:
+                conversaciones.update_no_track({clave: remoto})
+            return remoto
+        return nombre, campo, aplicar
+
+    # sincronizar() ya releyó antes de que PTB llegue a estos
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
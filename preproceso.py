@@ -0,0 +1,116 @@
+"""
+Preprocesamiento de fotos de boletas antes del OCR
+
+El bot elige el tamaño de Telegram más pequeño que alcanza la resolución
+objetivo y el worker aplica la cadena IMG_PIPELINE antes de subir a n8n:
+
+    escala       reduce el lado mayor a IMG_LADO_OBJETIVO
+    grises       convierte a escala de grises
+    recorte      quita los bordes de color uniforme (mesa, fondo)
+    recomprimir  guarda como JPEG con calidad IMG_CALIDAD_JPEG
+"""
+import io
+import os
+import logging
+
+from PIL import Image, ImageChops, ImageOps
+
+logger = logging.getLogger(__name__)
+
+IMG_PIPELINE = [p.strip() for p in os.getenv('IMG_PIPELINE', 'escala,grises,recorte,recomprimir').split(',') if p.strip()]
+IMG_LADO_OBJETIVO = int(os.getenv('IMG_LADO_OBJETIVO', '1280'))
+IMG_CALIDAD_JPEG = int(os.getenv('IMG_CALIDAD_JPEG', '75'))
+# Diferencia mínima de luminancia respecto al borde para considerar que hay contenido
+IMG_UMBRAL_RECORTE = int(os.getenv('IMG_UMBRAL_RECORTE', '24'))
+MARGEN_RECORTE = 8
+
+
+def elegir_tamano(photos, lado_objetivo=IMG_LADO_OBJETIVO):
+    """
+    Elige el PhotoSize más pequeño cuyo lado mayor alcanza lado_objetivo.
+    Si ninguno llega, retorna el más grande.
+    """
+    ordenadas = sorted(photos, key=lambda p: p.width * p.height)
+    for photo in ordenadas:
+        if max(photo.width, photo.height) >= lado_objetivo:
+            return photo
+    return ordenadas[-1]
+
+
+def _escala(img):
+    if max(img.size) > IMG_LADO_OBJETIVO:
+        img = img.copy()
+        img.thumbnail((IMG_LADO_OBJETIVO, IMG_LADO_OBJETIVO), Image.LANCZOS)
+    return img
+
+
+def _grises(img):
+    return img.convert('L')
+
+
+def _recorte(img):
+    gris = img.convert('L')
+    fondo = Image.new('L', gris.size, gris.getpixel((0, 0)))
+    diferencia = ImageChops.difference(gris, fondo).point(lambda v: 255 if v > IMG_UMBRAL_RECORTE else 0)
+    caja = diferencia.getbbox()
+    if not caja:
+        return img
+
+    izq, arriba, der, abajo = caja
+    caja = (
+        max(izq - MARGEN_RECORTE, 0),
+        max(arriba - MARGEN_RECORTE, 0),
+        min(der + MARGEN_RECORTE, img.width),
+        min(abajo + MARGEN_RECORTE, img.height),
+    )
+    return img.crop(caja)
+
+
+PASOS = {
+    'escala': _escala,
+    'grises': _grises,
+    'recorte': _recorte,
+}
+
+
+def preprocesar(image_bytes, pipeline=None):
+    """
+    Aplica la cadena de preprocesamiento
+
+    Returns:
+        (bytes a enviar, estadísticas). Si algo falla o el resultado pesa más
+        que el original, retorna el original.
+    """
+    pipeline = IMG_PIPELINE if pipeline is None else pipeline
+    stats = {'bytes_antes': len(image_bytes), 'bytes_despues': len(image_bytes), 'pasos': []}
+    if not pipeline:
+        return image_bytes, stats
+
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as original:
+            img = ImageOps.exif_transpose(original)
+            stats['dimensiones_antes'] = img.size
+
+            for paso in pipeline:
+                if paso in PASOS:
+                    img = PASOS[paso](img)
+                elif paso != 'recomprimir':
+                    logger.warning(f"⚠️ Paso de preprocesamiento desconocido: {paso}")
+                    continue
+                stats['pasos'].append(paso)
+
+            salida = io.BytesIO()
+            calidad = IMG_CALIDAD_JPEG if 'recomprimir' in pipeline else 95
+            img.convert('L' if img.mode == 'L' else 'RGB').save(salida, 'JPEG', quality=calidad, optimize=True)
+            stats['dimensiones_despues'] = img.size
+
+    except Exception as e:
+        logger.warning(f"⚠️ Preprocesamiento falló, se usa la imagen original: {e}")
+        return image_bytes, stats
+
+    procesada = salida.getvalue()
+    if len(procesada) >= len(image_bytes):
+        return image_bytes, stats
+
+    stats['bytes_despues'] = len(procesada)
+    return procesada, stats
@@ -0,0 +1,68 @@
+"""
+Procesamiento concurrente de updates con orden garantizado por chat
+
+Updates de chats distintos se procesan en paralelo (hasta
+BOT_MAX_CONCURRENCIA a la vez); los de un mismo chat, uno tras otro y en el
+orden en que llegaron, así el ConversationHandler y las marcas de
+context.user_data (esperando_monto_editar, etc.) siguen consistentes.
+"""
+import os
+import asyncio
+import logging
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+BOT_MAX_CONCURRENCIA = int(os.getenv('BOT_MAX_CONCURRENCIA', '64'))
+
+# process_update() de PTB toma su semáforo antes de do_process_update: con el
+# límite real ahí, los updates en espera de un mismo chat ocuparían cupos y
+# frenarían a los demás. El límite global se aplica después del lock del chat.
+_SIN_LIMITE = 1_000_000
+
+
+class ProcesadorPorChat(BaseUpdateProcessor):
+    def __init__(self, max_concurrencia=BOT_MAX_CONCURRENCIA):
+        super().__init__(_SIN_LIMITE)
+        self.max_concurrencia = max_concurrencia
+        self._cupos = None
+        self._locks = {}
+        self._esperando = {}
+
+    @staticmethod
+    def _clave(update):
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        clave = self._clave(update)
+        if clave is None:
+            async with self._cupos:
+                await coroutine
+            return
+
+        # asyncio.Lock atiende a los que esperan en orden de llegada (FIFO)
+        lock = self._locks.setdefault(clave, asyncio.Lock())
+        self._esperando[clave] = self._esperando.get(clave, 0) + 1
+        try:
+            async with lock:
+                async with self._cupos:
+                    await coroutine
+        finally:
+            self._esperando[clave] -= 1
+            if not self._esperando[clave]:
+                del self._esperando[clave]
+                del self._locks[clave]
+
+    async def initialize(self):
+        self._cupos = asyncio.Semaphore(self.max_concurrencia)
+
+    async def shutdown(self):
+        self._locks.clear()
+        self._esperando.clear()
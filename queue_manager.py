@@ -1,9 +1,29 @@
 """
 Sistema de colas con Redis para procesar fotos de boletas
+
+Reparto justo por usuario: encolar_foto deja el job (status deferred) en
+el carril del usuario y solo pasa a la cola 'fotos' cuando el usuario
+tiene menos de FOTOS_MAX_EN_VUELO jobs en vuelo. Los usuarios con jobs
+esperando se atienden por turnos (round-robin), así 50 boletas de una
+persona no dejan atrás a las demás. Cada job que termina libera su cupo
+(liberar) y despacha al siguiente; uno que RQ va a reintentar lo
+conserva (retener).
+
+Los reintentos pedidos por el usuario van a 'fotos_prioridad', que los
+workers atienden antes que 'fotos'.
+
+    fotos:usuarios            lista round-robin de usuarios con jobs esperando
+    fotos:carril:{user_id}    job ids esperando turno (FIFO)
+    fotos:en_vuelo:{user_id}  zset job id -> vencimiento del cupo
+    fotos:gasto:{gasto_id}    job id del gasto; el barrido (barrido.py) no vuelve
+                              a encolar gastos cuyo job sigue vigente (con_marca)
 """
 import os
+import time
+from datetime import timedelta
 from redis import Redis
 from rq import Queue, Retry
+from rq.job import Job, JobStatus
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -21,18 +41,84 @@ except Exception as e:
     logger.error(f"❌ Error conectando a Redis: {e}")
     redis_conn = None
 
+# Máximo de jobs de un mismo usuario en la cola o ejecutándose
+FOTOS_MAX_EN_VUELO = int(os.getenv('FOTOS_MAX_EN_VUELO', '2'))
+JOB_TIMEOUT = 300
+# Un cupo que nadie liberó (worker muerto) vence solo tras este tiempo
+CUPO_TTL = JOB_TIMEOUT + 60
+PREFIJO = 'fotos:'
+CLAVE_USUARIOS = PREFIJO + 'usuarios'
+# Solo debe sobrevivir a la ventana del barrido (BARRIDO_MAX_HORAS): que el job
+# siga vigente se decide por su estado en RQ, no por el TTL de la marca
+MARCA_TTL = 3 * 24 * 3600
+# Estados de un job que todavía va a correr o está corriendo
+ESTADOS_VIGENTES = {JobStatus.DEFERRED, JobStatus.QUEUED, JobStatus.SCHEDULED, JobStatus.STARTED}
+
 # Cola principal para procesamiento de fotos
-foto_queue = Queue('fotos', connection=redis_conn, default_timeout=300) if redis_conn else None
+foto_queue = Queue('fotos', connection=redis_conn, default_timeout=JOB_TIMEOUT) if redis_conn else None
+# Reintentos interactivos: los workers la vacían antes que 'fotos'
+prioridad_queue = Queue('fotos_prioridad', connection=redis_conn, default_timeout=JOB_TIMEOUT) if redis_conn else None
+
+# Agrega el job al carril; el usuario entra a la ronda si su carril estaba vacío
+_LUA_AGREGAR = """
+if redis.call('RPUSH', KEYS[1], ARGV[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[2])
+end
+"""
+
+# Una vuelta por la ronda: cada usuario con cupo entrega su job más antiguo.
+# Termina al despachar ARGV[4] jobs o tras recorrer la ronda sin despachar nada.
+_LUA_DESPACHAR = """
+local prefijo, ahora, ttl, cupo, maximo = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local despachados = {}
+local sin_despachar = 0
+while #despachados < maximo and sin_despachar < redis.call('LLEN', KEYS[1]) do
+    local usuario = redis.call('LPOP', KEYS[1])
+    local carril = prefijo .. 'carril:' .. usuario
+    local en_vuelo = prefijo .. 'en_vuelo:' .. usuario
+    redis.call('ZREMRANGEBYSCORE', en_vuelo, '-inf', ahora)
 
-def encolar_foto(gasto_id, image_base64, chat_id, user_id):
+    local job_id = false
+    if redis.call('ZCARD', en_vuelo) < cupo then
+        job_id = redis.call('LPOP', carril)
+    end
+    if job_id then
+        redis.call('ZADD', en_vuelo, ahora + ttl, job_id)
+        redis.call('EXPIRE', en_vuelo, ttl)
+        table.insert(despachados, job_id)
+        sin_despachar = 0
+    else
+        sin_despachar = sin_despachar + 1
+    end
+
+    if redis.call('LLEN', carril) > 0 then
+        redis.call('RPUSH', KEYS[1], usuario)
+    end
+end
+return despachados
+"""
+
+if redis_conn:
+    _agregar = redis_conn.register_script(_LUA_AGREGAR)
+    _despachar = redis_conn.register_script(_LUA_DESPACHAR)
+
+def _opciones():
+    return dict(
+        retry=Retry(max=3, interval=[10, 30, 60]),  # 3 reintentos: 10s, 30s, 60s
+        job_timeout=JOB_TIMEOUT,  # Timeout de 5 minutos
+        failure_ttl=3600  # Guardar info de fallos por 1 hora
+    )
+
+def encolar_foto(gasto_id, imagen_ref, chat_id, user_id, prioridad=False):
     """
     Encola un trabajo para procesar una foto
 
     Args:
         gasto_id: ID del registro en PostgreSQL
-        image_base64: Imagen en formato base64
+        imagen_ref: Referencia a la imagen (file_id de Telegram); el worker la descarga
         chat_id: ID del chat de Telegram
         user_id: ID del usuario de Telegram
+        prioridad: reintento pedido por el usuario; va directo a 'fotos_prioridad'
 
     Returns:
         Job object de RQ o None si falla
@@ -42,22 +128,172 @@ def encolar_foto(gasto_id, image_base64, chat_id, user_id):
         return None
 
     try:
-        job = foto_queue.enqueue(
-            'worker.procesar_foto_job',  # Función que ejecutará el worker
-            gasto_id,
-            image_base64,
-            chat_id,
-            user_id,
-            retry=Retry(max=3, interval=[10, 30, 60]),  # 3 reintentos: 10s, 30s, 60s
-            job_timeout=300,  # Timeout de 5 minutos
-            failure_ttl=3600  # Guardar info de fallos por 1 hora
-        )
-        logger.info(f"✅ Job encolado: {job.id} para gasto_id={gasto_id}")
+        opciones = _opciones()
+        args = (gasto_id, imagen_ref, chat_id, user_id)
+
+        if prioridad:
+            job = prioridad_queue.enqueue('worker.procesar_foto_job', *args, **opciones)
+            redis_conn.set(_clave_marca(gasto_id), job.id, ex=MARCA_TTL)
+            logger.info(f"⚡ Job prioritario encolado: {job.id} para gasto_id={gasto_id}")
+            return job
+
+        job = _crear_job(args, opciones)
+        with redis_conn.pipeline() as pipe:
+            _al_carril(pipe, job, gasto_id, user_id)
+            pipe.execute()
+
+        logger.info(f"✅ Job en carril de {user_id}: {job.id} para gasto_id={gasto_id}")
+        despachar()
         return job
     except Exception as e:
         logger.error(f"❌ Error encolando job: {e}")
         return None
 
+def _clave_marca(gasto_id):
+    return f'{PREFIJO}gasto:{gasto_id}'
+
+def _crear_job(args, opciones):
+    return foto_queue.create_job(
+        'worker.procesar_foto_job',  # Función que ejecutará el worker
+        args=args,
+        timeout=opciones['job_timeout'],
+        failure_ttl=opciones['failure_ttl'],
+        retry=opciones['retry'],
+        status=JobStatus.DEFERRED,
+    )
+
+def _al_carril(pipe, job, gasto_id, user_id):
+    """Guarda el job deferred, lo pone en el carril del usuario y marca el gasto"""
+    job.save(pipeline=pipe)
+    _agregar(keys=[f'{PREFIJO}carril:{user_id}', CLAVE_USUARIOS], args=[job.id, user_id], client=pipe)
+    pipe.set(_clave_marca(gasto_id), job.id, ex=MARCA_TTL)
+
+def encolar_lote(fotos):
+    """
+    Encola varias fotos en un solo pipeline (cada una a su carril) y despacha.
+
+    Args:
+        fotos: lista de (gasto_id, imagen_ref, chat_id, user_id)
+    Returns:
+        Cantidad encolada
+    """
+    if redis_conn is None or foto_queue is None or not fotos:
+        return 0
+
+    opciones = _opciones()
+    with redis_conn.pipeline() as pipe:
+        for args in fotos:
+            _al_carril(pipe, _crear_job(args, opciones), args[0], args[3])
+        pipe.execute()
+
+    logger.info(f"✅ {len(fotos)} jobs encolados en lote")
+    despachar(maximo=len(fotos))
+    return len(fotos)
+
+def con_marca(gasto_ids):
+    """
+    Los gasto_ids cuyo job marcado sigue vigente: esperando en el carril,
+    encolado, programado para reintento o en proceso.
+
+    Se consulta el estado del job y no solo la marca: un job que terminó,
+    falló o expiró no cuenta aunque la marca siga, y uno que espera horas
+    en el carril cuenta sin depender de renovar la marca.
+    """
+    if redis_conn is None or not gasto_ids:
+        return set()
+    marcas = redis_conn.mget([_clave_marca(g) for g in gasto_ids])
+    marcados = [(g, marca.decode()) for g, marca in zip(gasto_ids, marcas) if marca is not None]
+    if not marcados:
+        return set()
+
+    jobs = Job.fetch_many([job_id for _, job_id in marcados], connection=redis_conn)
+    return {
+        g for (g, _), job in zip(marcados, jobs)
+        if job is not None and job.get_status(refresh=False) in ESTADOS_VIGENTES
+    }
+
+def despachar(maximo=100):
+    """Pasa a la cola 'fotos' los jobs de los usuarios con cupo, por turnos"""
+    if redis_conn is None:
+        return 0
+
+    job_ids = _despachar(
+        keys=[CLAVE_USUARIOS],
+        args=[PREFIJO, time.time(), CUPO_TTL, FOTOS_MAX_EN_VUELO, maximo]
+    )
+    if not job_ids:
+        return 0
+
+    jobs = Job.fetch_many([j.decode() for j in job_ids], connection=redis_conn)
+    with redis_conn.pipeline() as pipe:
+        for job in jobs:
+            if job is None:
+                # Expiró mientras esperaba; su cupo vence solo
+                continue
+            # enqueue_job no encola jobs deferred (los deja esperando dependencias);
+            # _enqueue_job es lo que usa RQ al liberar dependientes
+            foto_queue._enqueue_job(job, pipeline=pipe)
+        pipe.execute()
+    return len(job_ids)
+
+def diferir(job_actual, gasto_id, imagen_ref, chat_id, user_id, segundos):
+    """
+    Vuelve a programar la foto en 'segundos' (n8n no disponible) sin contarlo
+    como fallo. El job nuevo hereda el cupo del actual, así el usuario no
+    pierde su turno ni ocupa uno extra. Usa el scheduler de RQ.
+    """
+    cola = Queue(job_actual.origin, connection=redis_conn) if job_actual else foto_queue
+    job = cola.enqueue_in(
+        timedelta(seconds=segundos),
+        'worker.procesar_foto_job',
+        gasto_id, imagen_ref, chat_id, user_id,
+        **_opciones()
+    )
+
+    # Solo los jobs de 'fotos' pasaron por el reparto justo y tienen cupo
+    if job_actual and job_actual.origin == foto_queue.name:
+        en_vuelo = f'{PREFIJO}en_vuelo:{user_id}'
+        with redis_conn.pipeline() as pipe:
+            pipe.zrem(en_vuelo, job_actual.id)
+            pipe.zadd(en_vuelo, {job.id: time.time() + segundos + CUPO_TTL})
+            pipe.expire(en_vuelo, int(segundos + CUPO_TTL))
+            pipe.execute()
+
+    redis_conn.set(_clave_marca(gasto_id), job.id, ex=MARCA_TTL)
+
+    logger.info(f"⏸️ gasto_id={gasto_id} diferido {segundos:.0f}s: {job.id}")
+    return job
+
+def retener(user_id, job):
+    """
+    El job falló y RQ lo reintentará con el mismo id: en vez de liberar su
+    cupo se extiende hasta que vuelva a correr. El reintento entra directo
+    a 'fotos' sin pasar por el carril, así el usuario no supera
+    FOTOS_MAX_EN_VUELO mientras sus fotos sigan fallando.
+    """
+    if redis_conn is None or job.origin != foto_queue.name:
+        return
+    segundos = job.get_retry_interval() + CUPO_TTL
+    en_vuelo = f'{PREFIJO}en_vuelo:{user_id}'
+    try:
+        with redis_conn.pipeline() as pipe:
+            # xx: si el cupo ya venció no se vuelve a tomar
+            pipe.zadd(en_vuelo, {job.id: time.time() + segundos}, xx=True)
+            pipe.expire(en_vuelo, int(segundos))
+            pipe.execute()
+    except Exception as e:
+        logger.error(f"❌ Error reteniendo cupo de {user_id}: {e}")
+
+def liberar(user_id, job_id):
+    """Libera el cupo del job (terminó bien o falló sin más reintentos) y despacha al siguiente"""
+    if redis_conn is None:
+        return
+    try:
+        redis_conn.zrem(f'{PREFIJO}en_vuelo:{user_id}', job_id)
+        despachar()
+    except Exception as e:
+        logger.error(f"❌ Error liberando cupo de {user_id}: {e}")
+
 def get_job_status(job_id):
     """Obtiene el estado de un job"""
     if redis_conn is None:
@@ -81,11 +317,24 @@ def get_queue_info():
         return {'error': 'Redis no disponible'}
     
     try:
+        usuarios = [u.decode() for u in redis_conn.lrange(CLAVE_USUARIOS, 0, -1)]
+        with redis_conn.pipeline() as pipe:
+            for usuario in usuarios:
+                pipe.llen(f'{PREFIJO}carril:{usuario}')
+            en_carriles = sum(pipe.execute())
+
+        colas = (prioridad_queue, foto_queue)
         return {
-            'pending': len(foto_queue),
-            'started': foto_queue.started_job_registry.count,
-            'finished': foto_queue.finished_job_registry.count,
-            'failed': foto_queue.failed_job_registry.count
+            'pending': sum(len(q) for q in colas) + en_carriles,
+            'lanes': {
+                'prioridad': len(prioridad_queue),
+                'fotos': len(foto_queue),
+                'esperando_turno': en_carriles,
+            },
+            'users_waiting': len(usuarios),
+            'started': sum(q.started_job_registry.count for q in colas),
+            'finished': sum(q.finished_job_registry.count for q in colas),
+            'failed': sum(q.failed_job_registry.count for q in colas)
         }
     except Exception as e:
         return {'error': str(e)}
@@ -1,12 +1,27 @@
 #!/usr/bin/env python3
 """
 Script para iniciar el worker de RQ que procesa las fotos
+
+Modos (--modo o WORKER_MODE):
+    fork    rq.Worker estándar: un proceso hijo nuevo por job
+    simple  Un proceso de larga vida que ejecuta los jobs en sí mismo
+    pool    N procesos de larga vida pre-forkeados (--procesos o WORKER_PROCESOS)
+    async   Un proceso con hasta --concurrencia jobs en vuelo (WORKER_CONCURRENCIA)
+
+En simple/pool/async las importaciones, el pool de PostgreSQL y la sesión HTTP
+se mantienen calientes entre jobs. En async los resultados se escriben en
+finanzas por lotes (lotes_bd.py). El timeout de 300s y los reintentos
+(Retry) funcionan igual en todos los modos.
 """
 import os
 import sys
+import argparse
 import logging
 from redis import Redis
-from rq import Worker, Queue, Connection
+from rq import Worker, SimpleWorker
+from rq.worker_pool import WorkerPool
+
+from worker_async import AsyncWorker, WORKER_CONCURRENCIA
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -15,17 +30,106 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379')
+WORKER_MODE = os.getenv('WORKER_MODE', 'simple')
+WORKER_PROCESOS = int(os.getenv('WORKER_PROCESOS', '2'))
+# En orden de prioridad: los reintentos pedidos por el usuario primero
+COLAS = ['fotos_prioridad', 'fotos']
+MODOS = ('fork', 'simple', 'pool', 'async')
+
+
+class SimpleWorkerConScheduler(SimpleWorker):
+    """
+    SimpleWorker que siempre levanta el scheduler de RQ y precalienta.
+
+    Es la clase de los hijos de WorkerPool: work() corre ya en el hijo,
+    así que el pool de BD y la sesión HTTP se abren en cada proceso antes
+    de su primer job. Sin scheduler los reintentos con intervalo (Retry(interval=[...]))
+    quedan en ScheduledJobRegistry y nunca vuelven a la cola. WorkerPool
+    no expone with_scheduler, por eso se fuerza aquí; el lock del
+    scheduler en Redis garantiza que solo un proceso lo ejecute.
+    """
+
+    def work(self, *args, **kwargs):
+        precalentar()
+        kwargs['with_scheduler'] = True
+        return super().work(*args, **kwargs)
+
+
+def precalentar():
+    """Importa el código de los jobs y abre el pool antes del primer job"""
+    import worker  # noqa: F401
+    import db
+    from http_client import get_session
+
+    try:
+        db.init_pool()
+    except Exception as e:
+        # El pool se reintenta en el primer job; no impedir que arranque el worker
+        logger.warning(f"⚠️ No se pudo precalentar el pool de BD: {e}")
+    get_session()
+
+
+def iniciar(modo, procesos, redis_conn, burst=False, concurrencia=WORKER_CONCURRENCIA):
+    """
+    Inicia el worker en el modo indicado. Retorna cuando termina (burst o señal).
+
+    No levanta el barrido de gastos huérfanos: lo hace __main__, así los
+    benchmarks (bench/) pueden llamar a iniciar() sin tocar la BD real.
+    """
+    if modo == 'fork':
+        worker = Worker(COLAS, connection=redis_conn)
+        logger.info("🚀 Worker (fork por job) iniciado. Esperando trabajos en colas fotos_prioridad/fotos...")
+        worker.work(burst=burst, with_scheduler=True)
+
+    elif modo == 'simple':
+        precalentar()
+        worker = SimpleWorker(COLAS, connection=redis_conn)
+        logger.info("🚀 Worker (sin fork) iniciado. Esperando trabajos en colas fotos_prioridad/fotos...")
+        worker.work(burst=burst, with_scheduler=True)
+
+    elif modo == 'pool':
+        # Los hijos heredan los módulos importados; cada hijo abre sus conexiones en work()
+        import worker  # noqa: F401
+        pool = WorkerPool(COLAS, connection=redis_conn, num_workers=procesos,
+                          worker_class=SimpleWorkerConScheduler)
+        logger.info(f"🚀 Pool de {procesos} workers sin fork iniciado. Esperando trabajos en colas fotos_prioridad/fotos...")
+        pool.start(burst=burst)
+
+    elif modo == 'async':
+        precalentar()
+        # Muchos jobs terminan a la vez en este proceso: sus UPDATE van por lotes
+        import lotes_bd
+        lotes_bd.activar()
+        worker = AsyncWorker(COLAS, connection=redis_conn, concurrencia=concurrencia)
+        logger.info(f"🚀 Worker async iniciado ({concurrencia} jobs en vuelo). Esperando trabajos en colas fotos_prioridad/fotos...")
+        worker.work(burst=burst, with_scheduler=True)
+
+    else:
+        raise ValueError(f"Modo de worker desconocido: {modo}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Worker de fotos de boletas')
+    parser.add_argument('--modo', choices=MODOS, default=WORKER_MODE)
+    parser.add_argument('--procesos', type=int, default=WORKER_PROCESOS)
+    parser.add_argument('--concurrencia', type=int, default=WORKER_CONCURRENCIA, help='Jobs en vuelo (modo async)')
+    parser.add_argument('--burst', action='store_true', help='Terminar cuando la cola quede vacía')
+    return parser.parse_args(argv)
+
 
 if __name__ == '__main__':
+    args = parse_args()
+
     try:
         redis_conn = Redis.from_url(REDIS_URL)
         redis_conn.ping()
         logger.info(f"✅ Conectado a Redis: {REDIS_URL}")
 
-        with Connection(redis_conn):
-            worker = Worker(['fotos'])
-            logger.info("🚀 Worker iniciado. Esperando trabajos en cola 'fotos'...")
-            worker.work()
+        # Cupos vencidos de workers caídos y gastos sin job: al iniciar y luego periódicamente
+        import barrido
+        barrido.iniciar()
+
+        iniciar(args.modo, args.procesos, redis_conn, burst=args.burst, concurrencia=args.concurrencia)
 
     except Exception as e:
         logger.error(f"❌ Error iniciando worker: {e}")
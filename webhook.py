@@ -0,0 +1,114 @@
+"""
+Modo webhook del bot (BOT_MODE=webhook)
+
+Servidor HTTP propio (tornado, viene con python-telegram-bot[webhooks]):
+
+    POST WEBHOOK_PATH   updates de Telegram; exige el header
+                        X-Telegram-Bot-Api-Secret-Token == WEBHOOK_SECRET
+    GET  /health        estado del bot para el balanceador
+
+Varias réplicas pueden atender el mismo webhook detrás de un balanceador.
+"""
+import os
+import hmac
+import json
+import signal
+import asyncio
+import logging
+
+import tornado.web
+from tornado.httpserver import HTTPServer
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8080'))
+CABECERA_SECRETO = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class UpdateHandler(tornado.web.RequestHandler):
+    """Recibe updates de Telegram y los pasa a la cola del Application"""
+
+    def initialize(self, app: Application, secreto):
+        self.app = app
+        self.secreto = secreto
+
+    async def post(self):
+        recibido = self.request.headers.get(CABECERA_SECRETO, '')
+        if not hmac.compare_digest(recibido, self.secreto):
+            logger.warning("⚠️ Webhook con secret token inválido")
+            raise tornado.web.HTTPError(403)
+
+        try:
+            update = Update.de_json(json.loads(self.request.body), self.app.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"⚠️ Update inválido: {e}")
+            raise tornado.web.HTTPError(400)
+
+        await self.app.update_queue.put(update)
+        self.set_status(200)
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    def initialize(self, app: Application):
+        self.app = app
+
+    def get(self):
+        sano = self.app.running
+        self.set_status(200 if sano else 503)
+        self.write({
+            'status': 'ok' if sano else 'detenido',
+            'updates_en_cola': self.app.update_queue.qsize(),
+        })
+
+
+async def _servir(app: Application, allowed_updates):
+    if not WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL es obligatorio en modo webhook")
+    if not WEBHOOK_SECRET:
+        # Sin secreto cualquiera que conozca la URL podría inyectar updates
+        raise ValueError("WEBHOOK_SECRET es obligatorio en modo webhook")
+
+    servidor = HTTPServer(tornado.web.Application([
+        (WEBHOOK_PATH, UpdateHandler, {'app': app, 'secreto': WEBHOOK_SECRET}),
+        (r'/health', HealthHandler, {'app': app}),
+    ]))
+
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, detener.set)
+
+    async with app:
+        if app.post_init:
+            await app.post_init(app)
+
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=allowed_updates,
+        )
+        await app.start()
+        servidor.listen(WEBHOOK_PORT, address=WEBHOOK_LISTEN)
+        logger.info(f"🌐 Webhook escuchando en {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+        try:
+            await detener.wait()
+        finally:
+            servidor.stop()
+            await app.stop()
+            if app.post_stop:
+                await app.post_stop(app)
+
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+
+
+def run_webhook(app: Application, allowed_updates):
+    """Equivalente a app.run_polling() pero recibiendo updates por webhook"""
+    asyncio.run(_servir(app, allowed_updates))
@@ -1,14 +1,28 @@
 """
-Worker que procesa fotos de boletas desde base64
+Worker que procesa fotos de boletas a partir de su file_id de Telegram
 """
 import os
+import time
 import logging
 import requests
-import psycopg2
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
 import base64
 import io
+import threading
+
+from rq import get_current_job
+
+import db
+import bandeja_salida
+import circuito_n8n
+import imagenes
+import lotes_bd
+import metricas
+import notificador
+import ocr_cache
+import preproceso
+from http_client import get_session, reset_session
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -16,45 +30,166 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-DATABASE_URL = os.getenv('DATABASE_PUBLIC_URL')
 N8N_ENDPOINT = os.getenv('N8N_ENDPOINT')
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+
+# Máximo de llamadas simultáneas a n8n por proceso (relevante en modo async)
+N8N_MAX_INFLIGHT = int(os.getenv('N8N_MAX_INFLIGHT', '8'))
+_n8n_cupos = threading.BoundedSemaphore(N8N_MAX_INFLIGHT)
 
-def procesar_foto_job(gasto_id, image_base64, chat_id, user_id):
+# Los jobs antiguos traían la imagen completa en base64 en lugar del file_id
+LARGO_MAX_FILE_ID = 1024
+
+def procesar_foto_job(gasto_id, imagen_ref, chat_id, user_id):
     """
-    Procesa foto desde base64
+    Descarga la foto referenciada por imagen_ref y la procesa con n8n
     """
     logger.info(f"🔄 Procesando gasto_id={gasto_id}")
 
+    imagen_clave = None
+    diferido = False
+    reintento = False
+    inicio_job = time.monotonic()
+    tiempos = {'procesando_at': datetime.now()}
+
+    job = get_current_job()
+    if job is not None and job.created_at:
+        # Desde encolar_foto (incluye la espera en el carril del usuario)
+        espera = max((datetime.utcnow() - job.created_at).total_seconds(), 0)
+        metricas.observar('espera_cola', espera)
+        tiempos['encolado_at'] = tiempos['procesando_at'] - timedelta(seconds=espera)
+
     try:
-        logger.info(f"📤 Enviando imagen a n8n...")
-        ocr_data = enviar_a_n8n(image_base64)
+        estado = leer_estado(gasto_id)
+        if estado is None:
+            logger.info(f"🗑️ gasto_id={gasto_id} ya no existe, nada que procesar")
+            return {'success': False, 'gasto_id': gasto_id}
+        if estado[0] in ('processed', 'confirmed'):
+            # Reintento de un job que ya guardó el OCR: se reenvía el mensaje, no se repite el OCR
+            if estado[0] == 'processed':
+                reenviar_confirmacion(gasto_id, chat_id, estado[1])
+            return {'success': True, 'gasto_id': gasto_id, 'data': estado[1]}
+
+        with metricas.medir('descarga_telegram'):
+            image_bytes = descargar_imagen(imagen_ref)
+        logger.info(f"✅ Imagen descargada, tamaño: {len(image_bytes)} bytes")
+
+        # finanzas solo guarda la clave; los bytes quedan en el almacén
+        imagen_clave = imagenes.get_store().guardar(image_bytes)
+
+        ocr_data = ocr_cache.obtener(imagen_clave)
+
+        if ocr_data is None:
+            with metricas.medir('preproceso'):
+                envio_bytes, stats = preproceso.preprocesar(image_bytes)
+            logger.info(
+                f"🪄 Preprocesada ({', '.join(stats['pasos']) or 'sin cambios'}): "
+                f"{stats['bytes_antes']} → {stats['bytes_despues']} bytes"
+            )
+
+            # Con n8n caído o saturado lanza N8nNoDisponible y el job se difiere
+            token = circuito_n8n.adquirir()
+            inicio = time.monotonic()
+            try:
+                logger.info(f"📤 Enviando imagen a n8n...")
+                ocr_data = enviar_a_n8n(envio_bytes)
+            finally:
+                latencia = time.monotonic() - inicio
+                metricas.observar('n8n', latencia)
+                circuito_n8n.registrar(token, ocr_data is not None, latencia)
+            tiempos['ocr_at'] = datetime.now()
 
-        if not ocr_data:
-            raise Exception("n8n no devolvió datos válidos")
+            if not ocr_data:
+                raise Exception("n8n no devolvió datos válidos")
 
-        logger.info(f"✅ Datos recibidos de n8n: {ocr_data}")
+            logger.info(f"✅ Datos recibidos de n8n: {ocr_data}")
+            ocr_cache.guardar(imagen_clave, ocr_data)
 
-        actualizar_bd(gasto_id, ocr_data, status='processed')
-        enviar_confirmacion_telegram(chat_id, gasto_id, ocr_data)
+        # La confirmación queda en la bandeja de salida en la misma transacción
+        with metricas.medir('bd_update'):
+            actualizar_bd(gasto_id, ocr_data, status='processed', imagen_clave=imagen_clave, tiempos=tiempos,
+                          notificacion=(chat_id,) + construir_confirmacion(gasto_id, ocr_data))
 
         logger.info(f"✅ Completado gasto_id={gasto_id}")
         return {'success': True, 'gasto_id': gasto_id, 'data': ocr_data}
 
+    except circuito_n8n.N8nNoDisponible as e:
+        # No es un fallo: se reprograma sin gastar reintentos ni avisar error al usuario
+        from queue_manager import diferir
+        diferir(get_current_job(), gasto_id, imagen_clave or imagen_ref, chat_id, user_id, e.espera)
+        diferido = True
+        return {'success': False, 'deferred': True, 'gasto_id': gasto_id}
+
     except Exception as e:
         logger.error(f"❌ Error: {e}")
 
+        # Último intento: RQ ya no lo reintentará y barrido.py tampoco debe
+        # ('fallido'); solo el botón 🔄 Reintentar lo vuelve a encolar
+        job = get_current_job()
+        reintento = job is not None and bool(job.retries_left)
+        status = 'error' if reintento else 'fallido'
+
         try:
-            actualizar_bd(gasto_id, {'error': str(e)}, status='error')
+            actualizar_bd(gasto_id, {'error': str(e)}, status=status, imagen_clave=imagen_clave, tiempos=tiempos,
+                          notificacion=(chat_id,) + construir_error(gasto_id))
         except:
-            pass
+            # Sin BD no hay bandeja de salida: el aviso va directo a la cola del notificador
+            notificador.notificar(chat_id, gasto_id, *construir_error(gasto_id))
 
-        enviar_error_telegram(chat_id, gasto_id)
         raise
 
-def enviar_a_n8n(image_base64):
+    finally:
+        metricas.observar('proceso_total', time.monotonic() - inicio_job)
+        metricas.volcar()
+        if reintento:
+            # RQ lo reprograma con el mismo id: el cupo sigue ocupado hasta que vuelva
+            from queue_manager import retener
+            retener(user_id, get_current_job())
+        elif not diferido:
+            liberar_turno(user_id)
+
+def liberar_turno(user_id):
+    """Libera el cupo del usuario en el reparto justo de queue_manager"""
+    job = get_current_job()
+    if job is None:
+        return
+    from queue_manager import liberar
+    liberar(user_id, job.id)
+
+def descargar_imagen(imagen_ref):
     """
-    Envía imagen en base64 a n8n
+    Obtiene los bytes de la imagen desde la Bot API de Telegram (getFile)
+
+    Acepta también claves del almacén ('sha256:...') y el base64 completo
+    de jobs encolados antes del cambio.
+    """
+    if imagenes.es_clave(imagen_ref):
+        image_bytes = imagenes.get_store().obtener(imagen_ref)
+        if image_bytes is None:
+            raise Exception(f"Imagen {imagen_ref} no está en el almacén")
+        return image_bytes
+
+    if len(imagen_ref) > LARGO_MAX_FILE_ID:
+        logger.info("📦 Job antiguo con imagen en base64")
+        return base64.b64decode(imagen_ref)
+
+    session = get_session()
+    response = session.get(
+        f"{TELEGRAM_API_URL}/bot{TELEGRAM_TOKEN}/getFile",
+        params={'file_id': imagen_ref},
+        timeout=10
+    )
+    response.raise_for_status()
+    file_path = response.json()['result']['file_path']
+
+    response = session.get(f"{TELEGRAM_API_URL}/file/bot{TELEGRAM_TOKEN}/{file_path}", timeout=30)
+    response.raise_for_status()
+    return response.content
+
+def enviar_a_n8n(image_bytes):
+    """
+    Envía los bytes de la imagen a n8n
     """
     if not N8N_ENDPOINT:
         logger.error("❌ N8N_ENDPOINT no configurado")
@@ -63,10 +198,6 @@ def enviar_a_n8n(image_base64):
     try:
         logger.info(f"📤 Preparando imagen para n8n...")
 
-        # Decodificar base64
-        image_bytes = base64.b64decode(image_base64)
-        logger.info(f"✅ Imagen decodificada, tamaño: {len(image_bytes)} bytes")
-
         # Crear archivo en memoria
         image_file = io.BytesIO(image_bytes)
         image_file.seek(0)
@@ -75,7 +206,8 @@ def enviar_a_n8n(image_base64):
         files = {'imagen': ('boleta.jpg', image_file, 'image/jpeg')}
 
         logger.info(f"🌐 Enviando POST a: {N8N_ENDPOINT}")
-        response = requests.post(N8N_ENDPOINT, files=files, timeout=60)
+        with _n8n_cupos:
+            response = get_session().post(N8N_ENDPOINT, files=files, timeout=60)
 
         logger.info(f"📥 Status code: {response.status_code}")
         logger.info(f"📥 Response preview: {response.text[:300] if response.text else '(vacío)'}")
@@ -105,12 +237,13 @@ def enviar_a_n8n(image_base64):
             logger.error(f"💡 N8N debe retornar Content-Type: application/json")
             return None
 
-    except base64.binascii.Error as e:
-        logger.error(f"❌ Error decodificando base64: {e}")
-        return None
     except requests.Timeout:
         logger.error("⏱️ Timeout esperando respuesta de n8n (>60s)")
         return None
+    except requests.ConnectionError as e:
+        logger.error(f"🌐 Error de conexión con n8n: {e}")
+        reset_session()
+        return None
     except requests.RequestException as e:
         logger.error(f"🌐 Error de conexión con n8n: {e}")
         return None
@@ -118,14 +251,30 @@ def enviar_a_n8n(image_base64):
         logger.error(f"❌ Error inesperado: {type(e).__name__}: {e}")
         return None
 
-def actualizar_bd(gasto_id, ocr_data, status):
+def leer_estado(gasto_id):
+    """(status, ocr_data) del gasto, o None si ya no existe"""
+    return db.ejecutar_sql_sync(
+        "SELECT status, ocr_data FROM finanzas WHERE id = %s", (gasto_id,), fetch='one'
+    )
+
+def reenviar_confirmacion(gasto_id, chat_id, ocr_data):
+    """Vuelve a dejar la confirmación en la bandeja de salida"""
+    with db.conexion() as conn:
+        with conn.cursor() as cur:
+            bandeja_salida.agregar(cur, chat_id, gasto_id, *construir_confirmacion(gasto_id, ocr_data))
+        conn.commit()
+    logger.info(f"📨 gasto_id={gasto_id} ya procesado, confirmación reenviada")
+
+def actualizar_bd(gasto_id, ocr_data, status, imagen_clave=None, tiempos=None, notificacion=None):
     """
     Actualiza BD con datos del OCR
+
+    tiempos: encolado_at, procesando_at y ocr_at del job (en el mismo UPDATE)
+    notificacion: (chat_id, texto, teclado) para la bandeja de salida, en la
+                  misma transacción que el UPDATE (solo si el gasto existe)
     """
+    tiempos = tiempos or {}
     try:
-        conn = psycopg2.connect(DATABASE_URL, sslmode="require")
-        cursor = conn.cursor()
-
         fecha_str = ocr_data.get('fecha')
         monto = ocr_data.get('monto')
         categoria = ocr_data.get('categoria')
@@ -145,35 +294,27 @@ def actualizar_bd(gasto_id, ocr_data, status):
             except:
                 logger.warning(f"⚠️ Fecha inválida: {fecha_str}")
 
-        cursor.execute("""
-            UPDATE finanzas
-            SET
-                status = %s,
-                ocr_data = %s,
-                processed_at = %s,
-                fecha = COALESCE(%s, fecha),
-                monto = COALESCE(%s, monto),
-                categoria = COALESCE(%s, categoria),
-                descripcion = COALESCE(%s, descripcion),
-                tipo_gasto = COALESCE(%s, tipo_gasto),
-                banco = COALESCE(%s, banco)
-            WHERE id = %s
-        """, (
-            status,
-            json.dumps(ocr_data),
-            datetime.now(),
-            fecha_obj,
-            float(monto) if monto else None,
-            categoria,
-            descripcion,
-            tipo_gasto,
-            banco,
-            gasto_id
-        ))
-
-        conn.commit()
-        cursor.close()
-        conn.close()
+        fila = lotes_bd.FilaOcr(
+            id=gasto_id,
+            status=status,
+            ocr_data=json.dumps(ocr_data),
+            processed_at=datetime.now(),
+            fecha=fecha_obj,
+            monto=float(monto) if monto else None,
+            categoria=categoria,
+            descripcion=descripcion,
+            tipo_gasto=tipo_gasto,
+            banco=banco,
+            image_path=imagen_clave,
+            encolado_at=tiempos.get('encolado_at'),
+            procesando_at=tiempos.get('procesando_at'),
+            ocr_at=tiempos.get('ocr_at'),
+        )
+
+        # En modo async se agrupa con las filas de otros jobs en un solo UPDATE
+        if not lotes_bd.escribir(fila, notificacion):
+            logger.warning(f"⚠️ gasto_id={gasto_id} ya no existe o ya estaba procesado, nada que actualizar")
+            return
 
         logger.info(f"💾 BD actualizada: gasto_id={gasto_id}, status={status}")
 
@@ -181,16 +322,15 @@ def actualizar_bd(gasto_id, ocr_data, status):
         logger.error(f"❌ Error BD: {e}")
         raise
 
-def enviar_confirmacion_telegram(chat_id, gasto_id, ocr_data):
+def construir_confirmacion(gasto_id, ocr_data):
     """
-    Envía confirmación con botones
+    Texto y teclado inline de la confirmación (también lo usa el bot)
     """
-    try:
-        monto = ocr_data.get('monto', 'No detectado')
-        if isinstance(monto, (int, float)):
-            monto = f"${monto:,.0f}".replace(',', '.')
+    monto = ocr_data.get('monto', 'No detectado')
+    if isinstance(monto, (int, float)):
+        monto = f"${monto:,.0f}".replace(',', '.')
 
-        mensaje = f"""📋 *Datos extraídos:*
+    mensaje = f"""📋 *Datos extraídos:*
 
 💰 Monto: {monto}
 📅 Fecha: {ocr_data.get('fecha', 'No detectada')}
@@ -199,73 +339,43 @@ def enviar_confirmacion_telegram(chat_id, gasto_id, ocr_data):
 
 ¿Son correctos?"""
 
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "✅ Guardar", "callback_data": f"confirm_{gasto_id}"},
-                    {"text": "✏️ Editar", "callback_data": f"edit_{gasto_id}"}
-                ],
-                [
-                    {"text": "🗑️ Cancelar", "callback_data": f"cancel_{gasto_id}"}
-                ]
+    keyboard = {
+        "inline_keyboard": [
+            [
+                {"text": "✅ Guardar", "callback_data": f"confirm_{gasto_id}"},
+                {"text": "✏️ Editar", "callback_data": f"edit_{gasto_id}"}
+            ],
+            [
+                {"text": "🗑️ Cancelar", "callback_data": f"cancel_{gasto_id}"}
             ]
-        }
+        ]
+    }
 
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': mensaje,
-            'parse_mode': 'Markdown',
-            'reply_markup': json.dumps(keyboard)
-        }
+    return mensaje, keyboard
 
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
-
-        logger.info(f"✅ Confirmación enviada a chat_id={chat_id}")
-
-    except Exception as e:
-        logger.error(f"❌ Error enviando mensaje: {e}")
-        raise
-
-def enviar_error_telegram(chat_id, gasto_id):
+def construir_error(gasto_id):
     """
-    Notifica error al usuario
+    Texto y teclado inline del aviso de error
     """
-    try:
-        mensaje = """❌ *Error procesando boleta*
+    mensaje = """❌ *Error procesando boleta*
 
 No pude extraer los datos.
 
 ¿Qué hacer?"""
 
-        keyboard = {
-            "inline_keyboard": [
-                [
-                    {"text": "🖋 Ingresar manual", "callback_data": f"manual_{gasto_id}"},
-                    {"text": "🔄 Reintentar", "callback_data": f"retry_{gasto_id}"}
-                ],
-                [
-                    {"text": "🗑️ Cancelar", "callback_data": f"cancel_{gasto_id}"}
-                ]
+    keyboard = {
+        "inline_keyboard": [
+            [
+                {"text": "🖋 Ingresar manual", "callback_data": f"manual_{gasto_id}"},
+                {"text": "🔄 Reintentar", "callback_data": f"retry_{gasto_id}"}
+            ],
+            [
+                {"text": "🗑️ Cancelar", "callback_data": f"cancel_{gasto_id}"}
             ]
-        }
-
-        url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
-        payload = {
-            'chat_id': chat_id,
-            'text': mensaje,
-            'parse_mode': 'Markdown',
-            'reply_markup': json.dumps(keyboard)
-        }
+        ]
+    }
 
-        response = requests.post(url, json=payload, timeout=10)
-        response.raise_for_status()
-
-        logger.info(f"📨 Error enviado a chat_id={chat_id}")
-
-    except Exception as e:
-        logger.error(f"❌ Error enviando error: {e}")
+    return mensaje, keyboard
 
 if __name__ == "__main__":
     print("⚠️ Ejecutar con: python start_worker.py")
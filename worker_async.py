@@ -0,0 +1,188 @@
+"""
+Worker que procesa varios jobs de la cola a la vez en un solo proceso
+
+No es I/O asíncrona: es un pool de hilos con un despachador asyncio. El
+loop saca jobs de Redis y mantiene hasta WORKER_CONCURRENCIA en vuelo;
+cada job corre con Worker.perform_job de RQ en un hilo del executor
+(requests y psycopg2 son bloqueantes), así que el registro de started,
+finished y failed, los reintentos (Retry) y los callbacks son los mismos
+que en los otros modos. El timeout por job usa TimerDeathPenalty porque
+SIGALRM solo funciona en el hilo principal; la excepción se entrega al
+hilo cuando vuelve de la llamada bloqueante en curso (n8n ya tiene su
+propio timeout de 60s).
+
+Todos los jobs comparten la instancia del worker, así que el estado de
+RQ pensado para un job a la vez se lleva distinto:
+
+- current_job y current_job_working_time del worker no se escriben; los
+  jobs en vuelo están en _en_vuelo. send_stop_job_command no aplica.
+- El worker queda BUSY mientras haya algún job en vuelo.
+- Una tarea del loop renueva cada job_monitoring_interval el heartbeat
+  del worker y de los jobs en vuelo (su entrada en StartedJobRegistry),
+  también con todos los cupos ocupados y sin dequeue.
+
+Las llamadas a n8n se limitan aparte con N8N_MAX_INFLIGHT (worker.py).
+"""
+import os
+import signal
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from rq import Worker
+from rq.worker import WorkerStatus
+from rq.timeouts import TimerDeathPenalty
+from rq.utils import utcnow
+
+WORKER_CONCURRENCIA = int(os.getenv('WORKER_CONCURRENCIA', '16'))
+# Segundos que espera cada BLPOP antes de revisar si se pidió detener el worker
+ESPERA_DEQUEUE = 1
+
+
+class AsyncWorker(Worker):
+    death_penalty_class = TimerDeathPenalty
+
+    def __init__(self, *args, concurrencia=WORKER_CONCURRENCIA, **kwargs):
+        # Antes de super(): set_state() los consulta
+        self._en_vuelo = {}
+        self._lock_en_vuelo = threading.Lock()
+        super().__init__(*args, **kwargs)
+        self.concurrencia = concurrencia
+
+    def set_state(self, state, pipeline=None):
+        # dequeue_job_and_maintain_ttl marca IDLE antes de cada dequeue aunque haya jobs en vuelo
+        if state == WorkerStatus.IDLE and self._en_vuelo:
+            state = WorkerStatus.BUSY
+        super().set_state(state, pipeline=pipeline)
+
+    def set_current_job_id(self, job_id=None, pipeline=None):
+        """No-op: con varios jobs en vuelo no hay un job actual (ver _en_vuelo)"""
+
+    def prepare_job_execution(self, job, remove_from_intermediate_queue=False):
+        """Como el de RQ, pero registra el job en _en_vuelo en vez de como job actual del worker"""
+        with self._lock_en_vuelo:
+            self._en_vuelo[job.id] = job
+
+        ttl = self.job_monitoring_interval + 60
+        with self.connection.pipeline() as pipeline:
+            self.set_state(WorkerStatus.BUSY, pipeline=pipeline)
+            self.heartbeat(ttl, pipeline=pipeline)
+            job.heartbeat(utcnow(), ttl, pipeline=pipeline)
+            job.prepare_for_execution(self.name, pipeline=pipeline)
+            if remove_from_intermediate_queue:
+                queue = self.queue_class(job.origin, connection=self.connection)
+                pipeline.lrem(queue.intermediate_queue_key, 1, job.id)
+            pipeline.execute()
+
+    def perform_job(self, job, queue):
+        try:
+            return super().perform_job(job, queue)
+        finally:
+            with self._lock_en_vuelo:
+                self._en_vuelo.pop(job.id, None)
+                if not self._en_vuelo:
+                    self.set_state(WorkerStatus.IDLE)
+
+    def _mantener_latidos(self):
+        """Heartbeat del worker y de cada job en vuelo en un solo pipeline"""
+        with self._lock_en_vuelo:
+            jobs = list(self._en_vuelo.values())
+
+        ttl = self.job_monitoring_interval + 60
+        with self.connection.pipeline() as pipeline:
+            self.heartbeat(ttl, pipeline=pipeline)
+            for job in jobs:
+                job.heartbeat(utcnow(), ttl, pipeline=pipeline, xx=True)
+            resultados = pipeline.execute()
+
+        # 2 comandos por heartbeat; hset devuelve 1 si recreó la clave de un job ya borrado
+        for i, job in enumerate(jobs):
+            if resultados[2 + 2 * i] == 1:
+                self.connection.delete(job.key)
+
+    async def _latir(self):
+        while True:
+            await asyncio.sleep(self.job_monitoring_interval)
+            try:
+                await asyncio.to_thread(self._mantener_latidos)
+            except Exception as e:
+                self.log.warning('Heartbeat falló: %s', e)
+
+    def request_stop(self, signum, frame):
+        """Apagado en caliente: no saca más jobs y espera los que están en vuelo"""
+        self.log.info('Apagado solicitado, esperando jobs en curso. Ctrl+C otra vez para forzar.')
+        self._shutdown_requested_date = utcnow()
+        signal.signal(signal.SIGINT, self.request_force_stop)
+        signal.signal(signal.SIGTERM, self.request_force_stop)
+        self._stop_requested = True
+        self.set_shutdown_requested_date()
+
+    def work(self, burst=False, logging_level="INFO", with_scheduler=True, **kwargs):
+        self.bootstrap(logging_level)
+        if with_scheduler:
+            self._start_scheduler(burst, logging_level)
+        self._install_signal_handlers()
+
+        try:
+            return asyncio.run(self._trabajar(burst))
+        finally:
+            self.teardown()
+
+    def _sacar_job(self, burst):
+        """BLPOP corto para no quedar bloqueado si llega la señal de parada"""
+        if self.should_run_maintenance_tasks:
+            self.run_maintenance_tasks()
+
+        if burst:
+            return self.dequeue_job_and_maintain_ttl(None)
+        return self.dequeue_job_and_maintain_ttl(ESPERA_DEQUEUE, max_idle_time=ESPERA_DEQUEUE)
+
+    async def _trabajar(self, burst):
+        loop = asyncio.get_running_loop()
+        cupos = asyncio.Semaphore(self.concurrencia)
+        en_curso = set()
+        completados = 0
+
+        # Hilo aparte para el dequeue: los jobs nunca lo dejan sin hilo libre
+        dequeue_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='dequeue')
+        jobs_executor = ThreadPoolExecutor(max_workers=self.concurrencia, thread_name_prefix='job')
+
+        def terminado(futuro):
+            en_curso.discard(futuro)
+            cupos.release()
+
+        # Sigue latiendo con los cupos llenos y mientras se esperan los jobs al apagar
+        latidos = asyncio.create_task(self._latir())
+        try:
+            while not self._stop_requested:
+                await cupos.acquire()
+                # La señal pudo llegar mientras esperábamos un cupo
+                if self._stop_requested:
+                    cupos.release()
+                    break
+
+                resultado = await loop.run_in_executor(dequeue_executor, self._sacar_job, burst)
+                if resultado is None:
+                    cupos.release()
+                    if burst and not en_curso:
+                        self.log.info('Worker %s: cola vacía, terminando', self.key)
+                        break
+                    if burst:
+                        await asyncio.wait(en_curso, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+
+                job, queue = resultado
+                futuro = loop.run_in_executor(jobs_executor, self.perform_job, job, queue)
+                en_curso.add(futuro)
+                futuro.add_done_callback(terminado)
+                completados += 1
+
+        finally:
+            if en_curso:
+                self.log.info('Esperando %d jobs en curso...', len(en_curso))
+                await asyncio.gather(*en_curso, return_exceptions=True)
+            latidos.cancel()
+            dequeue_executor.shutdown(wait=True)
+            jobs_executor.shutdown(wait=True)
+
+        return bool(completados)